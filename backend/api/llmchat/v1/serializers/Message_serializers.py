@@ -8,4 +8,4 @@ class MessageSerializer(ModelSerializer):
     class Meta:
         model  = Message
         fields = '__all__'
-        read_only_fields = ('id','room_id','message_id')
\ No newline at end of file
+        read_only_fields = ('id','room_id','message_id','num_tokens')
\ No newline at end of file
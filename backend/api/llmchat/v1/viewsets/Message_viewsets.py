@@ -7,6 +7,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 from api.utils import StandardThrottle
 from apps.llmchat.models import Message
+from apps.llmchat.utils import invalidate_history_cache
 from ..serializers import MessageSerializer
 
 
@@ -25,7 +26,10 @@ class MessageViewSet(APIView):
             if message_obj:
                 serializer = MessageSerializer(instance=message_obj, data=request.data, partial=True)
                 serializer.is_valid(raise_exception=True)
-                serializer.save()
+                # 本文が変わる場合があるのでトークン数は数え直す (get_history で数える)
+                serializer.save(num_tokens=None)
+                # consumer が参照するヒストリーのバッファを破棄
+                invalidate_history_cache(room_id)
                 response = Response(serializer.data, status=status.HTTP_200_OK)
             else:
                 response = Response({}, status=status.HTTP_404_NOT_FOUND)
@@ -49,6 +53,7 @@ class MessageViewSet(APIView):
                                             room_id__is_active   = True,)
             message_obj.is_active = False
             message_obj.save()
+            invalidate_history_cache(room_id)
             response = Response({}, status=status.HTTP_204_NO_CONTENT)
         except Exception as e:
             print(e)
@@ -8,6 +8,7 @@ from rest_framework.views import APIView
 from api.utils import StandardThrottle
 from apps.llmchat.models import RoomSettings
 from apps.llmchat.models import MODEL_NAME_CHOICES
+from apps.llmchat.utils import refresh_room_settings_cache
 from ..serializers import RoomSettingsSerializer
 
 
@@ -53,6 +54,8 @@ class RoomSettingsViewSet(APIView):
                 serializer = RoomSettingsSerializer(instance=room_settings_obj, data=request.data, partial=True)
                 serializer.is_valid(raise_exception=True)
                 serializer.save()
+                # consumer が参照するルーム設定のキャッシュを更新
+                refresh_room_settings_cache(serializer.instance)
                 response = Response(serializer.data, status=status.HTTP_200_OK)
             else:
                 response = Response({}, status=status.HTTP_404_NOT_FOUND)
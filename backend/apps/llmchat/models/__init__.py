@@ -1,4 +1,5 @@
 from .Room_models import Room, RoomSettings
 from .Message_models import Message
 from .SocketAccess_models import SocketAccess
-from .Choices import MODEL_NAME_CHOICES
\ No newline at end of file
+from .Choices import MODEL_NAME_CHOICES
+from .receivers.RoomSettingsModels_receivers import refresh_room_settings_cache_on_save, invalidate_room_settings_cache_on_delete
\ No newline at end of file
@@ -2,13 +2,27 @@ from .image_settings import (
     AI_ICON_RESIZE_WIDTH, AI_ICON_RESIZE_HEIGHT,
 )
 from .llm_settings import (
-    MIN_TOKENS, MAX_TOKENS, SEND_MAX_TOKENS,
+    MIN_TOKENS, MAX_TOKENS, SEND_MAX_TOKENS_DICT, DEFAULT_SEND_MAX_TOKENS,
     RETRY_LIMIT_N, MAX_HISSTORY_N,
     MAX_LEN_SYSTEM_SENTENCE, MAX_LEN_ASSISTANT_SENTENCE,
     DEFAULT_ROOM_NAME, MAX_LEN_ROOM_NAME,
     ALLOWD_DOMAINS_LIST,
+    ROOM_SETTINGS_L1_CACHE_SEC, ROOM_SETTINGS_CACHE_SEC,
+    HISTORY_CACHE_SEC,
+    MESSAGE_WRITE_BATCH_SIZE, MESSAGE_WRITE_INTERVAL_SEC, MESSAGE_SPOOL_DIR,
+    IS_RESPONSE_CACHE, RESPONSE_CACHE_MAX_TEMPERATURE, RESPONSE_CACHE_SEC, RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_REPLAY_CHUNK_SIZE,
+    LLM_SCHEDULER_BACKEND, LLM_SCHEDULER_LIMITS_DICT, DEFAULT_LLM_SCHEDULER_LIMITS,
+    LLM_QUEUE_TIMEOUT_SEC, LLM_SCHEDULER_POLL_SEC, LLM_SLOT_LEASE_SEC,
+    LLM_ROUTES_DICT,
+    LLM_FIRST_TOKEN_TIMEOUT_SEC, LLM_RESPONSE_TIMEOUT_SEC, LLM_RETRY_BACKOFF_BASE_SEC, LLM_RETRY_BACKOFF_MAX_SEC,
+    LLM_HEDGE_AFTER_SEC, LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SEC,
 )
 from .socket_settings import (
-    SOCKET_REQUEST_PER_SEC_LIMIT,
-    SOCKET_REXEIVE_DATA_KB_LIMIT,
+    SOCKET_REQUEST_PER_SEC_LIMIT, SOCKET_RATE_LIMITER_BACKEND,
+    SOCKET_REXEIVE_DATA_KB_LIMIT, SOCKET_RECEIVE_QUEUE_SIZE,
+    PRESENCE_TTL_SEC, PRESENCE_HEARTBEAT_SEC, IS_SAVE_SOCKET_ACCESS_LOG,
+    IS_DIRECT_DELIVERY,
+    FRAME_COMPRESS_MIN_BYTES, FRAME_COMPRESS_QUALITY,
+    STREAM_FLUSH_INTERVAL_MS, STREAM_FLUSH_MAX_BYTES, STREAM_FLUSH_ON_SENTENCE,
 )
\ No newline at end of file
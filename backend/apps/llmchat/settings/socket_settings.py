@@ -1,2 +1,31 @@
 SOCKET_REQUEST_PER_SEC_LIMIT = 10
-SOCKET_REXEIVE_DATA_KB_LIMIT = 10
\ No newline at end of file
+# メッセージ流量制限 (token bucket) のバックエンド
+# - 'redis': 複数ノードで共有 (Lua で原子的に判定)
+# - 'local': プロセス内のみ (シングルノード)
+SOCKET_RATE_LIMITER_BACKEND  = 'redis'
+SOCKET_REXEIVE_DATA_KB_LIMIT = 10
+# 接続ごとの受信キューの上限 (溢れた場合は wsClose を送る)
+SOCKET_RECEIVE_QUEUE_SIZE    = 8
+
+# Presence (Redis)
+# - 接続者を TTL 付きで管理し、heartbeat が途絶えた接続 (ワーカー停止など) は自動で除去する
+PRESENCE_TTL_SEC          = 30
+PRESENCE_HEARTBEAT_SEC    = 10
+# SocketAccess テーブルへ接続記録を保存する (監査用)
+IS_SAVE_SOCKET_ACCESS_LOG = False
+
+# 同一プロセス内の接続 (自身を含む) へは channel layer (Redis) を経由せずに直接送信する
+# - False にすると全て channel layer 経由 (ベンチマーク比較用)
+IS_DIRECT_DELIVERY = True
+
+# 送信フレーム
+# - JSON 化と圧縮は送信側で 1 度だけ行う
+# - FRAME_COMPRESS_MIN_BYTES 未満の JSON は圧縮せずテキストフレームで送信する
+FRAME_COMPRESS_MIN_BYTES = 256
+FRAME_COMPRESS_QUALITY   = 4
+
+# Streaming
+# LLM の delta をまとめて 1 フレームで送信する (いずれかの条件でフラッシュ)
+STREAM_FLUSH_INTERVAL_MS = 50   # 前回送信からの最大待ち時間(ms)
+STREAM_FLUSH_MAX_BYTES   = 256  # バッファの最大バイト数
+STREAM_FLUSH_ON_SENTENCE = True # 文末(。！？改行など)で送信
\ No newline at end of file
@@ -1,24 +1,38 @@
 """
 WebSocket で Gcloud の Speech-to-Text と Text-to-Speech を扱う
     - bytes_data => STT処理 (Speech-to-Text: セッション管理)
+        - 無音を VAD で間引き、約 STT_FRAME_MS ごとにまとめてから Gcloud に送る (SpeechFrameGate)
+        - ユーザごとの同時セッション数は接続をまたいで STT_MAX_SESSIONS_PER_USER まで (超えた発話は捨てて 429 を返す)
+        - 音声が届かない / 長すぎるセッションは定期的に閉じる (閉じた理由ごとに stt_tts.stt_session_closed を数える)
     - text_data  => JSONに "cmd: tts" があれば TTS処理 (Text-to-Speech)
+        - data.isChunked が true の場合は文ごとに合成し、音声をバイナリフレーム (encode_audio_frame) で順に送る
 """
 from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 import asyncio
+import time
 from base64 import b64encode
-import brotli
-import json
 from api.utils import jwt_auth_get_id
-from apps.utils import sync_get_user_obj
+from apps.utils import (
+    sync_get_user_obj, SocketCodec, negotiate_codec,
+    split_sentences, encode_audio_frame,
+    get_session_limiter,
+)
+from common.scripts.PythonCodeUtils import incr_counter, observe
 from google.cloud.speech_v1 import (
     SpeechAsyncClient, RecognitionConfig,
     StreamingRecognitionConfig, StreamingRecognizeRequest,
 )
-from google.cloud.texttospeech import (
-    TextToSpeechClient, SynthesisInput, VoiceSelectionParams,
-    SsmlVoiceGender, AudioConfig, AudioEncoding,
+from .settings import (
+    STT_SAMPLE_RATE_HERTZ, STT_FRAME_MS,
+    IS_STT_VAD, STT_VAD_ANALYSIS_MS, STT_VAD_ENERGY_THRESHOLD, STT_VAD_ZCR_MAX,
+    STT_VAD_PREROLL_MS, STT_VAD_HANGOVER_MS, STT_VAD_KEEPALIVE_SEC,
+    STT_SESSION_LIMITER_BACKEND, STT_MAX_SESSIONS_PER_USER,
+    STT_SESSION_MAX_SEC, STT_SESSION_IDLE_SEC, STT_SESSION_REAPER_INTERVAL_SEC,
+    STT_SESSION_QUEUE_MAX_FRAMES, STT_SESSION_QUEUE_POLICY, STT_SESSION_QUEUE_PUT_TIMEOUT_SEC,
+    TTS_SEGMENT_MAX_CHARS, TTS_MAX_CONCURRENCY,
 )
+from .utils import synthesize_speech, SpeechFrameGate
 
 
 class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
@@ -39,21 +53,40 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
             raise StopConsumer()
         # アクセス制御 △
 
-        await self.accept()
+        # 送受信のコーデック (サブプロトコル or ?codec= で指定、無ければ json)
+        # - msgpack の場合 TTS の音声は base64 にせずバイナリのまま送る
+        codec, subprotocol = negotiate_codec(self.scope)
+        self.codec = SocketCodec(codec=codec, metrics_tags={'app': 'stt_tts'})
+
+        await self.accept(subprotocol=subprotocol)
 
         # クライアント
+        # - TTS は synthesize_speech (イベントループごとに共有するクライアント + 音声キャッシュ)
         self.stt_client = SpeechAsyncClient()
-        self.tts_client = TextToSpeechClient()
+
+        # 文ごとの TTS
+        self.tts_semaphore = asyncio.Semaphore(TTS_MAX_CONCURRENCY)
+        self.tts_counter   = 0  # tts_id の連番 (音声のフレームのヘッダ)
 
         # STT セッション管理
-        # セッションIDをキーにし、 { "queue": ..., "task": ..., "sttend_flag": ..., "running": ... } を持つ
-        self.stt_sessions    = {}
-        self.session_counter = 0  # 連番付与
+        # セッションIDをキーにし、 { "queue": ..., "task": ..., "sttend_flag": ..., "running": ..., "gate": ...,
+        #                           "lease_id": ..., "created_at": ..., "last_active_at": ... } を持つ
+        self.stt_sessions       = {}
+        self.session_counter    = 0      # 連番付与
+        self.current_session_id = None   # 音声を入れるセッション (最後に作成したセッション。閉じたら None)
+        self.is_stt_rejected    = False  # 同時セッション数の上限で作成できなかった (sttend まで音声を捨てる)
+        self.stt_limiter        = get_session_limiter(namespace = 'stt_tts',
+                                                      backend   = STT_SESSION_LIMITER_BACKEND,)
+        self.stt_reaper_task    = asyncio.create_task(self._reap_stt_sessions())
 
     async def disconnect(self, close_code):
         # WebSocket切断時、すべてのセッションをキャンセル/クリーンアップ
+        reaper_task = getattr(self, 'stt_reaper_task', None)
+        if reaper_task:
+            reaper_task.cancel()
+            await asyncio.gather(reaper_task, return_exceptions=True)
         for session_id in list(self.stt_sessions.keys()):
-            await self._cleanup_session(session_id)
+            await self._cleanup_session(session_id, reason='disconnect')
         await self.close()
         raise StopConsumer()
 
@@ -82,9 +115,12 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
 
     async def _handle_receive_text(self, text_data: str):
         try:
-            data_json = json.loads(text_data)
+            data_json = self.codec.decode_text(text_data)
             if data_json['cmd'] == 'tts':
-                await self._handle_tts(data_json['data']['text'])
+                if data_json['data'].get('isChunked'):
+                    await self._handle_tts_chunked(data_json['data']['text'])
+                else:
+                    await self._handle_tts(data_json['data']['text'])
             else:
                 pass
         except Exception as e:
@@ -102,68 +138,169 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
     # Speech-to-Text
     ####################
     async def _handle_audio(self, chunk: bytes):
-        # 直前のセッションID(最大値)を探す
-        current_session_id = self._get_latest_session_id()
+        current_session_id = self.current_session_id
         if chunk == b'sttend':
-            # セッションを終了待ちにする (セッションがない場合は無視)
-            if current_session_id is not None:
-                self.stt_sessions[current_session_id]['sttend_flag'] = True
-                await self.stt_sessions[current_session_id]['queue'].put(b'sttend')
+            self.is_stt_rejected = False
+            # セッションを終了待ちにする (セッションがない / 既に終了待ちの場合は無視)
+            if current_session_id is not None and not self.stt_sessions[current_session_id]['sttend_flag']:
+                session = self.stt_sessions[current_session_id]
+                session['sttend_flag'] = True
+                # まとめている途中の音声を先に送る
+                for frame in session['gate'].flush():
+                    if not await self._put_queue(current_session_id, frame):
+                        return
+                await self._put_queue(current_session_id, b'sttend', is_control=True)
+            return
+        if self.is_stt_rejected:
+            # 上限でセッションを作成できなかった発話の音声は捨てる
             return
         # セッションがない or 既存セッションが終了待ちなら、新規セッションを開始
-        if current_session_id is None:
-            # セッションが一つもない場合
+        if current_session_id is None or self.stt_sessions[current_session_id]['sttend_flag']:
             session_id = await self._create_stt_session()
-            await self.stt_sessions[session_id]['queue'].put(chunk)
+            if session_id is None:
+                return
         else:
-            # セッションがまだ動作中かチェック
-            if self.stt_sessions[current_session_id]['sttend_flag']:
-                # セッションが終了待ち状態なので、新しくセッションを立ち上げる
-                session_id = await self._create_stt_session()
-                await self.stt_sessions[session_id]['queue'].put(chunk)
-            else:
-                # 継続中のセッション
-                await self.stt_sessions[current_session_id]['queue'].put(chunk)
+            # 継続中のセッション
+            session_id = current_session_id
+        await self._put_audio(session_id, chunk)
 
-    async def _create_stt_session(self) -> int:
+    async def _put_audio(self, session_id: int, chunk: bytes):
+        # 無音を間引き、STT_FRAME_MS ごとにまとめたチャンクだけをキューに入れる
+        session = self.stt_sessions[session_id]
+        session['last_active_at'] = time.monotonic()
+        for frame in session['gate'].feed(chunk):
+            if not await self._put_queue(session_id, frame):
+                return
+
+    async def _put_queue(self, session_id: int, item: bytes, is_control: bool = False) -> bool:
         """
-        新しい STT セッションを作成し、タスクを起動して返す
+        セッションのキュー (音声は STT_SESSION_QUEUE_MAX_FRAMES まで) に入れる (セッションが閉じていれば False)
+            - drop_oldest:  音声は一杯なら古い音声を捨てる。制御用 (is_control: b'sttend') は捨てずに予約の 1 枠に入れる
+            - backpressure: 空くまで待つ (その間は次の受信を処理しない)。STT_SESSION_QUEUE_PUT_TIMEOUT_SEC を超えたらセッションを閉じる
+                            b'sttend' も同様に待って入れる (捨てない)
+        b'sttend' はセッションの最後に 1 度だけ入れるため、キューの先頭 (捨てる対象) は常に音声
+        """
+        session = self.stt_sessions.get(session_id)
+        if not session:
+            return False
+        queue = session['queue']
+        if STT_SESSION_QUEUE_POLICY == 'backpressure':
+            try:
+                await asyncio.wait_for(queue.put(item), timeout=STT_SESSION_QUEUE_PUT_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                await self._cleanup_session(session_id, reason='queue_timeout')
+                return False
+            return True
+        if not is_control:
+            while queue.qsize() >= STT_SESSION_QUEUE_MAX_FRAMES:
+                queue.get_nowait()
+                incr_counter('stt_tts.stt_queue_dropped')
+        queue.put_nowait(item)
+        return True
+
+    async def _create_stt_session(self):
+        """
+        新しい STT セッションを作成し、タスクを起動してセッションIDを返す
+        (ユーザの同時セッション数が上限の場合はクライアントに通知して None)
         """
         session_id           = self.session_counter
         self.session_counter += 1
-        queue                = asyncio.Queue()
+        lease_id             = f'{self.channel_name}:{session_id}'
+        is_acquired          = await self.stt_limiter.try_acquire(key           = str(self.connect_user.pk),
+                                                                  lease_id      = lease_id,
+                                                                  limit         = STT_MAX_SESSIONS_PER_USER,
+                                                                  lease_ttl_sec = STT_SESSION_MAX_SEC + STT_SESSION_REAPER_INTERVAL_SEC,)
+        if not is_acquired:
+            self.is_stt_rejected = True
+            incr_counter('stt_tts.stt_session_rejected')
+            message_data = {
+                'cmd':          'error',
+                'status':       429,
+                'ok':           False,
+                'message':      'too many stt sessions',
+                'toastType':    'error',
+                'toastMessage': '同時に利用できる音声認識の数を超えています。しばらくしてから再度お試しください。',
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=False)
+            return None
+        now = time.monotonic()
         self.stt_sessions[session_id] = {
-            'queue':       queue,
-            'sttend_flag': False,   # b'sttend' を受け取ったか
-            'running':     True,    # セッションが継続中か
-            'task':        asyncio.create_task(self._run_streaming_recognize(session_id))
+            'queue':          asyncio.Queue(maxsize=STT_SESSION_QUEUE_MAX_FRAMES + 1),  # + b'sttend' の 1 枠
+            'sttend_flag':    False,   # b'sttend' を受け取ったか
+            'running':        True,    # セッションが継続中か
+            'gate':           SpeechFrameGate(sample_rate      = STT_SAMPLE_RATE_HERTZ,
+                                              frame_ms         = STT_FRAME_MS,
+                                              analysis_ms      = STT_VAD_ANALYSIS_MS,
+                                              energy_threshold = STT_VAD_ENERGY_THRESHOLD,
+                                              zcr_max          = STT_VAD_ZCR_MAX,
+                                              preroll_ms       = STT_VAD_PREROLL_MS,
+                                              hangover_ms      = STT_VAD_HANGOVER_MS,
+                                              keepalive_sec    = STT_VAD_KEEPALIVE_SEC,
+                                              is_vad           = IS_STT_VAD,),
+            'lease_id':       lease_id,
+            'created_at':     now,
+            'last_active_at': now,     # 最後に音声を受信した時刻
+            'task':           asyncio.create_task(self._run_streaming_recognize(session_id))
         }
+        self.current_session_id = session_id
         return session_id
 
-    def _get_latest_session_id(self):
-        if not self.stt_sessions:
-            return None
-        return max(self.stt_sessions.keys())
-
-    async def _cleanup_session(self, session_id: int):
-        session = self.stt_sessions.get(session_id)
+    async def _cleanup_session(self, session_id: int, reason: str):
+        """
+        セッションを閉じる (閉じた理由 reason ごとに stt_tts.stt_session_closed を数える)
+        - 先に stt_sessions から外すため、複数の経路から呼ばれても処理は 1 回だけ
+        """
+        session = self.stt_sessions.pop(session_id, None)
         if not session:
             return
         session['running'] = False
-        task               = session['task']
-        if task and not task.done():
+        if self.current_session_id == session_id:
+            self.current_session_id = None
+        incr_counter('stt_tts.stt_session_closed', tags={'reason': reason})
+        # セッションのタスク自身から呼ばれた場合はそのまま戻る (running=False でリクエストの送信も止まる)
+        task = session['task']
+        if task is not asyncio.current_task() and not task.done():
             task.cancel()
             try:
                 await task
             except asyncio.CancelledError:
                 pass
-        self.stt_sessions.pop(session_id, None)
+        await self.stt_limiter.release(str(self.connect_user.pk), session['lease_id'])
+        # 受信した / Gcloud に送った音声の秒数 (セッションごと)
+        gate = session['gate']
+        incr_counter('stt_tts.stt_received_sec',  gate.received_sec)
+        incr_counter('stt_tts.stt_forwarded_sec', gate.forwarded_sec)
+        if gate.received_samples:
+            observe('stt_tts.stt_forwarded_ratio', gate.forwarded_samples / gate.received_samples)
+
+    async def _reap_stt_sessions(self):
+        """
+        STT_SESSION_REAPER_INTERVAL_SEC ごとに、音声が STT_SESSION_IDLE_SEC 届いていない (idle) /
+        STT_SESSION_MAX_SEC を超えた (max_age) セッションを閉じる
+        (音声を入れているセッションの場合はクライアントに is_end を送る)
+        """
+        while True:
+            await asyncio.sleep(STT_SESSION_REAPER_INTERVAL_SEC)
+            try:
+                now = time.monotonic()
+                for session_id, session in list(self.stt_sessions.items()):
+                    if now - session['created_at'] >= STT_SESSION_MAX_SEC:
+                        reason = 'max_age'
+                    elif now - session['last_active_at'] >= STT_SESSION_IDLE_SEC:
+                        reason = 'idle'
+                    else:
+                        continue
+                    if session_id == self.current_session_id and not session['sttend_flag']:
+                        await self._send_stt_end()
+                    await self._cleanup_session(session_id, reason=reason)
+            except Exception as e:
+                print(e)
 
     # メイン処理
     async def _run_streaming_recognize(self, session_id: int):
         config = RecognitionConfig(
             encoding                     = RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz            = 16000,
+            sample_rate_hertz            = STT_SAMPLE_RATE_HERTZ,
             language_code                = 'ja-JP',
             profanity_filter             = True,
             enable_automatic_punctuation = True,
@@ -210,21 +347,23 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
                         # sttend受け取り済みで is_final 出たら is_end
                         is_end = True
 
-                    await self.send(text_data=json.dumps({
+                    await self.send(**self.codec.encode({
                         'transcript': transcript,
                         'is_final':   is_final,
                         'is_end':     is_end,
-                    }))
+                    }, is_send_bytes_data=False))
                     if is_end:
                         # セッションを終了
-                        await self._cleanup_session(session_id)
+                        await self._cleanup_session(session_id, reason='end')
                         return
+            # is_end の前に Gcloud のストリームが終わった
+            await self._cleanup_session(session_id, reason='stream_end')
 
         except asyncio.CancelledError:
-            await self._cleanup_session(session_id)
+            await self._cleanup_session(session_id, reason='cancelled')
         except Exception as e:
             print(e)
-            await self._cleanup_session(session_id)
+            await self._cleanup_session(session_id, reason='error')
 
     async def _watchdog_no_final(self, session_id: int, timeout=1.0):
         """
@@ -234,43 +373,23 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
         await asyncio.sleep(timeout)
         session = self.stt_sessions.get(session_id)
         if session and session['sttend_flag'] and session['running']:
-            await self.send(text_data=json.dumps({
-                'transcript': '',
-                'is_final': True,
-                'is_end': True,
-            }))
-            await self._cleanup_session(session_id)
+            await self._send_stt_end()
+            await self._cleanup_session(session_id, reason='no_final')
+
+    async def _send_stt_end(self):
+        await self.send(**self.codec.encode({
+            'transcript': '',
+            'is_final': True,
+            'is_end': True,
+        }, is_send_bytes_data=False))
 
     ####################
     # Text-to-Speech
     ####################
     async def _handle_tts(self, text: str):
         try:
-            # TextToSpeech のリクエスト定義
-            # OGG_OPUS or MP3 などに設定可能
-            input_text   = SynthesisInput(text=text)
-            # サポート音声一覧
-            # https://cloud.google.com/text-to-speech/docs/voices?hl=ja
-            #  - print(self.tts_client.list_voices(language_code = 'ja-JP'))
-            voice_params = VoiceSelectionParams(
-                name          = 'ja-JP-Neural2-B',
-                language_code = 'ja-JP',
-                ssml_gender   = SsmlVoiceGender.SSML_VOICE_GENDER_UNSPECIFIED,
-            )
-            audio_config = AudioConfig(
-                audio_encoding = AudioEncoding.OGG_OPUS,
-                speaking_rate  = 1.0, # default: 1.0
-                pitch          = 0.0, # default: 0.0
-                volume_gain_db = 0.0, # default: 0.0
-            )
-            response = self.tts_client.synthesize_speech(
-                request = {
-                    'input':        input_text,
-                    'voice':        voice_params,
-                    'audio_config': audio_config,
-                }
-            )
-            if not response.audio_content:
+            audio_bytes = await synthesize_speech(text)
+            if not audio_bytes:
                 message_data = {
                     'cmd':          'tts',
                     'ok':           False,
@@ -282,13 +401,16 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
                 }
                 await self._self_send_message(message_data, is_send_bytes_data=False)
                 return
-            # バイナリ -> Base64
-            base64_audio = b64encode(response.audio_content).decode('utf-8')
+            # バイナリ -> Base64 (msgpack はバイナリのまま)
+            if self.codec.is_binary:
+                audio_content = audio_bytes
+            else:
+                audio_content = b64encode(audio_bytes).decode('utf-8')
             message_data = {
                 'cmd':         'tts',
                 'ok':           True,
                 'status':       200,
-                'audioContent': base64_audio,
+                'audioContent': audio_content,
             }
             await self._self_send_message(message_data, is_send_bytes_data=False)
         except Exception as e:
@@ -303,39 +425,77 @@ class ThirdPartyGcloudSttTtsConsumer(AsyncWebsocketConsumer):
             }
             await self._self_send_message(message_data, is_send_bytes_data=False)
 
+    async def _handle_tts_chunked(self, text: str):
+        """
+        テキストを文ごとに区切って並列 (TTS_MAX_CONCURRENCY) に合成し、先頭の文から順に音声のバイナリフレームで送る
+        (base64 にせず、全文の合成を待たずに最初の文から再生できる)
+            1. {'cmd': 'ttsStart', 'ttsId': ..., 'segmentCount': ...} (テキストフレーム)
+            2. encode_audio_frame(ttsId, seq, is_final, 音声) を seq = 0, 1, ... の順に送る (最後の文で is_final)
+        """
+        tasks = []
+        try:
+            segments = split_sentences(text, TTS_SEGMENT_MAX_CHARS)
+            if not segments:
+                message_data = {
+                    'cmd':          'tts',
+                    'ok':           False,
+                    'status':       500,
+                    'audioContent': None,
+                    'message':      'No speech?',
+                    'toastType':    'info',
+                    'toastMessage': 'No speech?',
+                }
+                await self._self_send_message(message_data, is_send_bytes_data=False)
+                return
+            tts_id           = self.tts_counter
+            self.tts_counter = (self.tts_counter + 1) % 2**32
+            message_data = {
+                'cmd':          'ttsStart',
+                'ok':           True,
+                'status':       200,
+                'ttsId':        tts_id,
+                'segmentCount': len(segments),
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=False)
+
+            async def _synthesize_segment(segment: str) -> bytes:
+                async with self.tts_semaphore:
+                    return await synthesize_speech(segment)
+            start_time = time.perf_counter()
+            tasks      = [asyncio.ensure_future(_synthesize_segment(segment)) for segment in segments]
+            for seq, task in enumerate(tasks):
+                audio_bytes = await task
+                await self.send(bytes_data=encode_audio_frame(tts_id, seq, seq == len(tasks)-1, audio_bytes or b''))
+                if seq == 0:
+                    observe('stt_tts.tts_first_audio_sec', time.perf_counter() - start_time)
+        except Exception as e:
+            print(e)
+            message_data = {
+                'cmd':          'error',
+                'status':       500,
+                'ok':           False,
+                'message':      'error',
+                'toastType':    'error',
+                'toastMessage': 'error',
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=False)
+        finally:
+            # エラー / 切断時は残りの合成を止める
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
     ####################
     # _self_send_message
+    # - 自身への送信のみなので channel layer を経由せずに送る
     ####################
     async def _self_send_message(self,
                                  message_data,
                                  is_send_bytes_data = True,):
-        await self.channel_layer.send(
-            self.channel_name,
-            {
-                'type':    'send_bytes_data_message' if is_send_bytes_data else 'send_text_data_message',
-                'message': message_data,
-            },
-        )
-        return None
-
-    ####################
-    # send_message
-    ####################
-    async def send_text_data_message(self, event):
-        try:
-            message = event['message']
-            await self.send(text_data=json.dumps(message))
-        except Exception as e:
-            print(e)
-            pass
-        return None
-
-    async def send_bytes_data_message(self, event):
         try:
-            message = event['message']
-            await self.send(bytes_data=brotli.compress(json.dumps(message).encode('utf-8'),
-                                                       quality=4))
+            await self.send(**self.codec.encode(message_data, is_send_bytes_data=is_send_bytes_data))
         except Exception as e:
             print(e)
-            pass
         return None
\ No newline at end of file
@@ -0,0 +1,13 @@
+from .stt_settings import (
+    STT_SAMPLE_RATE_HERTZ, STT_FRAME_MS,
+    IS_STT_VAD, STT_VAD_ANALYSIS_MS, STT_VAD_ENERGY_THRESHOLD, STT_VAD_ZCR_MAX,
+    STT_VAD_PREROLL_MS, STT_VAD_HANGOVER_MS, STT_VAD_KEEPALIVE_SEC,
+    STT_SESSION_LIMITER_BACKEND, STT_MAX_SESSIONS_PER_USER,
+    STT_SESSION_MAX_SEC, STT_SESSION_IDLE_SEC, STT_SESSION_REAPER_INTERVAL_SEC,
+    STT_SESSION_QUEUE_MAX_FRAMES, STT_SESSION_QUEUE_POLICY, STT_SESSION_QUEUE_PUT_TIMEOUT_SEC,
+)
+from .tts_settings import (
+    IS_TTS_CACHE, TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES,
+    IS_TTS_CACHE_REDIS, TTS_CACHE_REDIS_SEC,
+    TTS_SEGMENT_MAX_CHARS, TTS_MAX_CONCURRENCY,
+)
\ No newline at end of file
@@ -0,0 +1,21 @@
+# STT に送る音声 (LINEAR16 / mono)
+STT_SAMPLE_RATE_HERTZ    = 16000
+STT_FRAME_MS             = 100   # 小さいチャンクをまとめて送る長さ
+# VAD (無音を Gcloud に送らない)
+# - STT_VAD_ANALYSIS_MS ごとの RMS (int16) とゼロ交差率で音声かを判定する
+IS_STT_VAD               = True
+STT_VAD_ANALYSIS_MS      = 20
+STT_VAD_ENERGY_THRESHOLD = 300   # 音声とみなす RMS
+STT_VAD_ZCR_MAX          = 0.35  # これを超えるゼロ交差率は雑音とみなす (RMS が閾値の 4 倍以上なら音声)
+STT_VAD_PREROLL_MS       = 200   # 音声の前に残す無音
+STT_VAD_HANGOVER_MS      = 500   # 音声の後に残す無音
+STT_VAD_KEEPALIVE_SEC    = 5.0   # 無音が続いた場合に 1 区間だけ送る間隔 (上流のタイムアウト対策)
+# セッション
+STT_SESSION_LIMITER_BACKEND       = 'redis'        # 'redis' (マルチノード) / 'local' (シングルノード)
+STT_MAX_SESSIONS_PER_USER         = 3              # ユーザごとの同時セッション数 (接続をまたいで数える, 0 は制限なし)
+STT_SESSION_MAX_SEC               = 290            # セッションの最長時間 (Gcloud の streaming_recognize は約 5 分まで)
+STT_SESSION_IDLE_SEC              = 15             # 音声が届かない状態がこれを超えたセッションは閉じる
+STT_SESSION_REAPER_INTERVAL_SEC   = 5              # 上 2 つを確認する間隔
+STT_SESSION_QUEUE_MAX_FRAMES      = 50             # Gcloud に送る前のキューの上限 (STT_FRAME_MS ごとのフレーム数)
+STT_SESSION_QUEUE_POLICY          = 'drop_oldest'  # キューが一杯の場合 'drop_oldest' (古いフレームを捨てる) / 'backpressure' (空くまで受信を待つ)
+STT_SESSION_QUEUE_PUT_TIMEOUT_SEC = 2.0            # backpressure: これを超えて空かない場合はセッションを閉じる
\ No newline at end of file
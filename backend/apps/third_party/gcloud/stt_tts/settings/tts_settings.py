@@ -0,0 +1,12 @@
+# TTS の音声キャッシュ
+# - キーはテキスト・音声 (VoiceSelectionParams)・AudioConfig のハッシュ。同じフレーズは Gcloud を呼ばずに返す
+IS_TTS_CACHE        = True
+TTS_CACHE_DIR       = 'tts_cache'          # ディスクキャッシュの保存先 (BASE_DIR からの相対パス)
+TTS_CACHE_MAX_BYTES = 256 * 1024 * 1024    # ディスクキャッシュの上限 (超えたら最終アクセスが古いものから削除)
+# Redis にも保存し、プロセス / サーバ間で共有する (ディスクに無い場合に参照)
+IS_TTS_CACHE_REDIS  = False
+TTS_CACHE_REDIS_SEC = 7 * 86400
+
+# 文ごとの TTS ({'cmd': 'tts', 'data': {'text': ..., 'isChunked': true}})
+TTS_SEGMENT_MAX_CHARS = 200 # 1 回で合成する最大文字数 (超える文は読点などで区切る)
+TTS_MAX_CONCURRENCY   = 3   # 1 接続で同時に合成する文の数
\ No newline at end of file
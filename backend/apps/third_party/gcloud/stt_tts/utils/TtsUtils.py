@@ -0,0 +1,73 @@
+from django.conf import settings
+import asyncio
+import os
+import weakref
+from apps.utils import TtsAudioCache
+from google.cloud.texttospeech import (
+    TextToSpeechAsyncClient, SynthesisInput, VoiceSelectionParams,
+    SsmlVoiceGender, AudioConfig, AudioEncoding,
+)
+from ..settings import (
+    IS_TTS_CACHE, TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES,
+    IS_TTS_CACHE_REDIS, TTS_CACHE_REDIS_SEC,
+)
+
+# TTS の音声キャッシュ (プロセス内で共有)
+tts_audio_cache = TtsAudioCache(namespace     = 'stt_tts.tts_cache',
+                                cache_dir     = os.path.join(settings.BASE_DIR, TTS_CACHE_DIR),
+                                max_bytes     = TTS_CACHE_MAX_BYTES,
+                                is_redis      = IS_TTS_CACHE_REDIS,
+                                redis_ttl_sec = TTS_CACHE_REDIS_SEC,
+                                is_enabled    = IS_TTS_CACHE,)
+
+# 非同期クライアント (gRPC のチャネル) はイベントループに紐づくため、ループごとに持つ
+_TTS_CLIENTS:'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, TextToSpeechAsyncClient]' = weakref.WeakKeyDictionary()
+
+
+def get_tts_client() -> TextToSpeechAsyncClient:
+    """
+    TextToSpeechAsyncClient を返す (同じイベントループ内では同じクライアントを使い回す)
+    """
+    loop   = asyncio.get_running_loop()
+    client = _TTS_CLIENTS.get(loop)
+    if client is None:
+        client = TextToSpeechAsyncClient()
+        _TTS_CLIENTS[loop] = client
+    return client
+
+async def synthesize_speech(text:str) -> bytes:
+    """
+    text を Gcloud の Text-to-Speech で合成した音声 (OGG_OPUS) を返す
+    - 合成中もイベントループを止めない
+    - 同じテキスト・音声・AudioConfig の音声は tts_audio_cache から返す (同時の同じリクエストは 1 回の合成にまとめる)
+    """
+    # TextToSpeech のリクエスト定義
+    # OGG_OPUS or MP3 などに設定可能
+    input_text   = SynthesisInput(text=text)
+    # サポート音声一覧
+    # https://cloud.google.com/text-to-speech/docs/voices?hl=ja
+    #  - print(get_tts_client().list_voices(language_code = 'ja-JP'))
+    voice_params = VoiceSelectionParams(
+        name          = 'ja-JP-Neural2-B',
+        language_code = 'ja-JP',
+        ssml_gender   = SsmlVoiceGender.SSML_VOICE_GENDER_UNSPECIFIED,
+    )
+    audio_config = AudioConfig(
+        audio_encoding = AudioEncoding.OGG_OPUS,
+        speaking_rate  = 1.0, # default: 1.0
+        pitch          = 0.0, # default: 0.0
+        volume_gain_db = 0.0, # default: 0.0
+    )
+    async def _synthesize() -> bytes:
+        response = await get_tts_client().synthesize_speech(
+            request = {
+                'input':        input_text,
+                'voice':        voice_params,
+                'audio_config': audio_config,
+            }
+        )
+        return response.audio_content
+    cache_key = tts_audio_cache.build_key(text,
+                                          voice        = VoiceSelectionParams.to_dict(voice_params),
+                                          audio_config = AudioConfig.to_dict(audio_config),)
+    return await tts_audio_cache.get_or_synthesize(cache_key, _synthesize)
\ No newline at end of file
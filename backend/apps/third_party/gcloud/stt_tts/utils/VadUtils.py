@@ -0,0 +1,149 @@
+import math
+import numpy as np
+from collections import deque
+from typing import Deque, List
+
+# 音声のサンプル (LINEAR16: little endian の int16)
+SAMPLE_DTYPE = np.dtype('<i2')
+SAMPLE_WIDTH = SAMPLE_DTYPE.itemsize
+
+
+def strip_wav_header(chunk:bytes) -> bytes:
+    """
+    WAV (RIFF) のヘッダが付いていれば取り除いて PCM だけを返す
+    (RecordRTC の StereoAudioRecorder は timeSlice ごとのチャンクにヘッダを付ける)
+    """
+    if len(chunk) < 12 or chunk[:4] != b'RIFF' or chunk[8:12] != b'WAVE':
+        return chunk
+    pos = 12
+    while pos + 8 <= len(chunk):
+        chunk_id   = chunk[pos:pos+4]
+        chunk_size = int.from_bytes(chunk[pos+4:pos+8], 'little')
+        if chunk_id == b'data':
+            return chunk[pos+8:]
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return b''
+
+
+class SpeechFrameGate:
+    """
+    STT に送る音声 (LINEAR16 / mono) の無音を VAD で間引き、frame_ms ごとのチャンクにまとめる
+        - analysis_ms ごとの RMS とゼロ交差率で音声かを判定する (受信したチャンク分をまとめて NumPy で計算)
+            - RMS が energy_threshold 以上かつゼロ交差率が zcr_max 以下 (高いものは雑音とみなす)
+            - または RMS が energy_threshold の 4 倍以上
+        - 音声の前 preroll_ms と後 hangover_ms は残し、それより長い無音は送らない
+          (無音が keepalive_sec 続いた場合は上流のタイムアウト対策に 1 区間だけ送る)
+        - 残した音声は frame_ms ごとにまとめて返す (音声の終わりでは frame_ms に満たなくても返す)
+        - is_vad=False の場合はまとめるだけ
+    統計: received_sec / forwarded_sec (受信した / 送る音声の秒数)
+    """
+
+    def __init__(self,
+                 sample_rate:int        = 16000,
+                 frame_ms:int           = 100,
+                 analysis_ms:int        = 20,
+                 energy_threshold:float = 300.0,
+                 zcr_max:float          = 0.35,
+                 preroll_ms:int         = 200,
+                 hangover_ms:int        = 500,
+                 keepalive_sec:float    = 5.0,
+                 is_vad:bool            = True,):
+        self.sample_rate      = sample_rate
+        self.analysis_samples = max(sample_rate * analysis_ms // 1000, 2)
+        self.analysis_bytes   = self.analysis_samples * SAMPLE_WIDTH
+        self.frame_bytes      = max(sample_rate * frame_ms // 1000, 1) * SAMPLE_WIDTH
+        self.energy_threshold = energy_threshold
+        self.zcr_max          = zcr_max
+        self.hangover_n       = math.ceil(hangover_ms / analysis_ms)
+        self.keepalive_n      = max(math.ceil(keepalive_sec * 1000 / analysis_ms), 1)
+        self.is_vad           = is_vad
+
+        self._remainder          = b''          # analysis_ms に満たない受信データ
+        self._out                = bytearray()  # 送る音声 (frame_bytes ごとに返す)
+        self._preroll:Deque[bytes] = deque(maxlen=math.ceil(preroll_ms / analysis_ms))
+        self._hangover_left      = 0            # 音声の後に残す区間の残り
+        self._silent_n           = 0            # 最後に送ってから続いている無音の区間数
+        self._is_flush_due       = False
+        self.received_samples    = 0
+        self.forwarded_samples   = 0
+
+    @property
+    def received_sec(self) -> float:
+        return self.received_samples / self.sample_rate
+
+    @property
+    def forwarded_sec(self) -> float:
+        return self.forwarded_samples / self.sample_rate
+
+    def _classify(self, frames:np.ndarray) -> np.ndarray:
+        """ frames: (区間数, analysis_samples) の int16。区間ごとに音声なら True """
+        x    = frames.astype(np.float32)
+        rms  = np.sqrt(np.mean(x * x, axis=1))
+        sign = np.signbit(frames)
+        zcr  = np.count_nonzero(sign[:, 1:] != sign[:, :-1], axis=1) / (frames.shape[1] - 1)
+        return ((rms >= self.energy_threshold) & (zcr <= self.zcr_max)) | (rms >= self.energy_threshold * 4)
+
+    def _forward(self, frame:bytes) -> None:
+        self._out.extend(frame)
+        self.forwarded_samples += len(frame) // SAMPLE_WIDTH
+        self._silent_n          = 0
+
+    def _push(self, frame:bytes, is_voice:bool) -> None:
+        if is_voice:
+            while self._preroll:
+                self._forward(self._preroll.popleft())
+            self._forward(frame)
+            self._hangover_left = self.hangover_n
+        elif self._hangover_left > 0:
+            self._forward(frame)
+            self._hangover_left -= 1
+            if self._hangover_left == 0:
+                # 音声の終わり: 溜めている分を待たずに送る
+                self._is_flush_due = True
+        else:
+            self._silent_n += 1
+            if self._silent_n >= self.keepalive_n:
+                self._forward(frame)
+                self._is_flush_due = True
+            else:
+                self._preroll.append(frame)
+
+    def _pop_frames(self) -> List[bytes]:
+        frames = []
+        while len(self._out) >= self.frame_bytes:
+            frames.append(bytes(self._out[:self.frame_bytes]))
+            del self._out[:self.frame_bytes]
+        if self._is_flush_due and self._out:
+            frames.append(bytes(self._out))
+            self._out.clear()
+        self._is_flush_due = False
+        return frames
+
+    def feed(self, chunk:bytes) -> List[bytes]:
+        """ 受信したチャンクを追加し、送るチャンク (frame_ms ごと) を返す """
+        data = self._remainder + strip_wav_header(chunk)
+        n    = len(data) // self.analysis_bytes
+        self._remainder = data[n * self.analysis_bytes:]
+        if n == 0:
+            return []
+        self.received_samples += n * self.analysis_samples
+        if not self.is_vad:
+            self._forward(data[:n * self.analysis_bytes])
+            return self._pop_frames()
+        frames   = np.frombuffer(data, dtype=SAMPLE_DTYPE, count=n * self.analysis_samples).reshape(n, self.analysis_samples)
+        is_voice = self._classify(frames)
+        for i in range(n):
+            self._push(data[i * self.analysis_bytes:(i + 1) * self.analysis_bytes], bool(is_voice[i]))
+        return self._pop_frames()
+
+    def flush(self) -> List[bytes]:
+        """ 発話の終了 (sttend) 時に残りを返す (音声の途中なら analysis_ms に満たない分も含める) """
+        remainder, self._remainder = self._remainder, b''
+        usable = len(remainder) - len(remainder) % SAMPLE_WIDTH
+        self.received_samples += usable // SAMPLE_WIDTH
+        if usable and (not self.is_vad or self._hangover_left > 0):
+            self._forward(remainder[:usable])
+        self._preroll.clear()
+        self._hangover_left = 0
+        self._is_flush_due  = True
+        return self._pop_frames()
\ No newline at end of file
@@ -0,0 +1,2 @@
+from .TtsUtils import tts_audio_cache, get_tts_client, synthesize_speech
+from .VadUtils import SpeechFrameGate, strip_wav_header
\ No newline at end of file
@@ -0,0 +1,125 @@
+import time
+import threading
+from django.core.cache import caches
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from common.scripts.PythonCodeUtils import incr_counter, set_gauge
+
+# 共有キャッシュの alias (config/settings/extra_settings/Caches.py)
+SHARED_CACHE_ALIAS = 'shared'
+
+
+class VersionedReadThroughCache:
+    """
+    バージョン付きのリードスルーキャッシュ
+        - L1: プロセス内 dict (l1_ttl_sec の短い TTL)
+        - L2: 共有キャッシュ (Redis)
+        - 値は dict で 'version' キー (AutoIncVersionField) を持つこと
+        - 書き込み側 (post_save 等) は set_if_newer で新しい version のみ上書きし、
+          古い読み込みが新しい値を上書きしないようにする
+        - 読み込み側は L2 にキーが無い場合のみ add する
+    ヒット率は metrics hook (common.scripts.PythonCodeUtils.MetricsUtils) に
+    '{namespace}.l1_hit' / '.l2_hit' / '.miss' と '{namespace}.hit_ratio' で通知する
+    """
+
+    def __init__(self,
+                 namespace:str,
+                 loader:Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+                 l1_ttl_sec:float = 2.0,
+                 l2_ttl_sec:int   = 600,
+                 cache_alias:str  = SHARED_CACHE_ALIAS,):
+        self.namespace   = namespace
+        self.loader      = loader
+        self.l1_ttl_sec  = l1_ttl_sec
+        self.l2_ttl_sec  = l2_ttl_sec
+        self.cache_alias = cache_alias
+
+        self._l1:Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock  = threading.Lock()
+        self._stats = {'l1_hit': 0, 'l2_hit': 0, 'miss': 0,}
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, key:str) -> str:
+        return f'{self.namespace}:{key}'
+
+    @staticmethod
+    def _version(value:Optional[Dict[str, Any]]) -> int:
+        return (value or {}).get('version') or 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = sum(self._stats.values())
+        return (self._stats['l1_hit'] + self._stats['l2_hit']) / total if total else 0.0
+
+    def _record(self, result:str) -> None:
+        with self._lock:
+            self._stats[result] += 1
+        incr_counter(f'{self.namespace}.{result}')
+        set_gauge(f'{self.namespace}.hit_ratio', self.hit_ratio)
+
+    def _set_l1(self, key:str, value:Dict[str, Any]) -> None:
+        with self._lock:
+            self._l1[key] = (time.monotonic() + self.l1_ttl_sec, value)
+
+    def _get_l1(self, key:str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._l1[key]
+                return None
+            return entry[1]
+
+    async def aget(self, key:str) -> Optional[Dict[str, Any]]:
+        """
+        L1 -> L2 -> loader の順に取得する (呼び出し側で変更できるようコピーを返す)
+        """
+        value = self._get_l1(key)
+        if value is not None:
+            self._record('l1_hit')
+            return dict(value)
+
+        try:
+            value = await self.cache.aget(self._key(key))
+        except Exception as e:
+            print(e)
+            value = None
+        if value is not None:
+            self._record('l2_hit')
+            self._set_l1(key, value)
+            return dict(value)
+
+        self._record('miss')
+        value = await self.loader(key)
+        if value is None:
+            return None
+        try:
+            # 読み込み中に書き込み側が新しい値を入れていた場合は上書きしない
+            await self.cache.aadd(self._key(key), value, self.l2_ttl_sec)
+        except Exception as e:
+            print(e)
+        self._set_l1(key, value)
+        return dict(value)
+
+    def set_if_newer(self, key:str, value:Dict[str, Any]) -> None:
+        """ 書き込み側から呼ぶ (キャッシュ済みの値より version が古い場合は無視) """
+        with self._lock:
+            self._l1.pop(key, None)
+        try:
+            current = self.cache.get(self._key(key))
+            if current is not None and self._version(current) > self._version(value):
+                return
+            self.cache.set(self._key(key), value, self.l2_ttl_sec)
+        except Exception as e:
+            print(e)
+
+    def delete(self, key:str) -> None:
+        with self._lock:
+            self._l1.pop(key, None)
+        try:
+            self.cache.delete(self._key(key))
+        except Exception as e:
+            print(e)
\ No newline at end of file
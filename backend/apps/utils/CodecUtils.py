@@ -0,0 +1,183 @@
+import brotli
+import json
+import msgpack
+import orjson
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from .FrameUtils import encode_frame
+
+# 対応コーデック
+# - json:    これまで通り (テキスト: JSON / バイナリ: JSON + brotli)。フォールバック
+# - orjson:  テキストフレーム (orjson)
+# - msgpack: バイナリフレーム (msgpack)
+# orjson / msgpack ではストリームの delta を [stream_id, text] の配列で送る
+# (最初の delta の前に {'cmd': 'StreamStart', 'sid': stream_id, 'messageId': ...} を送る)
+CODEC_JSON    = 'json'
+CODEC_ORJSON  = 'orjson'
+CODEC_MSGPACK = 'msgpack'
+CODECS        = (CODEC_JSON, CODEC_ORJSON, CODEC_MSGPACK,)
+# サブプロトコル名 -> コーデック
+SUBPROTOCOLS  = {f'chat.{codec}': codec for codec in CODECS}
+# 1 接続で同時に保持する stream_id の上限
+MAX_OPEN_STREAMS = 64
+# ping とみなすフレームの最大バイト数 (これより大きいフレームはデコードせずにキューへ回す)
+PING_MAX_BYTES   = 64
+
+
+def negotiate_codec(scope:Dict[str, Any]) -> Tuple[str, Optional[str]]:
+    """
+    接続時にコーデックを決める
+        1. サブプロトコル (Sec-WebSocket-Protocol: chat.msgpack など) の最初の対応しているもの
+        2. クエリパラメータ ?codec=msgpack
+        3. どちらも無ければ json
+    Returns: (コーデック, accept で返すサブプロトコル)
+    """
+    for subprotocol in scope.get('subprotocols') or []:
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol], subprotocol
+    query  = parse_qs((scope.get('query_string') or b'').decode('utf-8', 'ignore'))
+    codec  = (query.get('codec') or [CODEC_JSON])[0]
+    return (codec if codec in CODECS else CODEC_JSON), None
+
+
+class SocketCodec:
+    """
+    1 接続ごとのエンコード / デコード
+        - encode:            メッセージ dict をフレーム ({'text_data'} or {'bytes_data'}) にする
+        - frame_for_event:   channel layer のイベントからフレームを取り出す (同じコーデックは 1 度だけエンコード)
+        - stream_frames:     ストリームの delta をフレームにする (orjson / msgpack は compact な配列)
+        - decode_text/bytes: 受信データを dict にする
+    """
+
+    def __init__(self,
+                 codec:str               = CODEC_JSON,
+                 compress_min_bytes:int  = 256,
+                 quality:int             = 4,
+                 metrics_tags:Optional[Dict[str, str]] = None,):
+        self.codec              = codec if codec in CODECS else CODEC_JSON
+        self.compress_min_bytes = compress_min_bytes
+        self.quality            = quality
+        self.metrics_tags       = metrics_tags
+
+        self._stream_ids:Dict[str, int] = {}  # messageId -> stream_id
+        self._stream_counter            = 0
+
+    @property
+    def is_compact(self) -> bool:
+        return self.codec != CODEC_JSON
+
+    @property
+    def is_binary(self) -> bool:
+        return self.codec == CODEC_MSGPACK
+
+    # ------------------------------
+    # encode
+    def encode(self, message_data:Any, is_send_bytes_data:bool = True) -> Dict[str, Any]:
+        if self.codec == CODEC_MSGPACK:
+            return {'bytes_data': msgpack.packb(message_data, use_bin_type=True)}
+        if self.codec == CODEC_ORJSON:
+            return {'text_data': orjson.dumps(message_data).decode('utf-8')}
+        return encode_frame(message_data,
+                            is_send_bytes_data = is_send_bytes_data,
+                            compress_min_bytes = self.compress_min_bytes,
+                            quality            = self.quality,
+                            metrics_tags       = self.metrics_tags,)
+
+    def build_event(self,
+                    event_type:str,
+                    message_data:Dict[str, Any],
+                    is_send_bytes_data:bool = True,
+                    ) -> Dict[str, Any]:
+        """
+        送信用のイベントを作成する (送信者のコーデックのフレームは作成済みで渡す)
+        """
+        return {
+            'type':               event_type,
+            'cmd':                message_data.get('cmd'),
+            'message':            message_data,
+            'is_send_bytes_data': is_send_bytes_data,
+            'frames':             {self.codec: self.encode(message_data, is_send_bytes_data)},
+        }
+
+    def build_stream_event(self,
+                           message_id:str,
+                           text:str,
+                           message_data:Dict[str, Any],
+                           is_send_bytes_data:bool = True,
+                           ) -> Dict[str, Any]:
+        """
+        ストリームの delta 用のイベントを作成する
+        (message_data は json コーデック用の SendUserMessage。compact なコーデックは受信側で [stream_id, text] にする)
+        """
+        return {
+            'type':               'send_stream_delta',
+            'message_id':         message_id,
+            'text':               text,
+            'message':            message_data,
+            'is_send_bytes_data': is_send_bytes_data,
+            'frames':             {} if self.is_compact else {self.codec: self.encode(message_data, is_send_bytes_data)},
+        }
+
+    def frame_for_event(self, event:Dict[str, Any]) -> Dict[str, Any]:
+        """
+        イベントに同じコーデックのフレームがあればそのまま使い、無ければエンコードして保持する
+        (同一プロセス内の受信者は同じイベントを共有するので、コーデックごとに 1 度だけエンコードされる)
+        """
+        frames = event.setdefault('frames', {})
+        frame  = frames.get(self.codec)
+        if frame is None:
+            frame = self.encode(event['message'], event.get('is_send_bytes_data', True))
+            frames[self.codec] = frame
+        return frame
+
+    def stream_frames(self, event:Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        ストリームの delta イベント ({'message_id', 'text', 'message'}) をフレームにする
+            - json:            SendUserMessage をそのまま (コーデックごとに 1 度だけエンコード)
+            - orjson / msgpack: 初回のみ StreamStart ヘッダ + [stream_id, text]
+        """
+        if not self.is_compact:
+            return [self.frame_for_event(event)]
+        frames    = []
+        stream_id = self._stream_ids.get(event['message_id'])
+        if stream_id is None:
+            # 終了通知が届かなかったストリームが溜まらないよう古いものから捨てる
+            if len(self._stream_ids) >= MAX_OPEN_STREAMS:
+                self._stream_ids.pop(next(iter(self._stream_ids)))
+            self._stream_counter += 1
+            stream_id = self._stream_counter
+            self._stream_ids[event['message_id']] = stream_id
+            frames.append(self.encode({
+                'cmd':       'StreamStart',
+                'sid':       stream_id,
+                'messageId': event['message_id'],
+            }))
+        frames.append(self.encode([stream_id, event['text']]))
+        return frames
+
+    def end_stream(self, message_id:Optional[str]) -> None:
+        if message_id:
+            self._stream_ids.pop(message_id, None)
+
+    # ------------------------------
+    # decode
+    def is_ping(self, text_data:Optional[str] = None, bytes_data:Optional[bytes] = None) -> bool:
+        """ 受信フレームが ping か (receive でタスクを作らずに判定する) """
+        data = text_data if text_data is not None else bytes_data
+        if not data or len(data) > PING_MAX_BYTES:
+            return False
+        try:
+            data_json = self.decode_text(text_data) if text_data is not None else self.decode_bytes(bytes_data)
+        except Exception:
+            return False
+        return isinstance(data_json, dict) and data_json.get('cmd') == 'ping'
+
+    def decode_text(self, text_data:str) -> Any:
+        if self.codec == CODEC_JSON:
+            return json.loads(text_data)
+        return orjson.loads(text_data)
+
+    def decode_bytes(self, bytes_data:bytes) -> Any:
+        if self.codec == CODEC_MSGPACK:
+            return msgpack.unpackb(bytes_data, raw=False)
+        return json.loads(brotli.decompress(bytes_data).decode('utf-8'))
\ No newline at end of file
@@ -0,0 +1,79 @@
+from channels.consumer import get_handler_name
+from typing import Any, Dict, Iterable, Optional, Set
+
+# プロセス内で接続中の consumer (group_name -> {channel_name: consumer})
+_LOCAL_GROUPS:Dict[str, Dict[str, Any]] = {}
+
+
+class DirectDelivery:
+    """
+    同一プロセス内の接続へは channel layer (Redis) を経由せずに直接送信する
+        - 自身への送信と、同一プロセス内のメンバーへの送信は consumer のハンドラを直接呼ぶ
+        - 他プロセスのメンバー (remote) へは channel layer で channel_name ごとに送信する
+        - メンバーが未確定 (update_members 前) または is_enabled=False の場合は
+          これまで通り channel layer の send / group_send を使う
+    送信先ごとの順序は、直接送信は await の順、remote は channel ごとの FIFO で保たれる
+    """
+
+    def __init__(self,
+                 consumer,
+                 group_name:str,
+                 is_enabled:bool = True,):
+        self.consumer   = consumer
+        self.group_name = group_name
+        self.is_enabled = is_enabled
+        self.remote_channel_names:Optional[Set[str]] = None
+
+    @property
+    def channel_layer(self):
+        return self.consumer.channel_layer
+
+    @property
+    def is_direct(self) -> bool:
+        return self.is_enabled and self.remote_channel_names is not None
+
+    def register(self) -> None:
+        _LOCAL_GROUPS.setdefault(self.group_name, {})[self.consumer.channel_name] = self.consumer
+
+    def unregister(self) -> None:
+        local_members = _LOCAL_GROUPS.get(self.group_name)
+        if local_members is not None:
+            local_members.pop(self.consumer.channel_name, None)
+            if not local_members:
+                _LOCAL_GROUPS.pop(self.group_name, None)
+        self.remote_channel_names = None
+
+    def update_members(self, channel_names:Iterable[str]) -> None:
+        """ presence に登録されている channel_name 一覧から remote のメンバーを確定する """
+        local_channel_names       = set(_LOCAL_GROUPS.get(self.group_name, {}))
+        self.remote_channel_names = set(channel_names) - local_channel_names
+
+    @staticmethod
+    async def _dispatch(consumer, event:Dict[str, Any]) -> None:
+        try:
+            await getattr(consumer, get_handler_name(event))(event)
+        except Exception as e:
+            print(e)
+
+    async def send(self, channel_name:str, event:Dict[str, Any]) -> None:
+        if self.is_direct:
+            consumer = _LOCAL_GROUPS.get(self.group_name, {}).get(channel_name)
+            if consumer is not None:
+                return await self._dispatch(consumer, event)
+        await self.channel_layer.send(channel_name, event)
+
+    async def self_send(self, event:Dict[str, Any]) -> None:
+        if self.is_direct:
+            return await self._dispatch(self.consumer, event)
+        await self.channel_layer.send(self.consumer.channel_name, event)
+
+    async def group_send(self, event:Dict[str, Any]) -> None:
+        if not self.is_direct:
+            return await self.channel_layer.group_send(self.group_name, event)
+        for consumer in list(_LOCAL_GROUPS.get(self.group_name, {}).values()):
+            await self._dispatch(consumer, event)
+        for channel_name in list(self.remote_channel_names):
+            try:
+                await self.channel_layer.send(channel_name, event)
+            except Exception as e:
+                print(e)
\ No newline at end of file
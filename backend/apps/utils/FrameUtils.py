@@ -0,0 +1,71 @@
+import brotli
+import json
+import struct
+import time
+from typing import Any, Dict, Optional, Tuple
+from common.scripts.PythonCodeUtils import incr_counter
+
+# 音声のバイナリフレーム (TTS を文ごとに送る)
+# - ヘッダ: magic(4) | tts_id(uint32) | seq(uint32) | flags(uint8, bit0: 最後のフレーム) の 13 バイト (big endian)
+# - ヘッダの後ろは 1 文分の音声 (単体で再生できる)
+# magic は JSON + brotli / msgpack のフレームと区別するため
+AUDIO_FRAME_MAGIC  = b'TTS\x01'
+AUDIO_FRAME_HEADER = struct.Struct('>4sIIB')
+AUDIO_FRAME_FINAL  = 0x01
+
+
+def encode_frame(message_data:Dict[str, Any],
+                 is_send_bytes_data:bool = True,
+                 compress_min_bytes:int  = 256,
+                 quality:int             = 4,
+                 metrics_tags:Optional[Dict[str, str]] = None,
+                 ) -> Dict[str, Any]:
+    """
+    送信するメッセージを 1 度だけ JSON 化 (+ brotli 圧縮) し、
+    AsyncWebsocketConsumer.send にそのまま渡せる {'text_data': str} か {'bytes_data': bytes} を返す。
+
+    圧縮は以下の場合は行わずテキストフレームで送る
+    (同じ接続にテキスト / バイナリのフレームが混ざるため、フロントエンドは Blob の復号を待って到着順に処理する)
+        - is_send_bytes_data=False
+        - JSON のバイト数が compress_min_bytes 未満 (小さい delta は brotli のオーバーヘッドの方が大きい)
+        - 圧縮後の方が大きい
+
+    メトリクス (socket_frame.*)
+        - compressed / skipped:            圧縮した / しなかったフレーム数
+        - raw_bytes / compressed_bytes:    圧縮したフレームの圧縮前後のバイト数
+        - bytes_saved:                     圧縮で削減したバイト数
+        - compress_cpu_sec:                圧縮に掛かった時間(秒)
+    """
+    text_data = json.dumps(message_data)
+    if not is_send_bytes_data:
+        return {'text_data': text_data}
+
+    raw_data = text_data.encode('utf-8')
+    if len(raw_data) < compress_min_bytes:
+        incr_counter('socket_frame.skipped', tags=metrics_tags)
+        return {'text_data': text_data}
+
+    start_time = time.perf_counter()
+    bytes_data = brotli.compress(raw_data, quality=quality)
+    incr_counter('socket_frame.compress_cpu_sec', time.perf_counter()-start_time, tags=metrics_tags)
+    if len(bytes_data) >= len(raw_data):
+        incr_counter('socket_frame.skipped', tags=metrics_tags)
+        return {'text_data': text_data}
+
+    incr_counter('socket_frame.compressed',       tags=metrics_tags)
+    incr_counter('socket_frame.raw_bytes',        len(raw_data),                 tags=metrics_tags)
+    incr_counter('socket_frame.compressed_bytes', len(bytes_data),               tags=metrics_tags)
+    incr_counter('socket_frame.bytes_saved',      len(raw_data)-len(bytes_data), tags=metrics_tags)
+    return {'bytes_data': bytes_data}
+
+def encode_audio_frame(tts_id:int, seq:int, is_final:bool, audio:bytes) -> bytes:
+    """ 音声のバイナリフレームを作る (AsyncWebsocketConsumer.send(bytes_data=...) に渡す) """
+    flags = AUDIO_FRAME_FINAL if is_final else 0
+    return AUDIO_FRAME_HEADER.pack(AUDIO_FRAME_MAGIC, tts_id, seq, flags) + audio
+
+def decode_audio_frame(frame:bytes) -> Optional[Tuple[int, int, bool, bytes]]:
+    """ (tts_id, seq, is_final, audio) を返す (音声のフレームでなければ None) """
+    if len(frame) < AUDIO_FRAME_HEADER.size or not frame.startswith(AUDIO_FRAME_MAGIC):
+        return None
+    _, tts_id, seq, flags = AUDIO_FRAME_HEADER.unpack_from(frame)
+    return tts_id, seq, bool(flags & AUDIO_FRAME_FINAL), frame[AUDIO_FRAME_HEADER.size:]
\ No newline at end of file
@@ -0,0 +1,111 @@
+import json
+from typing import Any, Dict, List, Optional
+from .RedisUtils import get_async_redis_client, get_redis_client
+
+# ターンの追加 (Redis)
+# - KEYS[1]: ターンの list, KEYS[2]: 準備完了フラグ, KEYS[3]: dirty フラグ
+# - ARGV[1]: ターン json, ARGV[2]: 最大ターン数, ARGV[3]: ttl(秒), ARGV[4]: dirty フラグの ttl(秒)
+# - 未構築 (フラグ無し) のバッファには追加せず、構築中の読み込みが古くならないよう dirty を立てる
+APPEND_HISTORY_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('SET', KEYS[3], 1, 'EX', tonumber(ARGV[4]))
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], -tonumber(ARGV[2]), -1)
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+redis.call('EXPIRE', KEYS[2], tonumber(ARGV[3]))
+return 1
+"""
+
+# バッファの構築 (Redis)
+# - ARGV[1]: ttl(秒), ARGV[2...]: ターン json (古い順)
+# - DB 読み込み中に追加・無効化があった場合 (dirty) は構築しない
+FILL_HISTORY_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+if #ARGV > 1 then
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[1]))
+end
+redis.call('SET', KEYS[2], 1, 'EX', tonumber(ARGV[1]))
+return 1
+"""
+
+
+class RoomHistoryBuffer:
+    """
+    ルームごとの直近の会話 (ターン) を Redis の list に保持するリングバッファ
+        - ターンは {'message_id', 'user_message', 'llm_response', 'tokens'} の dict
+        - 最大 max_turns 件を古い順に保持する
+        - 準備完了フラグが無い場合は未構築として None を返すので、DB から読み込んで fill する
+        - メッセージの変更・削除時は invalidate する
+    """
+
+    def __init__(self,
+                 namespace:str,
+                 max_turns:int,
+                 ttl_sec:int       = 3600,
+                 dirty_ttl_sec:int = 10,):
+        self.namespace     = namespace
+        self.max_turns     = max_turns
+        self.ttl_sec       = ttl_sec
+        self.dirty_ttl_sec = dirty_ttl_sec
+
+    def _keys(self, room_id:str) -> List[str]:
+        return [f'history:{self.namespace}:{room_id}:turns',
+                f'history:{self.namespace}:{room_id}:ready',
+                f'history:{self.namespace}:{room_id}:dirty',]
+
+    async def aget(self, room_id:str, n:int) -> Optional[List[Dict[str, Any]]]:
+        """
+        直近 n ターンを古い順に返す (未構築、または n が max_turns を超える場合は None)
+        """
+        if n <= 0:
+            return []
+        if n > self.max_turns:
+            return None
+        turns_key, ready_key, _ = self._keys(room_id)
+        redis_client = get_async_redis_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.exists(ready_key)
+            pipe.lrange(turns_key, -n, -1)
+            is_ready, turns = await pipe.execute()
+        if not is_ready:
+            return None
+        return [json.loads(turn) for turn in turns]
+
+    async def afill(self, room_id:str, turns:List[Dict[str, Any]]) -> bool:
+        """ DB から読み込んだ直近のターン (古い順) でバッファを構築する """
+        redis_client = get_async_redis_client()
+        result = await redis_client.eval(FILL_HISTORY_LUA, 3, *self._keys(room_id),
+                                         self.ttl_sec,
+                                         *[json.dumps(turn, ensure_ascii=False) for turn in turns[-self.max_turns:]])
+        return bool(result)
+
+    async def aappend(self, room_id:str, turn:Dict[str, Any]) -> bool:
+        """ ターンを追加する """
+        redis_client = get_async_redis_client()
+        result = await redis_client.eval(APPEND_HISTORY_LUA, 3, *self._keys(room_id),
+                                         json.dumps(turn, ensure_ascii=False), self.max_turns,
+                                         self.ttl_sec, self.dirty_ttl_sec)
+        return bool(result)
+
+    def append(self, room_id:str, turn:Dict[str, Any]) -> bool:
+        """ ターンを追加する (同期処理用) """
+        redis_client = get_redis_client()
+        result = redis_client.eval(APPEND_HISTORY_LUA, 3, *self._keys(room_id),
+                                   json.dumps(turn, ensure_ascii=False), self.max_turns,
+                                   self.ttl_sec, self.dirty_ttl_sec)
+        return bool(result)
+
+    def invalidate(self, room_id:str) -> None:
+        """ バッファを破棄する (同期処理用) """
+        turns_key, ready_key, dirty_key = self._keys(room_id)
+        redis_client = get_redis_client()
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(turns_key, ready_key)
+            pipe.set(dirty_key, 1, ex=self.dirty_ttl_sec)
+            pipe.execute()
\ No newline at end of file
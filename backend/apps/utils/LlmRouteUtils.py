@@ -0,0 +1,81 @@
+from django.conf import settings
+from typing import Dict, List, Optional, Tuple
+from common.scripts.LlmUtils.llms import (
+    OpenAILlm, AzureLlm, GcloudLlm,
+    LlmRoute, LlmRouter, get_circuit_breaker,
+)
+
+_ROUTERS:Dict[Tuple, LlmRouter] = {}
+
+
+def _create_llm(provider:str):
+    # クライアント (接続プール) は ClientPool でプロセス内で使い回される
+    if provider == 'openai':
+        return OpenAILlm(api_key = settings.OPENAI_API_KEY,)
+    elif provider == 'azure':
+        return AzureLlm(api_key     = settings.AZURE_OPENAI_API_KEY,
+                        endpoint    = settings.AZURE_OPENAI_ENDPOINT,
+                        api_version = settings.AZURE_OPENAI_API_VERSION,)
+    elif provider == 'gcloud':
+        return GcloudLlm(project_name  = settings.GCLOUD_PROJECT_NAME,
+                         location_name = settings.GCLOUD_LOCATION_NAME,)
+    raise ValueError(f'unknown llm provider: {provider}')
+
+def get_llm_router(model_name:str,
+                   primary_provider:str,
+                   route_dict:Optional[Dict[str, List[Tuple[str, str]]]] = None,
+                   retry_limit_n:int                                     = 2,
+                   first_token_timeout_sec:float                         = 20,
+                   response_timeout_sec:float                            = 60,
+                   backoff_base_sec:float                                = 0.2,
+                   backoff_max_sec:float                                 = 2.0,
+                   hedge_after_sec:Optional[float]                       = None,
+                   circuit_failure_threshold:int                         = 5,
+                   circuit_reset_sec:float                               = 30,
+                   ) -> LlmRouter:
+    """
+    モデルの候補 (プロバイダ) を切り替えて呼び出す LlmRouter をプロセス内で共有して返す。
+
+    Args:
+        model_name (str): 要求されたモデル名 (MODEL_NAME_CHOICES の名前)。
+        primary_provider (str): route_dict が無い場合に使うプロバイダ ('openai' / 'azure' / 'gcloud')。
+        route_dict (dict): {'routes': [(provider, model_name), ...], 'fallbacks': [(provider, model_name), ...]}。
+            routes は同じモデルの候補 (azure の model_name はデプロイ名)、fallbacks は別のモデルの候補。
+        circuit_failure_threshold / circuit_reset_sec: プロバイダごとの CircuitBreaker
+            (アプリをまたいで共有し、最初の呼び出しの値で作る。異なる値の場合は get_circuit_breaker が警告を出す)。
+        それ以外は LlmRouter の引数 (LlmRouter は候補とこれらの値の組み合わせごとに共有する)。
+
+    Returns:
+        LlmRouter: 認証情報が設定されていないプロバイダを除いた候補の LlmRouter。
+    """
+    route_dict  = route_dict or {'routes': [(primary_provider, model_name)]}
+    route_specs = [(provider, name, False) for provider, name in route_dict.get('routes', [])] \
+                + [(provider, name, True) for provider, name in route_dict.get('fallbacks', [])]
+    cache_key   = (model_name, tuple(route_specs),
+                   retry_limit_n, first_token_timeout_sec, response_timeout_sec,
+                   backoff_base_sec, backoff_max_sec, hedge_after_sec,)
+    router      = _ROUTERS.get(cache_key)
+    if router is not None:
+        # CircuitBreaker の値が異なる場合の警告 (get_circuit_breaker)
+        for route in router.routes:
+            get_circuit_breaker(route.provider, circuit_failure_threshold, circuit_reset_sec)
+    else:
+        routes = []
+        for provider, name, is_fallback_model in route_specs:
+            try:
+                llm = _create_llm(provider)
+            except Exception as e:
+                # 認証情報が設定されていない
+                print(e)
+                continue
+            get_circuit_breaker(provider, circuit_failure_threshold, circuit_reset_sec)
+            routes.append(LlmRoute(provider, llm, name, is_fallback_model=is_fallback_model))
+        router = LlmRouter(routes,
+                           retry_limit_n           = retry_limit_n,
+                           first_token_timeout_sec = first_token_timeout_sec,
+                           response_timeout_sec    = response_timeout_sec,
+                           backoff_base_sec        = backoff_base_sec,
+                           backoff_max_sec         = backoff_max_sec,
+                           hedge_after_sec         = hedge_after_sec,)
+        _ROUTERS[cache_key] = router
+    return router
\ No newline at end of file
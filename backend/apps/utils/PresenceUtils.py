@@ -0,0 +1,136 @@
+import json
+from typing import Dict, List, Optional, Tuple
+from .RedisUtils import get_async_redis_client
+
+# 期限切れメンバーの除去 (Redis)
+# - KEYS[1]: メンバー情報の hash (access_id -> json), KEYS[2]: 生存期限の zset (access_id -> 期限 unix time)
+# - 除去した access_id と json を [id1, info1, id2, info2, ...] で返す
+PRUNE_PRESENCE_LUA = """
+local t     = redis.call('TIME')
+local now   = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+local removed = {}
+for _, access_id in ipairs(stale) do
+    if redis.call('ZREM', KEYS[2], access_id) == 1 then
+        local info = redis.call('HGET', KEYS[1], access_id)
+        redis.call('HDEL', KEYS[1], access_id)
+        table.insert(removed, access_id)
+        table.insert(removed, info or '{}')
+    end
+end
+return removed
+"""
+
+# 生存期限の更新 (Redis)
+# - ARGV[1]: access_id, ARGV[2]: ttl(秒), ARGV[3]: メンバー情報 json (空文字なら hash は更新しない)
+# - 既に除去されたメンバーの heartbeat では復活させない (0 を返す)
+TOUCH_PRESENCE_LUA = """
+local t   = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local ttl = tonumber(ARGV[2])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+elseif redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], now + ttl, ARGV[1])
+redis.call('EXPIRE', KEYS[1], ttl * 2)
+redis.call('EXPIRE', KEYS[2], ttl * 2)
+return 1
+"""
+
+
+class RoomPresence:
+    """
+    ルームごとの接続メンバーを Redis で管理する
+        - join / leave / heartbeat で生存期限 (ttl_sec) を更新する
+        - heartbeat が途絶えたメンバー (ワーカー停止など) は次の join / heartbeat 時に除去して返す
+        - 公開用のメンバー情報には channel_name を含めない
+    """
+
+    def __init__(self,
+                 namespace:str,
+                 ttl_sec:int = 30,):
+        self.namespace = namespace
+        self.ttl_sec   = ttl_sec
+
+    def _keys(self, room_id:str) -> Tuple[str, str]:
+        return (f'presence:{self.namespace}:{room_id}:members',
+                f'presence:{self.namespace}:{room_id}:alive',)
+
+    @staticmethod
+    def _public_info(info:Dict[str, str]) -> Dict[str, str]:
+        return {
+            'access_id': info.get('access_id'),
+            'user_name': info.get('user_name'),
+        }
+
+    async def _prune(self, room_id:str) -> List[Dict[str, str]]:
+        redis_client = get_async_redis_client()
+        removed = await redis_client.eval(PRUNE_PRESENCE_LUA, 2, *self._keys(room_id))
+        return [self._public_info(json.loads(removed[i+1]) or {'access_id': removed[i]})
+                for i in range(0, len(removed), 2)]
+
+    async def join(self,
+                   room_id:str,
+                   access_id:str,
+                   user_name:str,
+                   channel_name:str,
+                   joined_at:float,
+                   ) -> List[Dict[str, str]]:
+        """
+        メンバーを登録し、除去した期限切れメンバーのリストを返す
+        """
+        info = {
+            'access_id':    access_id,
+            'user_name':    user_name,
+            'channel_name': channel_name,
+            'joined_at':    joined_at,
+        }
+        redis_client = get_async_redis_client()
+        await redis_client.eval(TOUCH_PRESENCE_LUA, 2, *self._keys(room_id),
+                                access_id, self.ttl_sec, json.dumps(info))
+        return await self._prune(room_id)
+
+    async def heartbeat(self,
+                        room_id:str,
+                        access_id:str,
+                        ) -> Tuple[bool, List[Dict[str, str]]]:
+        """
+        生存期限を延長する
+        Returns: (自身がまだ登録されているか, 除去した期限切れメンバーのリスト)
+        """
+        redis_client = get_async_redis_client()
+        is_alive = await redis_client.eval(TOUCH_PRESENCE_LUA, 2, *self._keys(room_id),
+                                           access_id, self.ttl_sec, '')
+        return bool(is_alive), await self._prune(room_id)
+
+    async def leave(self, room_id:str, access_id:str) -> bool:
+        """ メンバーを削除する (削除できた場合 True) """
+        members_key, alive_key = self._keys(room_id)
+        redis_client = get_async_redis_client()
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.zrem(alive_key, access_id)
+            pipe.hdel(members_key, access_id)
+            removed, _ = await pipe.execute()
+        return bool(removed)
+
+    async def members(self, room_id:str) -> List[Dict[str, str]]:
+        """ 接続順のメンバー一覧 (公開用) """
+        members_key, _ = self._keys(room_id)
+        redis_client = get_async_redis_client()
+        infos = [json.loads(v) for v in (await redis_client.hgetall(members_key)).values()]
+        infos.sort(key=lambda info: info.get('joined_at', 0))
+        return [self._public_info(info) for info in infos]
+
+    async def get_channel_name(self, room_id:str, access_id:str) -> Optional[str]:
+        members_key, _ = self._keys(room_id)
+        redis_client = get_async_redis_client()
+        info = await redis_client.hget(members_key, access_id)
+        return json.loads(info).get('channel_name') if info else None
+
+    async def channel_names(self, room_id:str) -> List[str]:
+        """ 登録中メンバーの channel_name 一覧 (DirectDelivery 用) """
+        members_key, _ = self._keys(room_id)
+        redis_client = get_async_redis_client()
+        return [json.loads(v).get('channel_name') for v in await redis_client.hvals(members_key)]
\ No newline at end of file
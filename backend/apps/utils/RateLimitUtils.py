@@ -0,0 +1,129 @@
+import time
+from typing import Dict, Optional, Tuple
+from .RedisUtils import get_async_redis_client
+
+# Token bucket (Redis)
+# - KEYS[1]: バケットのキー
+# - ARGV[1]: 1秒あたりの補充トークン数, ARGV[2]: バケット容量, ARGV[3]: キーの有効期間(ms)
+# - 時刻は Redis の TIME を使い、ノード間の時計ずれの影響を受けないようにする
+TOKEN_BUCKET_LUA = """
+local rate     = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local ttl_ms   = tonumber(ARGV[3])
+local t        = redis.call('TIME')
+local now      = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data     = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens   = tonumber(data[1])
+local ts       = tonumber(data[2])
+if tokens == nil or ts == nil then
+    tokens = capacity
+    ts     = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens  = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ttl_ms)
+return allowed
+"""
+
+
+class LocalTokenBucketLimiter:
+    """
+    プロセス内で完結する token bucket (シングルノード用)
+    """
+
+    def __init__(self,
+                 rate_per_sec:float,
+                 capacity:Optional[float] = None,):
+        self.rate_per_sec = float(rate_per_sec)
+        self.capacity     = float(capacity if capacity is not None else rate_per_sec)
+        self._buckets:Dict[str, Tuple[float, float]] = {} # key: (tokens, last_ts)
+
+    async def allow(self, key:str) -> bool:
+        if self.rate_per_sec <= 0:
+            return True
+        now          = time.monotonic()
+        tokens, last = self._buckets.get(key, (self.capacity, now))
+        tokens       = min(self.capacity, tokens + (now - last) * self.rate_per_sec)
+        is_allowed   = tokens >= 1
+        if is_allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return is_allowed
+
+    async def discard(self, key:str) -> None:
+        self._buckets.pop(key, None)
+
+
+class RedisTokenBucketLimiter:
+    """
+    Redis の Lua スクリプトで原子的に判定する token bucket (マルチノード用)
+    - Redis に接続できない場合は LocalTokenBucketLimiter で判定する
+    """
+
+    def __init__(self,
+                 rate_per_sec:float,
+                 capacity:Optional[float] = None,
+                 key_prefix:str           = 'ratelimit',):
+        self.rate_per_sec = float(rate_per_sec)
+        self.capacity     = float(capacity if capacity is not None else rate_per_sec)
+        self.key_prefix   = key_prefix
+        # バケットが満タンに戻るまでの時間 + 1秒でキーを失効させる
+        self.ttl_ms       = int((self.capacity / self.rate_per_sec + 1) * 1000) if self.rate_per_sec > 0 else 1000
+        self._fallback    = LocalTokenBucketLimiter(rate_per_sec, capacity)
+
+    def _key(self, key:str) -> str:
+        return f'{self.key_prefix}:{key}'
+
+    async def allow(self, key:str) -> bool:
+        if self.rate_per_sec <= 0:
+            return True
+        try:
+            redis_client = get_async_redis_client()
+            result = await redis_client.eval(TOKEN_BUCKET_LUA, 1, self._key(key),
+                                             self.rate_per_sec, self.capacity, self.ttl_ms)
+            return int(result) == 1
+        except Exception as e:
+            print(e)
+            return await self._fallback.allow(key)
+
+    async def discard(self, key:str) -> None:
+        await self._fallback.discard(key)
+        try:
+            redis_client = get_async_redis_client()
+            await redis_client.delete(self._key(key))
+        except Exception as e:
+            print(e)
+
+
+_LIMITERS:Dict[Tuple[str, str, float], object] = {}
+
+def get_socket_rate_limiter(namespace:str,
+                            rate_per_sec:float,
+                            backend:str = 'redis',):
+    """
+    WebSocket のメッセージ用 rate limiter をプロセス内で共有して返す。
+
+    Args:
+        namespace (str): キーの名前空間 (アプリ名など)。
+        rate_per_sec (float): 1秒あたりの許可数 (バケット容量も同じ値)。
+        backend (str): 'redis' (マルチノード) / 'local' (シングルノード)。
+
+    Returns:
+        RedisTokenBucketLimiter | LocalTokenBucketLimiter: allow(key) / discard(key) を持つ limiter。
+    """
+    cache_key = (namespace, backend, float(rate_per_sec))
+    limiter   = _LIMITERS.get(cache_key)
+    if limiter is None:
+        if backend == 'redis':
+            limiter = RedisTokenBucketLimiter(rate_per_sec, key_prefix=f'ratelimit:{namespace}')
+        elif backend == 'local':
+            limiter = LocalTokenBucketLimiter(rate_per_sec)
+        else:
+            raise ValueError(f'unknown rate limiter backend: {backend}')
+        _LIMITERS[cache_key] = limiter
+    return limiter
\ No newline at end of file
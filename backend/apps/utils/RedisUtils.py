@@ -0,0 +1,52 @@
+from django.conf import settings
+import asyncio
+import redis
+import redis.asyncio as aioredis
+import threading
+import weakref
+from typing import Dict, Optional
+
+# redis.asyncio のコネクションプールはイベントループに紐づくため、ループごとにクライアントを持つ
+# - decode_responses ごとに別のクライアント
+_ASYNC_REDIS_CLIENTS:'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[bool, aioredis.Redis]]' = weakref.WeakKeyDictionary()
+
+
+def get_async_redis_client(decode_responses:bool = True) -> aioredis.Redis:
+    """
+    settings.REDIS_HOST / REDIS_PORT に接続する redis.asyncio クライアントを返す。
+    同じイベントループ内では同じクライアント (コネクションプール) を使い回す。
+
+    Args:
+        decode_responses (bool): False の場合は bytes のまま返すクライアント (音声などのバイナリ用)。
+
+    Returns:
+        aioredis.Redis: 実行中のイベントループ用のクライアント。
+    """
+    loop    = asyncio.get_running_loop()
+    clients = _ASYNC_REDIS_CLIENTS.get(loop)
+    if clients is None:
+        clients = _ASYNC_REDIS_CLIENTS[loop] = {}
+    client = clients.get(decode_responses)
+    if client is None:
+        client = aioredis.Redis(host             = settings.REDIS_HOST,
+                                port             = settings.REDIS_PORT,
+                                decode_responses = decode_responses,)
+        clients[decode_responses] = client
+    return client
+
+_REDIS_CLIENT:Optional[redis.Redis] = None
+_REDIS_CLIENT_LOCK                  = threading.Lock()
+
+def get_redis_client() -> redis.Redis:
+    """
+    同期処理 (database_sync_to_async 内や REST API) 用の redis クライアントを返す。
+    プロセス内で 1 つのクライアント (スレッドセーフなコネクションプール) を使い回す。
+    """
+    global _REDIS_CLIENT
+    if _REDIS_CLIENT is None:
+        with _REDIS_CLIENT_LOCK:
+            if _REDIS_CLIENT is None:
+                _REDIS_CLIENT = redis.Redis(host             = settings.REDIS_HOST,
+                                            port             = settings.REDIS_PORT,
+                                            decode_responses = True,)
+    return _REDIS_CLIENT
\ No newline at end of file
@@ -0,0 +1,123 @@
+import hashlib
+import json
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional
+from common.scripts.PythonCodeUtils import incr_counter
+from .RedisUtils import get_async_redis_client
+
+# 取得 (Redis)
+# - KEYS[1]: 回答, KEYS[2]: LRU 用の zset (hash -> 最終アクセス unix time)
+# - ARGV[1]: hash, ARGV[2]: ttl(秒)
+# - ヒットした場合は最終アクセス時刻と TTL を更新する
+GET_RESPONSE_LUA = """
+local response = redis.call('GET', KEYS[1])
+if response then
+    local t = redis.call('TIME')
+    redis.call('ZADD', KEYS[2], tonumber(t[1]), ARGV[1])
+    redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+    redis.call('EXPIRE', KEYS[2], tonumber(ARGV[2]))
+end
+return response
+"""
+
+# 保存 (Redis)
+# - ARGV[1]: hash, ARGV[2]: 回答, ARGV[3]: ttl(秒), ARGV[4]: 最大件数, ARGV[5]: 回答のキーの prefix
+# - TTL 切れの hash を zset から除き、最大件数を超えた分は最終アクセスが古いものから削除する (LRU)
+SET_RESPONSE_LUA = """
+local t   = redis.call('TIME')
+local now = tonumber(t[1])
+local ttl = tonumber(ARGV[3])
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ttl)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl)
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+redis.call('EXPIRE', KEYS[2], ttl)
+local over = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if over > 0 then
+    local evicted = redis.call('ZPOPMIN', KEYS[2], over)
+    for i = 1, #evicted, 2 do
+        redis.call('DEL', ARGV[5] .. evicted[i])
+    end
+    return over
+end
+return 0
+"""
+
+
+class LlmResponseCache:
+    """
+    決定的な生成パラメータ (temperature <= max_temperature) の LLM の回答を Redis にキャッシュする (opt-in)
+        - キーは create_messages の messages と生成パラメータ (model_name 含む) の正規化 JSON の sha256
+        - TTL (ttl_sec) と件数上限 (max_entries, 最終アクセスが古いものから削除) を持つ
+        - record_stream は最後まで読み切ったストリームだけを保存する (StopGeneration / エラー時は保存しない)
+    メトリクス ({namespace}.hit / .miss / .evicted)
+    """
+
+    def __init__(self,
+                 namespace:str,
+                 ttl_sec:int           = 86400,
+                 max_entries:int       = 10000,
+                 max_temperature:float = 0.0,
+                 is_enabled:bool       = False,):
+        self.namespace       = namespace
+        self.ttl_sec         = ttl_sec
+        self.max_entries     = max_entries
+        self.max_temperature = max_temperature
+        self.is_enabled      = is_enabled
+
+    def _keys(self, cache_key:str) -> List[str]:
+        return [f'llm_cache:{self.namespace}:response:{cache_key}',
+                f'llm_cache:{self.namespace}:lru',]
+
+    def build_key(self,
+                  messages:List[Dict[str, str]],
+                  generation_params:Dict[str, Any],
+                  ) -> Optional[str]:
+        """ キャッシュの対象外 (無効、または temperature が max_temperature を超える) の場合は None """
+        if not self.is_enabled or generation_params.get('temperature') is None:
+            return None
+        if generation_params['temperature'] > self.max_temperature:
+            return None
+        canonical = json.dumps({'messages': messages, 'params': generation_params},
+                               sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    async def aget(self, cache_key:str) -> Optional[str]:
+        try:
+            redis_client = get_async_redis_client()
+            response = await redis_client.eval(GET_RESPONSE_LUA, 2, *self._keys(cache_key),
+                                               cache_key, self.ttl_sec)
+        except Exception as e:
+            print(e)
+            response = None
+        incr_counter(f'{self.namespace}.hit' if response is not None else f'{self.namespace}.miss')
+        return response
+
+    async def aset(self, cache_key:str, response:str) -> None:
+        if not response:
+            return
+        try:
+            redis_client = get_async_redis_client()
+            evicted = await redis_client.eval(SET_RESPONSE_LUA, 2, *self._keys(cache_key),
+                                              cache_key, response, self.ttl_sec, self.max_entries,
+                                              f'llm_cache:{self.namespace}:response:')
+        except Exception as e:
+            print(e)
+            return
+        if evicted:
+            incr_counter(f'{self.namespace}.evicted', evicted)
+
+    async def record_stream(self,
+                            cache_key:str,
+                            stream:AsyncIterator[str],
+                            ) -> AsyncGenerator[str, None]:
+        """ stream の delta をそのまま yield し、最後まで読み切った場合のみ全文を保存する """
+        chunks = []
+        source = stream.__aiter__()
+        try:
+            async for delta in source:
+                chunks.append(delta)
+                yield delta
+        finally:
+            aclose = getattr(source, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+        await self.aset(cache_key, ''.join(chunks))
\ No newline at end of file
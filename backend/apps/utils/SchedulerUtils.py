@@ -0,0 +1,463 @@
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from common.scripts.PythonCodeUtils import incr_counter, observe, set_gauge
+from .RedisUtils import get_async_redis_client
+
+# TPM のバケットのキーの有効期間 (満タンに戻るまでの 60秒 + 余裕)
+TPM_BUCKET_TTL_MS = 120000
+
+# スロットの確保 (Redis)
+# - KEYS[1]: 実行中のリースの zset (lease_id -> 期限 unix time), KEYS[2]: TPM のバケット
+# - ARGV[1]: lease_id, ARGV[2]: 同時実行数の上限, ARGV[3]: リースの期限(秒), ARGV[4]: TPM の上限, ARGV[5]: 見積もりトークン数, ARGV[6]: バケットの有効期間(ms)
+# - 期限切れのリース (ワーカー停止など) を除いてから、同時実行数と TPM (token bucket) の両方に空きがある場合のみ確保する
+# - 戻り値 1: 確保, 0: 同時実行数の上限, -1: TPM の上限 (上限 0 はその制限なし)
+ACQUIRE_SLOT_LUA = """
+local t   = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local concurrency = tonumber(ARGV[2])
+if concurrency > 0 and redis.call('ZCARD', KEYS[1]) >= concurrency then
+    return 0
+end
+local tpm = tonumber(ARGV[4])
+if tpm > 0 then
+    local data   = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+    local tokens = tonumber(data[1])
+    local ts     = tonumber(data[2])
+    if tokens == nil or ts == nil then
+        tokens = tpm
+        ts     = now
+    end
+    tokens = math.min(tpm, tokens + math.max(0, now - ts) * tpm / 60)
+    local cost = math.min(tonumber(ARGV[5]), tpm)
+    local allowed = tokens >= cost
+    if allowed then
+        tokens = tokens - cost
+    end
+    redis.call('HSET', KEYS[2], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[2], tonumber(ARGV[6]))
+    if not allowed then
+        return -1
+    end
+end
+local lease_ttl = tonumber(ARGV[3])
+redis.call('ZADD', KEYS[1], now + lease_ttl, ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(lease_ttl) + 1)
+return 1
+"""
+
+# スロットの解放 (Redis)
+# - ARGV[1]: lease_id, ARGV[2]: TPM の上限, ARGV[3]: 返却するトークン数 (見積もり - 実績, 負の場合は追加で消費)
+RELEASE_SLOT_LUA = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+local tpm    = tonumber(ARGV[2])
+local refund = tonumber(ARGV[3])
+if tpm > 0 and refund ~= 0 then
+    local data   = redis.call('HMGET', KEYS[2], 'tokens', 'ts')
+    local tokens = tonumber(data[1])
+    local ts     = tonumber(data[2])
+    if tokens ~= nil and ts ~= nil then
+        local t   = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        tokens = math.min(tpm, tokens + math.max(0, now - ts) * tpm / 60 + refund)
+        redis.call('HSET', KEYS[2], 'tokens', tostring(tokens), 'ts', tostring(now))
+    end
+end
+return 1
+"""
+
+
+class LlmQueueTimeout(Exception):
+    """ queue_timeout_sec 以内にスロットを確保できなかった """
+
+
+class LocalLlmBudget:
+    """
+    プロセス内で完結するモデルごとの同時実行数 / TPM の管理 (シングルノード用)
+    """
+
+    def __init__(self):
+        self._leases:Dict[str, Dict[str, float]]     = {} # model_name: {lease_id: 期限}
+        self._buckets:Dict[str, Tuple[float, float]] = {} # model_name: (tokens, last_ts)
+
+    def _refill(self, model_name:str, tpm_limit:int, now:float) -> float:
+        tokens, last = self._buckets.get(model_name, (tpm_limit, now))
+        return min(tpm_limit, tokens + max(0.0, now - last) * tpm_limit / 60)
+
+    async def try_acquire(self,
+                          model_name:str,
+                          lease_id:str,
+                          concurrency_limit:int,
+                          tpm_limit:int,
+                          cost:int,
+                          lease_ttl_sec:float,) -> int:
+        now    = time.monotonic()
+        leases = self._leases.setdefault(model_name, {})
+        for expired_id in [k for k, expire in leases.items() if expire <= now]:
+            del leases[expired_id]
+        if concurrency_limit > 0 and len(leases) >= concurrency_limit:
+            return 0
+        if tpm_limit > 0:
+            tokens  = self._refill(model_name, tpm_limit, now)
+            allowed = tokens >= min(cost, tpm_limit)
+            if allowed:
+                tokens -= min(cost, tpm_limit)
+            self._buckets[model_name] = (tokens, now)
+            if not allowed:
+                return -1
+        leases[lease_id] = now + lease_ttl_sec
+        return 1
+
+    async def release(self,
+                      model_name:str,
+                      lease_id:str,
+                      tpm_limit:int,
+                      refund:int,) -> None:
+        self._leases.get(model_name, {}).pop(lease_id, None)
+        if tpm_limit > 0 and refund and model_name in self._buckets:
+            now = time.monotonic()
+            self._buckets[model_name] = (min(tpm_limit, self._refill(model_name, tpm_limit, now) + refund), now)
+
+
+class RedisLlmBudget:
+    """
+    Redis の Lua スクリプトで全ワーカー共通のモデルごとの同時実行数 / TPM を管理する (マルチノード用)
+    - Redis に接続できない場合は LocalLlmBudget で判定する (解放も確保した側で行う)
+    """
+
+    def __init__(self, key_prefix:str = 'llm_scheduler'):
+        self.key_prefix    = key_prefix
+        self._fallback     = LocalLlmBudget()
+        self._local_leases = set() # fallback で確保した lease_id
+
+    def _keys(self, model_name:str) -> List[str]:
+        return [f'{self.key_prefix}:{model_name}:leases',
+                f'{self.key_prefix}:{model_name}:tpm',]
+
+    async def try_acquire(self,
+                          model_name:str,
+                          lease_id:str,
+                          concurrency_limit:int,
+                          tpm_limit:int,
+                          cost:int,
+                          lease_ttl_sec:float,) -> int:
+        try:
+            redis_client = get_async_redis_client()
+            result = await redis_client.eval(ACQUIRE_SLOT_LUA, 2, *self._keys(model_name),
+                                             lease_id, concurrency_limit, lease_ttl_sec, tpm_limit, cost,
+                                             TPM_BUCKET_TTL_MS)
+            return int(result)
+        except Exception as e:
+            print(e)
+            result = await self._fallback.try_acquire(model_name, lease_id, concurrency_limit,
+                                                      tpm_limit, cost, lease_ttl_sec)
+            if result == 1:
+                self._local_leases.add(lease_id)
+            return result
+
+    async def release(self,
+                      model_name:str,
+                      lease_id:str,
+                      tpm_limit:int,
+                      refund:int,) -> None:
+        if lease_id in self._local_leases:
+            self._local_leases.discard(lease_id)
+            await self._fallback.release(model_name, lease_id, tpm_limit, refund)
+            return
+        try:
+            redis_client = get_async_redis_client()
+            await redis_client.eval(RELEASE_SLOT_LUA, 2, *self._keys(model_name),
+                                    lease_id, tpm_limit, refund)
+        except Exception as e:
+            # 解放できなかったリースは期限 (lease_ttl_sec) で消える
+            print(e)
+
+
+class LlmSlot:
+    """
+    LlmScheduler.slot が返す async context manager
+    - async with で待ち行列に並び、抜けた時点で解放する
+    - commit(actual_tokens) で実績のトークン数を渡すと、見積もりとの差を TPM のバケットに戻す
+    """
+
+    def __init__(self,
+                 scheduler:'LlmScheduler',
+                 model_name:str,
+                 user_key:str,
+                 cost:int,
+                 concurrency_limit:int,
+                 tpm_limit:int,
+                 weight:float,
+                 on_position:Optional[Callable[[int], Awaitable[None]]],):
+        self.scheduler         = scheduler
+        self.model_name        = model_name
+        self.user_key          = user_key
+        self.cost              = max(int(cost), 0)
+        self.concurrency_limit = max(int(concurrency_limit or 0), 0)
+        self.tpm_limit         = max(int(tpm_limit or 0), 0)
+        self.weight            = weight if weight > 0 else 1.0
+        self.on_position       = on_position
+        self.lease_id          = uuid.uuid4().hex
+        self.actual_tokens:Optional[int] = None
+        self.wait_sec          = 0.0
+
+    @property
+    def charged_tokens(self) -> int:
+        return min(self.cost, self.tpm_limit) if self.tpm_limit > 0 else 0
+
+    def commit(self, actual_tokens:int) -> None:
+        self.actual_tokens = max(int(actual_tokens), 0)
+
+    async def __aenter__(self) -> 'LlmSlot':
+        await self.scheduler._acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.scheduler._release(self)
+
+
+class _Waiter:
+    __slots__ = ('slot', 'start_tag', 'finish_tag', 'seq', 'future', 'position',)
+
+    def __init__(self, slot:LlmSlot, start_tag:float, finish_tag:float, seq:int, future:asyncio.Future):
+        self.slot       = slot
+        self.start_tag  = start_tag
+        self.finish_tag = finish_tag
+        self.seq        = seq
+        self.future     = future
+        self.position:Optional[int] = None
+
+    def __lt__(self, other:'_Waiter') -> bool:
+        return (self.finish_tag, self.seq) < (other.finish_tag, other.seq)
+
+
+class _ModelQueue:
+    """ モデルごとの待ち行列 (ユーザごとの重み付き公平キュー) """
+
+    def __init__(self, loop:asyncio.AbstractEventLoop):
+        self.loop         = loop
+        self.heap:List[_Waiter]       = []
+        self.virtual_time = 0.0
+        self.user_finish:Dict[str, float] = {} # user_key: 最後に並んだ要求の finish_tag
+        self.is_congested = False # 空きが無く待たせている (順番の通知を行う)
+        self.wakeup       = asyncio.Event()
+        self.task:Optional[asyncio.Task] = None
+
+    def push(self, slot:LlmSlot, seq:int) -> _Waiter:
+        # 仮想時間で各ユーザの要求を cost / weight ずつ進め、finish_tag の小さい順に処理する
+        # (1 ユーザが大量に並べても他のユーザの要求が間に入る)
+        start_tag  = max(self.virtual_time, self.user_finish.get(slot.user_key, 0.0))
+        finish_tag = start_tag + max(slot.cost, 1) / slot.weight
+        self.user_finish[slot.user_key] = finish_tag
+        waiter = _Waiter(slot, start_tag, finish_tag, seq, self.loop.create_future())
+        heapq.heappush(self.heap, waiter)
+        return waiter
+
+    def head(self) -> Optional[_Waiter]:
+        # 取り消された要求 (キャンセル / タイムアウト) を先頭から除く
+        while self.heap and self.heap[0].future.done():
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    def pop(self, waiter:_Waiter) -> None:
+        # 確保の間に finish_tag の小さい要求が並んだ場合は先頭以外から除く
+        if self.heap and self.heap[0] is waiter:
+            heapq.heappop(self.heap)
+        else:
+            self.heap.remove(waiter)
+            heapq.heapify(self.heap)
+        self.virtual_time = max(self.virtual_time, waiter.start_tag)
+        # 仮想時間に追い越されたユーザは記録を残さない
+        if len(self.user_finish) > len(self.heap) * 2:
+            self.user_finish = {k: v for k, v in self.user_finish.items() if v > self.virtual_time}
+
+    def waiting(self) -> List[_Waiter]:
+        return sorted(waiter for waiter in self.heap if not waiter.future.done())
+
+
+class LlmScheduler:
+    """
+    上流 LLM の呼び出しの前段に置くスケジューラ
+        - モデルごとの同時実行数 (concurrency_limit) と 1分あたりのトークン数 (tpm_limit) を budget で全ワーカー共通に管理する
+          (RedisLlmBudget: Redis, 失敗時は LocalLlmBudget)
+        - 空きが無い場合はプロセス内でモデルごとに待たせ、ユーザごとの重み付き公平キュー (finish_tag 順) で順番に確保する
+        - 待たせている間は順番が変わるたびに on_position(position) を呼ぶ (1 始まり)
+        - 他のワーカーの解放は通知されないので poll_interval_sec ごとに確保を再試行する
+        - 確保したスロットは lease_ttl_sec で失効する (解放できずに停止したワーカーの分)
+    cost (見積もりトークン数) は TPM の上限を超える場合は上限として扱う (バケットが満タンなら通す)
+
+    メトリクス ({namespace}.*)
+        - acquired / timeout:    件数
+        - wait_sec:              スロットの確保までの待ち時間(秒)
+        - queue_len:             モデルごとの待ち行列の長さ (gauge, tags={'model': model_name})
+    """
+
+    def __init__(self,
+                 budget,
+                 namespace:str            = 'llm_scheduler',
+                 poll_interval_sec:float  = 0.1,
+                 lease_ttl_sec:float      = 300,
+                 queue_timeout_sec:float  = 60,):
+        self.budget            = budget
+        self.namespace         = namespace
+        self.poll_interval_sec = poll_interval_sec
+        self.lease_ttl_sec     = lease_ttl_sec
+        self.queue_timeout_sec = queue_timeout_sec
+        self._queues:Dict[str, _ModelQueue] = {}
+        self._seq              = itertools.count()
+
+    def slot(self,
+             model_name:str,
+             user_key:str,
+             cost:int,
+             concurrency_limit:int = 0,
+             tpm_limit:int         = 0,
+             weight:float          = 1.0,
+             on_position:Optional[Callable[[int], Awaitable[None]]] = None,
+             ) -> LlmSlot:
+        return LlmSlot(self, model_name, user_key, cost, concurrency_limit, tpm_limit, weight, on_position)
+
+    def queue_len(self, model_name:str) -> int:
+        queue = self._queues.get(model_name)
+        return len(queue.waiting()) if queue else 0
+
+    ####################
+    # 確保・解放
+    ####################
+    def _get_queue(self, model_name:str) -> _ModelQueue:
+        loop  = asyncio.get_running_loop()
+        queue = self._queues.get(model_name)
+        if queue is None or queue.loop is not loop:
+            queue = _ModelQueue(loop)
+            self._queues[model_name] = queue
+        if queue.task is None or queue.task.done():
+            queue.task = loop.create_task(self._dispatch(model_name, queue))
+        return queue
+
+    async def _acquire(self, slot:LlmSlot) -> None:
+        start  = time.monotonic()
+        queue  = self._get_queue(slot.model_name)
+        waiter = queue.push(slot, next(self._seq))
+        queue.wakeup.set()
+        try:
+            # タイムアウト・キャンセル時は future が取り消され、dispatch 側で除かれる
+            await asyncio.wait_for(waiter.future, self.queue_timeout_sec)
+        except asyncio.TimeoutError:
+            incr_counter(f'{self.namespace}.timeout')
+            raise LlmQueueTimeout(f'{slot.model_name}: waited over {self.queue_timeout_sec} sec')
+        except asyncio.CancelledError:
+            # 確保した直後にキャンセルされた場合は解放する
+            if waiter.future.done() and not waiter.future.cancelled():
+                await self.budget.release(slot.model_name, slot.lease_id, slot.tpm_limit, slot.charged_tokens)
+            raise
+        slot.wait_sec = time.monotonic() - start
+        incr_counter(f'{self.namespace}.acquired')
+        observe(f'{self.namespace}.wait_sec', slot.wait_sec)
+
+    async def _release(self, slot:LlmSlot) -> None:
+        refund = slot.charged_tokens - slot.actual_tokens if slot.actual_tokens is not None else 0
+        await self.budget.release(slot.model_name, slot.lease_id, slot.tpm_limit, refund)
+        queue = self._queues.get(slot.model_name)
+        if queue is not None:
+            queue.wakeup.set()
+
+    async def _dispatch(self, model_name:str, queue:_ModelQueue) -> None:
+        while True:
+            waiter = queue.head()
+            if waiter is None:
+                queue.is_congested = False
+                set_gauge(f'{self.namespace}.queue_len', 0, tags={'model': model_name})
+                queue.wakeup.clear()
+                await queue.wakeup.wait()
+                continue
+            slot = waiter.slot
+            try:
+                result = await self.budget.try_acquire(slot.model_name, slot.lease_id, slot.concurrency_limit,
+                                                       slot.tpm_limit, slot.cost, self.lease_ttl_sec)
+            except Exception as e:
+                print(e)
+                result = 0
+            if result == 1:
+                queue.pop(waiter)
+                if waiter.future.done():
+                    # 確保中に取り消された
+                    await self.budget.release(slot.model_name, slot.lease_id, slot.tpm_limit, slot.charged_tokens)
+                else:
+                    waiter.future.set_result(None)
+                self._notify_positions(model_name, queue)
+                continue
+            # 空きが無い: 解放・新しい要求で起こされるか poll_interval_sec 後に再試行する
+            queue.is_congested = True
+            self._notify_positions(model_name, queue)
+            queue.wakeup.clear()
+            try:
+                await asyncio.wait_for(queue.wakeup.wait(), self.poll_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify_positions(self, model_name:str, queue:_ModelQueue) -> None:
+        waiting = queue.waiting()
+        set_gauge(f'{self.namespace}.queue_len', len(waiting), tags={'model': model_name})
+        if not queue.is_congested:
+            return
+        for position, waiter in enumerate(waiting, start=1):
+            if waiter.position == position or waiter.slot.on_position is None:
+                continue
+            waiter.position = position
+            queue.loop.create_task(self._call_on_position(waiter.slot, position))
+
+    async def _call_on_position(self, slot:LlmSlot, position:int) -> None:
+        try:
+            await slot.on_position(position)
+        except Exception as e:
+            print(e)
+
+
+_BUDGETS:Dict[str, object]                                       = {}
+_SCHEDULERS:Dict[Tuple[str, float, float, float], LlmScheduler] = {}
+
+def _get_llm_budget(backend:str):
+    # 設定の異なるスケジューラ間でも budget (モデルごとの上限) は backend ごとに共有する
+    budget = _BUDGETS.get(backend)
+    if budget is None:
+        if backend == 'redis':
+            budget = RedisLlmBudget()
+        elif backend == 'local':
+            budget = LocalLlmBudget()
+        else:
+            raise ValueError(f'unknown llm scheduler backend: {backend}')
+        _BUDGETS[backend] = budget
+    return budget
+
+def get_llm_scheduler(backend:str            = 'redis',
+                      poll_interval_sec:float = 0.1,
+                      lease_ttl_sec:float     = 300,
+                      queue_timeout_sec:float = 60,
+                      ) -> LlmScheduler:
+    """
+    上流 LLM の呼び出し用スケジューラをプロセス内で共有して返す。
+    (モデルごとの上限はアプリをまたいで共通に管理するため、キーにアプリ名は含めない)
+    スケジューラは引数の組み合わせごとに作り、budget は backend ごとに共有する。
+
+    Args:
+        backend (str): 'redis' (マルチノード) / 'local' (シングルノード)。
+        poll_interval_sec (float): 空きが無い場合の再試行の間隔(秒)。
+        lease_ttl_sec (float): 確保したスロットの期限(秒)。
+        queue_timeout_sec (float): 待ち時間の上限(秒)。超えた場合は LlmQueueTimeout。
+
+    Returns:
+        LlmScheduler: slot(...) で async context manager を返す。
+    """
+    cache_key = (backend, float(poll_interval_sec), float(lease_ttl_sec), float(queue_timeout_sec))
+    scheduler = _SCHEDULERS.get(cache_key)
+    if scheduler is None:
+        scheduler = LlmScheduler(_get_llm_budget(backend),
+                                 poll_interval_sec = poll_interval_sec,
+                                 lease_ttl_sec     = lease_ttl_sec,
+                                 queue_timeout_sec = queue_timeout_sec,)
+        _SCHEDULERS[cache_key] = scheduler
+    return scheduler
\ No newline at end of file
@@ -0,0 +1,123 @@
+import time
+from typing import Dict, Tuple
+from .RedisUtils import get_async_redis_client
+
+# セッションの確保 (Redis)
+# - KEYS[1]: 確保中のリースの zset (lease_id -> 期限 unix time)
+# - ARGV[1]: lease_id, ARGV[2]: 同時セッション数の上限 (0 は制限なし), ARGV[3]: リースの期限(秒)
+# - 期限切れのリース (ワーカー停止など) を除いてから、空きがある場合のみ確保する (1: 確保, 0: 上限)
+ACQUIRE_SESSION_LUA = """
+local t   = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+local limit = tonumber(ARGV[2])
+if limit > 0 and redis.call('ZSCORE', KEYS[1], ARGV[1]) == false and redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+local lease_ttl = tonumber(ARGV[3])
+redis.call('ZADD', KEYS[1], now + lease_ttl, ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(lease_ttl) + 1)
+return 1
+"""
+
+
+class LocalSessionLimiter:
+    """
+    プロセス内で完結するキー (ユーザ) ごとの同時セッション数の管理 (シングルノード用)
+    """
+
+    def __init__(self):
+        self._leases:Dict[str, Dict[str, float]] = {} # key: {lease_id: 期限}
+
+    async def try_acquire(self,
+                          key:str,
+                          lease_id:str,
+                          limit:int,
+                          lease_ttl_sec:float,) -> bool:
+        now    = time.monotonic()
+        leases = self._leases.setdefault(key, {})
+        for expired_id in [k for k, expire in leases.items() if expire <= now]:
+            del leases[expired_id]
+        if limit > 0 and lease_id not in leases and len(leases) >= limit:
+            return False
+        leases[lease_id] = now + lease_ttl_sec
+        return True
+
+    async def release(self, key:str, lease_id:str) -> None:
+        leases = self._leases.get(key)
+        if leases is None:
+            return
+        leases.pop(lease_id, None)
+        if not leases:
+            del self._leases[key]
+
+
+class RedisSessionLimiter:
+    """
+    Redis の Lua スクリプトで全ワーカー (接続) 共通のキー (ユーザ) ごとの同時セッション数を管理する (マルチノード用)
+    - Redis に接続できない場合は LocalSessionLimiter で判定する (解放も確保した側で行う)
+    - 解放できなかったリースは期限 (lease_ttl_sec) で消える
+    """
+
+    def __init__(self, key_prefix:str = 'session_limit'):
+        self.key_prefix    = key_prefix
+        self._fallback     = LocalSessionLimiter()
+        self._local_leases = set() # fallback で確保した lease_id
+
+    def _key(self, key:str) -> str:
+        return f'{self.key_prefix}:{key}'
+
+    async def try_acquire(self,
+                          key:str,
+                          lease_id:str,
+                          limit:int,
+                          lease_ttl_sec:float,) -> bool:
+        try:
+            redis_client = get_async_redis_client()
+            result = await redis_client.eval(ACQUIRE_SESSION_LUA, 1, self._key(key),
+                                             lease_id, limit, lease_ttl_sec)
+            return int(result) == 1
+        except Exception as e:
+            print(e)
+            is_acquired = await self._fallback.try_acquire(key, lease_id, limit, lease_ttl_sec)
+            if is_acquired:
+                self._local_leases.add(lease_id)
+            return is_acquired
+
+    async def release(self, key:str, lease_id:str) -> None:
+        if lease_id in self._local_leases:
+            self._local_leases.discard(lease_id)
+            await self._fallback.release(key, lease_id)
+            return
+        try:
+            redis_client = get_async_redis_client()
+            await redis_client.zrem(self._key(key), lease_id)
+        except Exception as e:
+            print(e)
+
+
+_SESSION_LIMITERS:Dict[Tuple[str, str], object] = {}
+
+def get_session_limiter(namespace:str,
+                        backend:str = 'redis',):
+    """
+    キー (ユーザ) ごとの同時セッション数の limiter をプロセス内で共有して返す。
+
+    Args:
+        namespace (str): キーの名前空間 (アプリ名など)。
+        backend (str): 'redis' (マルチノード) / 'local' (シングルノード)。
+
+    Returns:
+        RedisSessionLimiter | LocalSessionLimiter: try_acquire(key, lease_id, limit, lease_ttl_sec) / release(key, lease_id) を持つ limiter。
+    """
+    cache_key = (namespace, backend)
+    limiter   = _SESSION_LIMITERS.get(cache_key)
+    if limiter is None:
+        if backend == 'redis':
+            limiter = RedisSessionLimiter(key_prefix=f'session_limit:{namespace}')
+        elif backend == 'local':
+            limiter = LocalSessionLimiter()
+        else:
+            raise ValueError(f'unknown session limiter backend: {backend}')
+        _SESSION_LIMITERS[cache_key] = limiter
+    return limiter
\ No newline at end of file
@@ -0,0 +1,217 @@
+import asyncio
+import re
+import time
+from typing import AsyncIterator, AsyncGenerator, Iterator, List, Optional
+from common.scripts.LlmUtils import StreamingUrlSanitizer
+
+# 文末とみなす文字 (この文字でバッファが終わっていればフラッシュする)
+SENTENCE_END_CHARS = ('。', '．', '！', '？', '!', '?', '\n',)
+# 文 (文末の文字が続く場合はまとめて 1 つの文の終わりとする)
+SENTENCE_PATTERN   = re.compile('[^{0}]*(?:[{0}]+|\\Z)'.format(re.escape(''.join(SENTENCE_END_CHARS))))
+# 長すぎる文を区切る位置の候補
+SOFT_BREAK_CHARS   = ('、', '，', ',', ' ', '　',)
+
+
+class StreamCoalescer:
+    """
+    LLM のストリーミング出力 (delta) をまとめて送信するためのバッファ。
+
+    以下のいずれかを満たした時点でバッファをフラッシュする
+        - 前回のフラッシュから flush_interval_ms 以上経過した
+        - バッファのバイト数が flush_max_bytes 以上になった
+        - is_flush_on_sentence=True でバッファが文末で終わっている
+
+    全文は list に貯めて text プロパティで join する (文字列の += 連結は行わない)
+    """
+
+    def __init__(self,
+                 flush_interval_ms:int     = 50,
+                 flush_max_bytes:int       = 256,
+                 is_flush_on_sentence:bool = True,):
+        self.flush_interval_sec   = max(flush_interval_ms, 0) / 1000
+        self.flush_max_bytes      = max(flush_max_bytes, 0)
+        self.is_flush_on_sentence = is_flush_on_sentence
+
+        self._buffer:List[str] = []  # 未送信の delta
+        self._buffer_bytes     = 0
+        self._chunks:List[str] = []  # 全文 (送信済み + 未送信)
+        self._last_flush       = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self._chunks)
+
+    @property
+    def is_empty(self) -> bool:
+        return not self._buffer
+
+    def seconds_until_due(self) -> float:
+        """ 時間条件でフラッシュされるまでの残り秒数 """
+        return max(self.flush_interval_sec - (time.monotonic() - self._last_flush), 0.0)
+
+    def add(self, delta:str) -> Optional[str]:
+        """
+        delta をバッファに追加し、フラッシュ条件を満たしていればまとめた文字列を返す
+        """
+        if delta:
+            self._buffer.append(delta)
+            self._chunks.append(delta)
+            self._buffer_bytes += len(delta.encode('utf-8'))
+        if self._is_flush_due():
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """ バッファを強制的に吐き出す (空の場合は None) """
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return None
+        chunk              = ''.join(self._buffer)
+        self._buffer       = []
+        self._buffer_bytes = 0
+        return chunk
+
+    def _is_flush_due(self) -> bool:
+        if not self._buffer:
+            return False
+        if self._buffer_bytes >= self.flush_max_bytes:
+            return True
+        if self.is_flush_on_sentence and self._buffer[-1].endswith(SENTENCE_END_CHARS):
+            return True
+        if self.seconds_until_due() <= 0:
+            return True
+        return False
+
+
+def _cut_long_sentence(sentence:str, max_chars:int) -> Iterator[str]:
+    while len(sentence) > max_chars:
+        cut = max(sentence.rfind(c, 0, max_chars) for c in SOFT_BREAK_CHARS) + 1
+        if cut <= 0:
+            cut = max_chars
+        yield sentence[:cut]
+        sentence = sentence[cut:]
+    if sentence:
+        yield sentence
+
+def split_sentences(text:str, max_chars:int = 200) -> List[str]:
+    """
+    テキストを文末 (SENTENCE_END_CHARS) で区切る (TTS を文ごとに合成する用)
+    - max_chars を超える文は読点 / 空白の位置で (無ければ max_chars で) 区切る
+    - 空白だけの部分は直前の文に含める (''.join(結果) は元のテキストと同じ。空白だけのテキストは [])
+    """
+    sentences:List[str] = []
+    carry               = ''
+    for m in SENTENCE_PATTERN.finditer(text or ''):
+        for sentence in _cut_long_sentence(m.group(0), max(max_chars, 1)):
+            if not sentence.strip():
+                if sentences:
+                    sentences[-1] += sentence
+                else:
+                    carry += sentence
+                continue
+            sentences.append(carry + sentence)
+            carry = ''
+    return sentences
+
+async def split_sentence_stream(source:AsyncIterator[str],
+                                max_chars:int = 200,
+                                ) -> AsyncGenerator[str, None]:
+    """
+    source の delta を文 (split_sentences) ごとにまとめて yield する (文ごとに TTS に送る用)
+    - 文末の後に次の文字が来た時点で文を確定する (「！？」のように文末の文字が続く場合に分けない)
+    - 最後の空白だけの部分は yield しない
+    終了・キャンセル時は source を aclose する。
+    """
+    source_iter = source.__aiter__()
+    buffer      = ''  # 確定していない文 (1 文分まで)
+    try:
+        async for delta in source_iter:
+            buffer   += delta
+            sentences = split_sentences(buffer, max_chars)
+            for sentence in sentences[:-1]:
+                yield sentence
+            if sentences:
+                buffer = sentences[-1]
+        for sentence in split_sentences(buffer, max_chars):
+            yield sentence
+    finally:
+        aclose = getattr(source_iter, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+async def iter_text(context:str, chunk_size:int = 1) -> AsyncGenerator[str, None]:
+    """
+    固定文字列 (エラーメッセージ等) を StreamCoalescer に流すための非同期ジェネレータ
+    """
+    for i in range(0, len(context or ''), max(chunk_size, 1)):
+        yield context[i:i+chunk_size]
+
+async def sanitize_stream(source:AsyncIterator[str],
+                          allowed_domains_list:list,
+                          ) -> AsyncGenerator[str, None]:
+    """
+    source の delta の URL を StreamingUrlSanitizer で処理して yield する
+    (未完成の URL / Markdown のリンクの可能性がある末尾だけを次の delta まで保留する)
+    終了・キャンセル時は source を aclose する。
+    """
+    sanitizer   = StreamingUrlSanitizer(allowed_domains_list)
+    source_iter = source.__aiter__()
+    try:
+        async for delta in source_iter:
+            chunk = sanitizer.feed(delta)
+            if chunk:
+                yield chunk
+        chunk = sanitizer.flush()
+        if chunk:
+            yield chunk
+    finally:
+        aclose = getattr(source_iter, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+async def coalesce_stream(source:AsyncIterator[str],
+                          coalescer:StreamCoalescer,
+                          ) -> AsyncGenerator[str, None]:
+    """
+    source の delta を coalescer でまとめて yield する。
+    上流が止まっていても flush_interval_ms が経過すればバッファを吐き出す。
+    全文は coalescer.text で取得できる。
+    終了・キャンセル時は source を aclose する。
+    """
+    source_iter = source.__aiter__()
+    pending     = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(source_iter.__anext__())
+            # バッファが空なら次の delta まで待つ / 空でなければフラッシュ期限まで待つ
+            timeout = None if coalescer.is_empty else coalescer.seconds_until_due()
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                chunk = coalescer.flush()
+                if chunk:
+                    yield chunk
+                continue
+            try:
+                delta = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+            chunk = coalescer.add(delta)
+            if chunk:
+                yield chunk
+        chunk = coalescer.flush()
+        if chunk:
+            yield chunk
+    finally:
+        # キャンセル (StopGeneration / 切断) 時は上流を閉じてプロバイダとの接続を解放する
+        if pending is not None and not pending.done():
+            pending.cancel()
+            await asyncio.wait({pending})
+        aclose = getattr(source_iter, 'aclose', None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                print(e)
\ No newline at end of file
@@ -0,0 +1,212 @@
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+from common.scripts.PythonCodeUtils import incr_counter
+from .RedisUtils import get_async_redis_client
+
+
+class TtsAudioCache:
+    """
+    TTS の音声を (テキスト, 音声, AudioConfig) のハッシュをキーにキャッシュする (content-addressed)
+        - ディスク: cache_dir/<hash[:2]>/<hash>.bin に保存する (WebSocket の送信に bytes が必要なため、そのまま read で読み込む)。
+          合計が max_bytes を超えたら最終アクセスが古いものから削除する (LRU)
+        - Redis (任意, is_redis): ディスクに無い場合に参照し、ヒットしたらディスクにも保存する (プロセス / サーバ間で共有)
+        - get_or_synthesize は同じキーの同時リクエストを 1 回の合成にまとめる
+    ディスクの読み書きはスレッドで行い、イベントループを止めない
+    LRU の順序はプロセスごとに持ち、起動時はファイルの更新日時 (ヒット時に更新) から作る
+
+    メトリクス ({namespace}.hit_disk / .hit_redis / .miss / .evicted)
+    """
+
+    def __init__(self,
+                 namespace:str,
+                 cache_dir:str,
+                 max_bytes:int     = 256 * 1024 * 1024,
+                 is_redis:bool     = False,
+                 redis_ttl_sec:int = 86400,
+                 is_enabled:bool   = True,):
+        self.namespace     = namespace
+        self.cache_dir     = cache_dir
+        self.max_bytes     = max_bytes
+        self.is_redis      = is_redis
+        self.redis_ttl_sec = redis_ttl_sec
+        self.is_enabled    = is_enabled
+
+        self._index:'OrderedDict[str, int]' = OrderedDict() # hash -> bytes (古い順)
+        self._total_bytes     = 0
+        self._is_index_loaded = False
+        self._lock            = threading.Lock()
+        self._inflight:Dict[str, asyncio.Task] = {}
+
+    def build_key(self,
+                  text:str,
+                  voice:Dict[str, Any],
+                  audio_config:Dict[str, Any],
+                  ) -> Optional[str]:
+        """ 無効の場合は None """
+        if not self.is_enabled:
+            return None
+        canonical = json.dumps({'text': text, 'voice': voice, 'audio_config': audio_config},
+                               sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, cache_key:str) -> str:
+        return os.path.join(self.cache_dir, cache_key[:2], f'{cache_key}.bin')
+
+    def _redis_key(self, cache_key:str) -> str:
+        return f'tts_cache:{self.namespace}:{cache_key}'
+
+    ####################
+    # ディスク (スレッドで実行)
+    ####################
+    def _load_index(self) -> None:
+        # self._lock 内で呼ぶ
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.bin')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, os.path.basename(path)[:-len('.bin')], stat.st_size))
+        for _, cache_key, size in sorted(entries):
+            self._index[cache_key] = size
+            self._total_bytes     += size
+        self._is_index_loaded = True
+
+    def _touch(self, cache_key:str, size:int) -> None:
+        # self._lock 内で呼ぶ
+        if cache_key in self._index:
+            self._index.move_to_end(cache_key)
+        else:
+            # 他のプロセスが保存したファイル
+            self._index[cache_key] = size
+            self._total_bytes     += size
+
+    def _read_disk(self, cache_key:str) -> Optional[bytes]:
+        with self._lock:
+            if not self._is_index_loaded:
+                self._load_index()
+        path = self._path(cache_key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            if not audio:
+                return None
+            size = len(audio)
+            os.utime(path) # 起動時の LRU の順序用
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self._touch(cache_key, size)
+        return audio
+
+    def _write_disk(self, cache_key:str, audio:bytes) -> int:
+        """ 保存し、削除した件数を返す """
+        path     = self._path(cache_key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, path) # 読み込み中のプロセスに書きかけを見せない
+        evicted = 0
+        with self._lock:
+            if not self._is_index_loaded:
+                self._load_index()
+            if cache_key in self._index:
+                self._total_bytes -= self._index.pop(cache_key)
+            self._index[cache_key] = len(audio)
+            self._total_bytes     += len(audio)
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                old_key, size      = self._index.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+                evicted += 1
+        return evicted
+
+    ####################
+    # 取得 / 保存
+    ####################
+    async def aget(self, cache_key:str) -> Optional[bytes]:
+        try:
+            audio = await asyncio.to_thread(self._read_disk, cache_key)
+        except Exception as e:
+            print(e)
+            audio = None
+        if audio is not None:
+            incr_counter(f'{self.namespace}.hit_disk')
+            return audio
+        if self.is_redis:
+            try:
+                redis_client = get_async_redis_client(decode_responses=False)
+                audio = await redis_client.getex(self._redis_key(cache_key), ex=self.redis_ttl_sec)
+            except Exception as e:
+                print(e)
+                audio = None
+            if audio:
+                incr_counter(f'{self.namespace}.hit_redis')
+                await self._aset_disk(cache_key, audio)
+                return audio
+        incr_counter(f'{self.namespace}.miss')
+        return None
+
+    async def _aset_disk(self, cache_key:str, audio:bytes) -> None:
+        try:
+            evicted = await asyncio.to_thread(self._write_disk, cache_key, audio)
+        except Exception as e:
+            print(e)
+            return
+        if evicted:
+            incr_counter(f'{self.namespace}.evicted', evicted)
+
+    async def aset(self, cache_key:str, audio:bytes) -> None:
+        if not audio:
+            return
+        await self._aset_disk(cache_key, audio)
+        if self.is_redis:
+            try:
+                redis_client = get_async_redis_client(decode_responses=False)
+                await redis_client.set(self._redis_key(cache_key), audio, ex=self.redis_ttl_sec)
+            except Exception as e:
+                print(e)
+
+    async def _synthesize_and_store(self,
+                                    cache_key:str,
+                                    synthesize:Callable[[], Awaitable[bytes]],
+                                    ) -> bytes:
+        audio = await self.aget(cache_key)
+        if audio is not None:
+            return audio
+        audio = await synthesize()
+        await self.aset(cache_key, audio)
+        return audio
+
+    async def get_or_synthesize(self,
+                                cache_key:Optional[str],
+                                synthesize:Callable[[], Awaitable[bytes]],
+                                ) -> bytes:
+        """
+        キャッシュにあればそれを、無ければ synthesize() の結果を保存して返す (cache_key が None の場合は常に合成)
+        - 同じキーの合成中は、その結果を待つ (呼び出し元がキャンセルされても合成と保存は続ける)
+        """
+        if cache_key is None:
+            return await synthesize()
+        task = self._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._synthesize_and_store(cache_key, synthesize))
+            self._inflight[cache_key] = task
+
+            def _done(t:asyncio.Task):
+                self._inflight.pop(cache_key, None)
+                if not t.cancelled():
+                    t.exception() # 待つ呼び出し元がいない場合の警告を出さない
+            task.add_done_callback(_done)
+        return await asyncio.shield(task)
\ No newline at end of file
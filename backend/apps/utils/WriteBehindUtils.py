@@ -0,0 +1,259 @@
+import asyncio
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from channels.db import database_sync_to_async
+from django.db import InterfaceError, OperationalError
+from typing import Any, Callable, Deque, Dict, List, Optional
+from common.scripts.PythonCodeUtils import incr_counter, observe
+
+# 終了時にフラッシュするキュー
+_QUEUES:List['WriteBehindQueue'] = []
+
+
+def is_transient_db_error(e:Exception) -> bool:
+    """ DB に接続できないなど、時間をおけば書き込める可能性があるエラーか (それ以外は item 自体の問題とみなす) """
+    return isinstance(e, (OperationalError, InterfaceError, ConnectionError, TimeoutError))
+
+
+class WriteBehindQueue:
+    """
+    完了したデータを一旦メモリに積み、まとめて DB に書き込む (write-behind)
+        - put は待たずに戻る。flush_fn(items) は max_batch 件たまるか
+          最初の 1 件から flush_interval_sec 経過した時点でまとめて呼ぶ (bulk_create 用)
+        - flush_fn が失敗した場合 (DB 停止など) は spool_dir の追記専用ファイル (JSON Lines) に退避し、
+          次に書き込みが成功した時点で (他プロセスの分も含めて) 再投入する
+        - 再投入で失敗したバッチは 1 件ずつ書き込み直し、それでも失敗する item (制約違反・参照先の削除など) は
+          隔離ファイル (.dead) に移して残りの再投入を続ける。is_transient_error (既定: is_transient_db_error) のエラーの場合は次回に持ち越す
+        - プロセス終了時 (atexit) に残りを同期でフラッシュし、失敗した分は spool に退避する
+    item は JSON 化できる dict とし、flush_fn は再投入で同じ item が重複しても良いようにする
+    (bulk_create(ignore_conflicts=True) など)
+
+    メトリクス ({name}.*)
+        - enqueued / flushed / spooled / replayed / dead:  件数
+        - flush_sec / batch_size:                    1 回の書き込みの所要時間(秒) / 件数
+    """
+
+    def __init__(self,
+                 name:str,
+                 flush_fn:Callable[[List[Dict[str, Any]]], Any],
+                 max_batch:int            = 50,
+                 flush_interval_sec:float = 0.5,
+                 spool_dir:Optional[str]  = None,
+                 replay_interval_sec:int  = 30,
+                 stale_replay_sec:int     = 300,
+                 is_transient_error:Callable[[Exception], bool] = is_transient_db_error,):
+        self.name                = name
+        self.flush_fn            = flush_fn
+        self.max_batch           = max(max_batch, 1)
+        self.flush_interval_sec  = max(flush_interval_sec, 0.0)
+        self.spool_dir           = spool_dir
+        self.replay_interval_sec = replay_interval_sec
+        self.stale_replay_sec    = stale_replay_sec
+        self.is_transient_error  = is_transient_error
+
+        self._items:Deque[Dict[str, Any]] = deque()
+        self._lock          = threading.Lock() # spool ファイルへの追記用
+        self._event:Optional[asyncio.Event] = None
+        self._task:Optional[asyncio.Task]   = None
+        self._loop          = None
+        self._next_replay   = 0.0
+        _QUEUES.append(self)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    ####################
+    # 追加・フラッシュ
+    ####################
+    async def put(self, item:Dict[str, Any]) -> None:
+        """ item を積んで直ちに戻る (書き込みはバックグラウンドのタスクで行う) """
+        self._items.append(item)
+        incr_counter(f'{self.name}.enqueued')
+        self._ensure_task()
+        self._event.set()
+
+    def _ensure_task(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop  = loop
+        self._event = asyncio.Event()
+        self._task  = loop.create_task(self._run())
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        batch = []
+        while self._items and len(batch) < self.max_batch:
+            batch.append(self._items.popleft())
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            if not self._items:
+                self._event.clear()
+                await self._event.wait()
+            # サイズか時間のどちらかの条件を満たすまで待つ
+            deadline = time.monotonic() + self.flush_interval_sec
+            while len(self._items) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = self._take_batch()
+            if batch:
+                is_flushed = await database_sync_to_async(self._flush_batch)(batch)
+                if is_flushed and time.monotonic() >= self._next_replay:
+                    self._next_replay = time.monotonic() + self.replay_interval_sec
+                    await database_sync_to_async(self.replay_spool)()
+
+    def _flush_batch(self, batch:List[Dict[str, Any]]) -> bool:
+        """ flush_fn で書き込み、失敗した場合は spool に退避する (書き込めた場合 True) """
+        start = time.perf_counter()
+        try:
+            self.flush_fn(batch)
+        except Exception as e:
+            print(e)
+            self._spool(batch)
+            return False
+        observe(f'{self.name}.flush_sec', time.perf_counter() - start)
+        observe(f'{self.name}.batch_size', len(batch))
+        incr_counter(f'{self.name}.flushed', len(batch))
+        return True
+
+    def flush_now(self) -> None:
+        """ 残っている item を同期で全て書き込む (atexit 用) """
+        while self._items:
+            self._flush_batch(self._take_batch())
+
+    ####################
+    # spool
+    ####################
+    def _spool_path(self) -> str:
+        return os.path.join(self.spool_dir, f'{self.name}-{os.getpid()}.jsonl')
+
+    def _spool(self, batch:List[Dict[str, Any]]) -> None:
+        if not self.spool_dir:
+            print(f'{self.name}: spool_dir is not set, {len(batch)} items dropped')
+            return
+        lines = ''.join(json.dumps(item, ensure_ascii=False, default=str)+'\n' for item in batch)
+        path  = self._spool_path()
+        with self._lock:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            # 追記中に replay 側へ rename された場合は新しいファイルに書き直す
+            while True:
+                with open(path, 'a', encoding='utf-8') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        if os.path.exists(path) and os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                            f.write(lines)
+                            f.flush()
+                            os.fsync(f.fileno())
+                            break
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        incr_counter(f'{self.name}.spooled', len(batch))
+
+    def _claim_spool_files(self) -> List[str]:
+        """ 再投入する spool ファイルを rename で確保する (他プロセスと取り合っても 1 つだけが確保する) """
+        claimed = []
+        paths   = glob.glob(os.path.join(self.spool_dir, f'{self.name}-*.jsonl'))
+        # 再投入中に停止したプロセスの分
+        now     = time.time()
+        paths  += [path for path in glob.glob(os.path.join(self.spool_dir, f'{self.name}-*.replay'))
+                   if now - os.path.getmtime(path) > self.stale_replay_sec]
+        for path in paths:
+            claimed_path = os.path.join(self.spool_dir, f'{self.name}-{uuid.uuid4().hex}.replay')
+            try:
+                os.rename(path, claimed_path)
+            except OSError:
+                continue
+            claimed.append(claimed_path)
+        return claimed
+
+    def _write_spool_file(self, items:List[Dict[str, Any]], ext:str) -> None:
+        """ items を新しいファイル ({name}-*.{ext}) に書く (書き終えてから rename するため、書きかけを確保されない) """
+        path     = os.path.join(self.spool_dir, f'{self.name}-{uuid.uuid4().hex}.{ext}')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(item, ensure_ascii=False, default=str)+'\n' for item in items))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+
+    def _replay_items(self, items:List[Dict[str, Any]]):
+        """
+        items を max_batch 件ずつ書き込む。失敗したバッチは 1 件ずつ書き込み直す
+        Returns: (書き込めた件数, 書き込めない item のリスト, 次回に持ち越す item のリスト)
+        """
+        replayed, dead = 0, []
+        for i in range(0, len(items), self.max_batch):
+            batch = items[i:i+self.max_batch]
+            try:
+                self.flush_fn(batch)
+                replayed += len(batch)
+                continue
+            except Exception as e:
+                print(e)
+                if self.is_transient_error(e):
+                    return replayed, dead, items[i:]
+            for j, item in enumerate(batch):
+                try:
+                    self.flush_fn([item])
+                    replayed += 1
+                except Exception as e:
+                    print(e)
+                    if self.is_transient_error(e):
+                        return replayed, dead, batch[j:] + items[i+self.max_batch:]
+                    dead.append(item)
+        return replayed, dead, []
+
+    def replay_spool(self) -> int:
+        """ spool に退避した item を再投入する (再投入できた件数を返す) """
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return 0
+        replayed, dead_n = 0, 0
+        claimed = self._claim_spool_files()
+        for n, path in enumerate(claimed):
+            with open(path, 'r', encoding='utf-8') as f:
+                # rename 前から追記中の書き込みが終わるのを待つ
+                fcntl.flock(f, fcntl.LOCK_EX)
+                items = [json.loads(line) for line in f if line.strip()]
+                fcntl.flock(f, fcntl.LOCK_UN)
+            file_replayed, dead, remaining = self._replay_items(items)
+            replayed += file_replayed
+            if dead:
+                # 隔離 (再投入しない)
+                self._write_spool_file(dead, 'dead')
+                dead_n += len(dead)
+            if remaining:
+                # DB に接続できないなど: 残りを次回に持ち越し、確保した他のファイルも戻す
+                self._write_spool_file(remaining, 'jsonl')
+                os.remove(path)
+                for other_path in claimed[n+1:]:
+                    os.rename(other_path, os.path.join(self.spool_dir, f'{self.name}-{uuid.uuid4().hex}.jsonl'))
+                break
+            os.remove(path)
+        if replayed:
+            incr_counter(f'{self.name}.replayed', replayed)
+        if dead_n:
+            incr_counter(f'{self.name}.dead', dead_n)
+        return replayed
+
+
+@atexit.register
+def _flush_all_queues() -> None:
+    for queue in _QUEUES:
+        try:
+            queue.flush_now()
+        except Exception as e:
+            print(e)
\ No newline at end of file
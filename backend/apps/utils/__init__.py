@@ -1 +1,31 @@
-from .WebsocketUtils import sync_get_user_obj
\ No newline at end of file
+from .WebsocketUtils import sync_get_user_obj
+from .StreamUtils import (
+    StreamCoalescer, coalesce_stream, sanitize_stream, iter_text,
+    split_sentences, split_sentence_stream,
+)
+from .RedisUtils import get_async_redis_client, get_redis_client
+from .RateLimitUtils import (
+    LocalTokenBucketLimiter, RedisTokenBucketLimiter,
+    get_socket_rate_limiter,
+)
+from .SessionLimitUtils import (
+    LocalSessionLimiter, RedisSessionLimiter,
+    get_session_limiter,
+)
+from .PresenceUtils import RoomPresence
+from .CacheUtils import VersionedReadThroughCache
+from .HistoryUtils import RoomHistoryBuffer
+from .DeliveryUtils import DirectDelivery
+from .WriteBehindUtils import WriteBehindQueue
+from .ResponseCacheUtils import LlmResponseCache
+from .TtsCacheUtils import TtsAudioCache
+from .SchedulerUtils import (
+    LocalLlmBudget, RedisLlmBudget, LlmScheduler, LlmQueueTimeout,
+    get_llm_scheduler,
+)
+from .LlmRouteUtils import get_llm_router
+from .FrameUtils import encode_frame, encode_audio_frame, decode_audio_frame
+from .CodecUtils import (
+    CODEC_JSON, CODEC_ORJSON, CODEC_MSGPACK,
+    SocketCodec, negotiate_codec,
+)
\ No newline at end of file
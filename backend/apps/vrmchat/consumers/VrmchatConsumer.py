@@ -1,20 +1,42 @@
 from channels.db import database_sync_to_async
 from channels.exceptions import StopConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 import asyncio
-import brotli
-import json
+import time
+from typing import Optional
 from api.utils import jwt_auth_get_id
 from common.scripts.DjangoUtils import generate_uuid_hex
-from common.scripts.LlmUtils import create_messages, calc_token, is_tokens_less_than_settings
-from common.scripts.LlmUtils.llms import OpenAILlm, GcloudLlm
-from apps.utils import sync_get_user_obj
+from common.scripts.LlmUtils import create_messages, calc_token, pack_context, text_modify_fnc
+from common.scripts.PythonCodeUtils import observe
+from apps.utils import (
+    sync_get_user_obj,
+    get_socket_rate_limiter,
+    RoomPresence,
+    DirectDelivery,
+    SocketCodec, negotiate_codec,
+    LlmResponseCache,
+    get_llm_scheduler, LlmQueueTimeout,
+    get_llm_router,
+    sanitize_stream, iter_text, split_sentence_stream, encode_audio_frame,
+)
+from apps.third_party.gcloud.stt_tts.utils import synthesize_speech
 from ..settings import (
-    SOCKET_REQUEST_PER_SEC_LIMIT, SOCKET_REXEIVE_DATA_KB_LIMIT,
-    SEND_MAX_TOKENS,
+    SOCKET_REQUEST_PER_SEC_LIMIT, SOCKET_RATE_LIMITER_BACKEND, SOCKET_REXEIVE_DATA_KB_LIMIT,
+    SOCKET_RECEIVE_QUEUE_SIZE,
+    PRESENCE_TTL_SEC, PRESENCE_HEARTBEAT_SEC, IS_SAVE_SOCKET_ACCESS_LOG,
+    IS_DIRECT_DELIVERY,
+    FRAME_COMPRESS_MIN_BYTES, FRAME_COMPRESS_QUALITY,
+    SEND_MAX_TOKENS_DICT, DEFAULT_SEND_MAX_TOKENS, RETRY_LIMIT_N,
+    ALLOWD_DOMAINS_LIST,
+    IS_RESPONSE_CACHE, RESPONSE_CACHE_MAX_TEMPERATURE, RESPONSE_CACHE_SEC, RESPONSE_CACHE_MAX_ENTRIES,
+    LLM_SCHEDULER_BACKEND, LLM_SCHEDULER_LIMITS_DICT, DEFAULT_LLM_SCHEDULER_LIMITS,
+    LLM_QUEUE_TIMEOUT_SEC, LLM_SCHEDULER_POLL_SEC, LLM_SLOT_LEASE_SEC,
+    LLM_ROUTES_DICT,
+    LLM_FIRST_TOKEN_TIMEOUT_SEC, LLM_RESPONSE_TIMEOUT_SEC, LLM_RETRY_BACKOFF_BASE_SEC, LLM_RETRY_BACKOFF_MAX_SEC,
+    LLM_HEDGE_AFTER_SEC, LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SEC,
+    IS_TTS_PIPELINE, TTS_PIPELINE_MAX_CHARS, TTS_PIPELINE_CONCURRENCY,
 )
 from ..models import (
     Room, SocketAccess,
@@ -22,8 +44,8 @@ from ..models import (
 )
 from ..utils import (
     sync_get_room_obj,
-    get_room_settings, get_history,
-    sync_save_message_models,
+    get_room_settings, get_history_turns, turns_to_history,
+    save_message_models,
     replace_room_name_check,
     base_prompt,
 )
@@ -31,6 +53,20 @@ from ..utils import (
 
 MODEL_NAME_CHOICES_DICT = dict(MODEL_NAME_CHOICES())
 
+# LLM の回答のキャッシュ (opt-in)
+llm_response_cache = LlmResponseCache(
+                            namespace       = 'vrmchat.llm_response_cache',
+                            ttl_sec         = RESPONSE_CACHE_SEC,
+                            max_entries     = RESPONSE_CACHE_MAX_ENTRIES,
+                            max_temperature = RESPONSE_CACHE_MAX_TEMPERATURE,
+                            is_enabled      = IS_RESPONSE_CACHE,)
+
+# 上流 LLM の呼び出しのスケジューラ (モデルごとの同時実行数 / TPM、ユーザごとの公平キュー)
+llm_scheduler = get_llm_scheduler(backend           = LLM_SCHEDULER_BACKEND,
+                                  poll_interval_sec = LLM_SCHEDULER_POLL_SEC,
+                                  lease_ttl_sec     = LLM_SLOT_LEASE_SEC,
+                                  queue_timeout_sec = LLM_QUEUE_TIMEOUT_SEC,)
+
 
 class VrmchatConsumer(AsyncWebsocketConsumer):
 
@@ -61,20 +97,62 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
             raise StopConsumer()
         # アクセス制御 △
 
+        # 流量制限 (接続ごとに channel_name をキーにする)
+        self.rate_limiter = get_socket_rate_limiter(namespace    = 'vrmchat',
+                                                    rate_per_sec = SOCKET_REQUEST_PER_SEC_LIMIT,
+                                                    backend      = SOCKET_RATE_LIMITER_BACKEND,)
+
+        # 送受信のコーデック (サブプロトコル or ?codec= で指定、無ければ json)
+        codec, subprotocol = negotiate_codec(self.scope)
+        self.codec = SocketCodec(codec              = codec,
+                                 compress_min_bytes = FRAME_COMPRESS_MIN_BYTES,
+                                 quality            = FRAME_COMPRESS_QUALITY,
+                                 metrics_tags       = {'app': 'vrmchat'},)
+
+        # 同一プロセス内の接続へは channel layer を経由せずに送信する
+        self.delivery = DirectDelivery(self, self.group_name, is_enabled=IS_DIRECT_DELIVERY)
+        self.delivery.register()
+
         # connect: group_name
         await self.channel_layer.group_add(self.group_name,
                                            self.channel_name,)
-        await self.accept()
+        await self.accept(subprotocol=subprotocol)
+
+        # 接続者情報 (presence) の初期化
+        self.access_id       = generate_uuid_hex()
+        self.user_name       = '*'+self.access_id[:5].upper()
+        self.presence        = RoomPresence(namespace='vrmchat', ttl_sec=PRESENCE_TTL_SEC)
+        self.heartbeat_task  = None
+        self.is_disconnected = False
+
+        # 受信キュー (接続ごとに上限あり) と生成スロット (接続ごとに 1 つ)
+        self.receive_queue         = asyncio.Queue(maxsize=SOCKET_RECEIVE_QUEUE_SIZE)
+        self.receive_worker        = asyncio.create_task(self._receive_worker())
+        self.generation_task       = None
+        self.generation_message_id = None
+
+        # 回答を文ごとに TTS に送るパイプライン (SendUserMessage の data.isTts)
+        self.tts_semaphore = asyncio.Semaphore(TTS_PIPELINE_CONCURRENCY)
+        self.tts_counter   = 0  # tts_id の連番 (音声のフレームのヘッダ)
+
         asyncio.create_task(self._handle_connect(self.room_id,
                                                  self.channel_name,
                                                  self.connect_user,))
 
     async def disconnect(self, close_code):
         try:
+            self.delivery.unregister()
             # disconnect: group_name
             await self.channel_layer.group_discard(self.group_name,
                                                    self.channel_name,)
-            asyncio.create_task(self._handle_disconnect(self.room_id, self.channel_name,))
+            self.is_disconnected = True
+            if self.heartbeat_task:
+                self.heartbeat_task.cancel()
+            # 受信キューの処理と生成中の LLM リクエストを止める (プロバイダとの接続も閉じる)
+            self.receive_worker.cancel()
+            await self._stop_generation(is_send_complete=False)
+            asyncio.create_task(self._handle_disconnect(self.room_id, self.access_id,))
+            await self.rate_limiter.discard(self.channel_name)
         except Exception as e:
             print(e)
             pass
@@ -84,39 +162,38 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
             raise StopConsumer()
 
     async def receive(self, text_data=None, bytes_data=None):
-        asyncio.create_task(self._handle_receive(text_data, bytes_data))
+        # ping はタスクを作らずにその場で処理する (何も返さない)
+        if self.codec.is_ping(text_data, bytes_data):
+            return
+        # それ以外は受信キューに積む (溢れた場合は流量超過として切断を促す)
+        try:
+            self.receive_queue.put_nowait((text_data, bytes_data))
+        except asyncio.QueueFull:
+            message_data = {
+                'cmd':     'wsClose',
+                'status':  200,
+                'ok':      True,
+                'message': None,
+                'data':    None,
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=False)
+
+    async def _receive_worker(self):
+        # 受信キューを 1 件ずつ処理する (LLM の生成は generation_task で並行して行う)
+        while True:
+            text_data, bytes_data = await self.receive_queue.get()
+            # 1 件の失敗で接続の受信処理全体を止めない
+            try:
+                await self._handle_receive(text_data, bytes_data)
+            except Exception as e:
+                print(e)
 
     # ------------------------------
     # safety
-    @database_sync_to_async
-    def _request_count_and_check_socket_access(self, access_id:str):
-        # 短期間のリクエストを遮断する
+    async def _check_request_rate(self) -> bool:
+        # 短期間のリクエストを遮断する (token bucket: DB アクセスなし)
         try:
-            check_result = True
-
-            socket_access_obj = SocketAccess.objects.filter(access_id = access_id).first()
-            now_utc_sec       = int(timezone.now().timestamp())
-            # socket_access_obj が作成されていなければ一旦Trueする
-            if socket_access_obj:
-                date_access_sec       = int(socket_access_obj.date_access.timestamp())
-                date_last_request_sec = int(socket_access_obj.date_last_request.timestamp())
-
-                # アクセスの2秒後からチェックを開始する
-                if now_utc_sec - date_access_sec >= 2:
-                    # 1秒間のアクセスをカウントする
-                    if now_utc_sec - date_last_request_sec < 1:
-                        request_count = socket_access_obj.request_count + 1
-                    else:
-                        request_count = 1
-                        socket_access_obj.date_last_request = timezone.now()
-                    socket_access_obj.request_count = request_count
-                    socket_access_obj.save()
-                    
-                    # 規定回数を超えたらアクセスを遮断
-                    if request_count > SOCKET_REQUEST_PER_SEC_LIMIT:
-                        check_result = False
-
-            return check_result
+            return await self.rate_limiter.allow(self.channel_name)
         except Exception as e:
             print(e)
             return False
@@ -152,36 +229,98 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                               room_id:str,
                               channel_name:str,
                               connect_user,):
-        await asyncio.sleep(0.5)  # 非同期の待機処理
         try:
-            status_code, return_data, return_user_data = await self._create_socket_access(room_id, channel_name, connect_user)
+            stale_members = await self.presence.join(room_id      = room_id,
+                                                     access_id    = self.access_id,
+                                                     user_name    = self.user_name,
+                                                     channel_name = channel_name,
+                                                     joined_at    = timezone.now().timestamp(),)
+            members       = await self.presence.members(room_id)
+            status_code   = 200
+            # メンバーが確定してから直接送信を有効にする
+            await self._refresh_delivery_members(room_id)
         except Exception as e:
             print(e)
-            status_code      = 500
-            return_data      = None
-            return_user_data = None
-        
-        # ユーザ自身の return_user_data はユーザにのみ通知
+            status_code   = 500
+            stale_members = []
+            members       = None
+
+        # ユーザ自身の access_id と現在のメンバー一覧はユーザにのみ通知
         message_data = {
             'cmd':     'SetUserAccessId',
             'status':  status_code,
             'ok':      True if status_code == 200 else False,
             'message': None,
-            'data':    return_user_data,
+            'data':    {
+                'access_id':          self.access_id,
+                'user_name':          self.user_name,
+                'socket_access_objs': members,
+            } if status_code == 200 else None,
         }
         if status_code == 200:
             await self._self_send_message(message_data, is_send_bytes_data=False)
 
-        # group_send_message
+            # group_send_message (差分のみ通知)
+            await self._group_send_presence_delta('SocketConnect', {
+                'access_id': self.access_id,
+                'user_name': self.user_name,
+            })
+            for stale_member in stale_members:
+                await self._group_send_presence_delta('SocketDisconnect', stale_member)
+
+            # 接続処理中に切断されていた場合は heartbeat を開始しない
+            if not self.is_disconnected:
+                self.heartbeat_task = asyncio.create_task(self._presence_heartbeat(room_id))
+
+            # DB への接続記録 (監査用: 任意)
+            if IS_SAVE_SOCKET_ACCESS_LOG:
+                asyncio.create_task(self._create_socket_access(room_id, channel_name, connect_user))
+        return None
+
+    async def _presence_heartbeat(self, room_id:str):
+        # PRESENCE_HEARTBEAT_SEC ごとに生存期限を延長し、期限切れメンバーの離脱を通知する
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_SEC)
+            try:
+                is_alive, stale_members = await self.presence.heartbeat(room_id, self.access_id)
+                if not is_alive:
+                    # 他ワーカーに期限切れとして除去されていた場合は再登録する
+                    stale_members += await self.presence.join(room_id      = room_id,
+                                                              access_id    = self.access_id,
+                                                              user_name    = self.user_name,
+                                                              channel_name = self.channel_name,
+                                                              joined_at    = timezone.now().timestamp(),)
+                    await self._group_send_presence_delta('SocketConnect', {
+                        'access_id': self.access_id,
+                        'user_name': self.user_name,
+                    })
+                for stale_member in stale_members:
+                    await self._group_send_presence_delta('SocketDisconnect', stale_member)
+                await self._refresh_delivery_members(room_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(e)
+
+    async def _refresh_delivery_members(self, room_id:str):
+        # 他プロセスのメンバー (channel layer で送信する先) を presence から更新する
+        if self.is_disconnected:
+            return None
+        try:
+            self.delivery.update_members(await self.presence.channel_names(room_id))
+        except Exception as e:
+            print(e)
+        return None
+
+    async def _group_send_presence_delta(self, cmd:str, member:dict):
         message_data = {
-            'cmd':     'SocketConnect',
-            'status':  status_code,
-            'ok':      True if status_code == 200 else False,
+            'cmd':     cmd,
+            'status':  200,
+            'ok':      True,
             'message': None,
-            'data':    return_data,
+            'data':    member,
         }
-        if status_code == 200:
-            await self._group_send_message(message_data, is_send_bytes_data=False)
+        await self._group_send_message(message_data, is_send_bytes_data=False)
         return None
 
     @database_sync_to_async
@@ -190,80 +329,39 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                               channel_name:str,
                               connect_user,):
         try:
-            room_obj = Room.objects.get(room_id=room_id)
-            # Create SocketAccess
-            access_id = generate_uuid_hex()
-            user_name = '*'+access_id[:5].upper()
-            _ = SocketAccess.objects.create(room_id          = room_obj,
-                                            access_id         = access_id,
-                                            user              = None if connect_user.is_anonymous else connect_user,
-                                            user_name         = user_name,
-                                            channel_name      = channel_name,
-                                            date_last_request = timezone.now(),
-                                            date_access       = timezone.now(),)
-            # GET SocketAccess data
-            socket_access_objs = SocketAccess.objects.filter(room_id = room_obj).order_by('pk')\
-                                                     .values('access_id', 'user_name')
-            return_data = {
-                'socket_access_objs': list(socket_access_objs),
-            }
-            return_user_data = {
-                'access_id': access_id,
-                'user_name': user_name,
-            }
-            return 200, return_data, return_user_data
+            SocketAccess.objects.create(room_id           = Room.objects.get(room_id=room_id),
+                                        access_id         = self.access_id,
+                                        user              = None if connect_user.is_anonymous else connect_user,
+                                        user_name         = self.user_name,
+                                        channel_name      = channel_name,
+                                        date_last_request = timezone.now(),
+                                        date_access       = timezone.now(),)
         except Exception as e:
             print(e)
-            return 500, None, None
+        return None
 
     # ------------------------------
     # disconnect
-    async def _handle_disconnect(self, room_id:str, channel_name:str):
-        await asyncio.sleep(1)  # 非同期の待機処理
+    async def _handle_disconnect(self, room_id:str, access_id:str):
         try:
-            status_code, return_data = await self._delete_socket_access(room_id, channel_name)
+            is_removed = await self.presence.leave(room_id, access_id)
         except Exception as e:
             print(e)
-            status_code = 500
-            return_data = None
+            is_removed = False
 
-        # group_send_message
-        message_data = {
-            'cmd':     'SocketDisconnect',
-            'status':  status_code,
-            'ok':      True if status_code == 200 else False,
-            'message': None,
-            'data':    return_data,
-        }
-        if status_code == 200:
-            await self._group_send_message(message_data, is_send_bytes_data=False)
+        # group_send_message (差分のみ通知)
+        if is_removed:
+            await self._group_send_presence_delta('SocketDisconnect', {
+                'access_id': access_id,
+                'user_name': self.user_name,
+            })
         return None
 
-    @database_sync_to_async
-    def _delete_socket_access(self, room_id:str, channel_name:str):
-        try:
-            # Derete SocketAccess
-            try:
-                socket_access_obj = SocketAccess.objects.get(channel_name = channel_name)
-                socket_access_obj.delete()
-            except Exception as e:
-                # 既にレコードが削除済みなどもありえるので無視
-                pass
-
-            # GET SocketAccess data
-            socket_access_objs = SocketAccess.objects.filter(room_id__room_id = room_id).order_by('pk')\
-                                                     .values('access_id', 'user_name')
-            return_data = {
-                'socket_access_objs': list(socket_access_objs),
-            }
-            return 200, return_data
-        except Exception as e:
-            print(e)
-            return 500, None
-
     # ------------------------------
     # receive
     async def _handle_receive(self, text_data=None, bytes_data=None):
+        # サイズ超過 / 空のデータで wsClose / Error を返す時にも使う
+        is_possible_compress = bool(bytes_data)
         try:
             if text_data:
                 check_result = await self._check_text_data_byte(text_data)
@@ -278,25 +376,25 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                 is_possible_compress = False
                 try:
                     if text_data:
-                        data_json = json.loads(text_data) if text_data else None
-                        # ping は何も返さない
-                        if data_json['cmd'] == 'ping':
-                            return
-                        # Reconnect はユーザにのみ通知
-                        elif data_json['cmd'] == 'Reconnect':
-                            message_data = {
-                                'cmd':     'Reconnect',
-                                'status':  200,
-                                'ok':      True,
-                                'message': None,
-                                'data':    None,
-                            }
-                            return await self._self_send_message(message_data, is_send_bytes_data=False)
+                        data_json = self.codec.decode_text(text_data) if text_data else None
                     elif bytes_data:
-                        data_json = json.loads(brotli.decompress(bytes_data).decode('utf-8')) if bytes_data else None
+                        data_json = self.codec.decode_bytes(bytes_data) if bytes_data else None
                         is_possible_compress = True
                     else:
                         data_json = None
+                    # ping は何も返さない
+                    if data_json and data_json['cmd'] == 'ping':
+                        return
+                    # Reconnect はユーザにのみ通知
+                    elif data_json and data_json['cmd'] == 'Reconnect':
+                        message_data = {
+                            'cmd':     'Reconnect',
+                            'status':  200,
+                            'ok':      True,
+                            'message': None,
+                            'data':    None,
+                        }
+                        return await self._self_send_message(message_data, is_send_bytes_data=False)
                 except Exception as e:
                     print(e)
                     data_json = None
@@ -304,15 +402,19 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
 
                 if data_json:                    
                     # 短期間のリクエストを遮断する
-                    check_result = await self._request_count_and_check_socket_access(data_json['request_user_access_id'])
+                    check_result = await self._check_request_rate()
 
                     if check_result:
                         # -------------------------
                         # メイン処理(cmd分岐) ▽
                         if data_json['cmd'] == 'SendUserMessage':
-                            await self._receive_user_message(data_json['data']['message'],
-                                                             None,
-                                                             is_possible_compress)
+                            await self._start_generation(data_json['data']['message'],
+                                                         None,
+                                                         is_possible_compress,
+                                                         is_tts_pipeline = IS_TTS_PIPELINE and bool(data_json['data'].get('isTts')),)
+                        elif data_json['cmd'] == 'StopGeneration':
+                            await self._stop_generation((data_json.get('data') or {}).get('messageId'),
+                                                        is_send_bytes_data = is_possible_compress,)
                         # ... 他のコマンドあればここで分岐処理させる
                         # メイン処理(cmd分岐) △
                         # -------------------------
@@ -356,11 +458,67 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
             await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
         return None
 
+    ####################
+    # _start_generation / _stop_generation
+    # - 生成 (_receive_user_message) は 1 接続につき 1 つまで
+    ####################
+    async def _start_generation(self,
+                                user_message:str,
+                                message_id:Optional[str],
+                                is_possible_compress:bool,
+                                is_tts_pipeline:bool = False,):
+        if self.generation_task is not None and not self.generation_task.done():
+            message_data = {
+                'cmd':  'SendUserMessage',
+                'status': 200,
+                'ok':     True,
+                'data': {
+                    'messageId':   message_id or generate_uuid_hex(),
+                    'llmResponse': '',
+                },
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
+            return None
+        self.generation_message_id = message_id
+        self.generation_task       = asyncio.create_task(self._receive_user_message(user_message,
+                                                                                    message_id,
+                                                                                    is_possible_compress,
+                                                                                    is_tts_pipeline,))
+        return None
+
+    async def _stop_generation(self,
+                               message_id:Optional[str] = None,
+                               is_send_bytes_data:bool  = True,
+                               is_send_complete:bool    = True,):
+        if self.generation_task is None or self.generation_task.done():
+            return None
+        if message_id and self.generation_message_id and message_id != self.generation_message_id:
+            return None
+        # LLM のリクエストごと取り消す (空の回答を返して終了させる)
+        self.generation_task.cancel()
+        if is_send_complete:
+            message_data = {
+                'cmd':  'SendUserMessage',
+                'status': 200,
+                'ok':     True,
+                'data': {
+                    'messageId':   message_id or self.generation_message_id or generate_uuid_hex(),
+                    'llmResponse': '',
+                },
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=is_send_bytes_data)
+        return None
+
     ####################
     # _receive_user_message ▽
     ####################
-    async def _receive_user_message(self, user_message:str, message_id:str, is_possible_compress:bool):
+    async def _receive_user_message(self,
+                                    user_message:str,
+                                    message_id:str,
+                                    is_possible_compress:bool,
+                                    is_tts_pipeline:bool = False,):
 
+        start_time = time.perf_counter()
         try:
             # RoomSettings の取得
             data_dict = await get_room_settings(self.room_id)
@@ -376,9 +534,19 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                 data_dict['message_id'] = generate_uuid_hex()
 
             # ルームに紐づくヒストリーメッセージ時の取得▽
-            history_list, history_text = await get_history(self.room_id, data_dict['history_len'])
-            data_dict['history_list'] = history_list
-            data_dict['history_text'] = history_text
+            # - 送信できる最大トークン - max_tokens - ルーム設定 に、ユーザメッセージと一緒に収まる直近のヒストリーだけ使う
+            # - ユーザメッセージだけで収まらない場合は history_n が None
+            send_max_tokens = SEND_MAX_TOKENS_DICT.get(model_name_int, DEFAULT_SEND_MAX_TOKENS)
+            settings_tokens = data_dict.pop('system_sentence_tokens') + data_dict.pop('assistant_sentence_tokens')
+            history_turns   = await get_history_turns(self.room_id, data_dict['history_len'])
+            history_n       = pack_context(sentence       = data_dict['user_message'],
+                                           turn_tokens    = [turn['tokens'] for turn in history_turns],
+                                           context_tokens = send_max_tokens,
+                                           max_tokens     = data_dict['max_tokens'],
+                                           base_tokens    = settings_tokens,)
+            history_list, history_tokens = turns_to_history(history_turns[len(history_turns)-(history_n or 0):])
+            data_dict['history_list']   = history_list
+            data_dict['history_tokens'] = history_tokens
             # ルームに紐づくヒストリーメッセージ時の取得△
 
             # 入力のバリデーション▽
@@ -397,13 +565,8 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                 await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
             ## 何も質問されてないときに返すテキスト△
             ## メッセージのトークンが設定値を超えた場合の処理▽
-            elif not is_tokens_less_than_settings(
-                        sentence   = data_dict['user_message']+ \
-                                    data_dict['system_sentence'] if data_dict['system_sentence'] else ''+ \
-                                    data_dict['assistant_sentence'] if data_dict['assistant_sentence'] else ''+ \
-                                    data_dict['history_text'] if data_dict['history_text'] else '',
-                        max_tokens = int(SEND_MAX_TOKENS)):
-                error_message = f'入力文字数が設定値を超えたみたいです。\n過去の会話、システムメッセージなども含めて最大トークンは{SEND_MAX_TOKENS}に設定されています。'
+            elif history_n is None:
+                error_message = f'入力文字数が設定値を超えたみたいです。\nシステムメッセージ、回答の最大トークン数なども含めて最大トークンは{send_max_tokens}に設定されています。'
                 message_data = {
                     'cmd':  'SendUserMessage',
                     'status': 200,
@@ -428,25 +591,62 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                                         data_dict['assistant_sentence'],
                                         data_dict['history_list'])
                 # llm
-                # model_name_int の大きさで切り替え
-                if model_name_int < 100:
-                    llm = OpenAILlm(api_key           = settings.OPENAI_API_KEY,
-                                    model_name        = data_dict['model_name'],
-                                    temperature       = data_dict['temperature'],
-                                    max_tokens        = data_dict['max_tokens'],
-                                    top_p             = data_dict['top_p'],
-                                    frequency_penalty = data_dict['frequency_penalty'],
-                                    presence_penalty  = data_dict['presence_penalty'],)
-                elif 100 <= model_name_int:
-                    llm = GcloudLlm(project_name      = settings.GCLOUD_PROJECT_NAME,
-                                    location_name     = settings.GCLOUD_LOCATION_NAME,
-                                    model_name        = data_dict['model_name'],
-                                    temperature       = data_dict['temperature'],
-                                    max_tokens        = data_dict['max_tokens'],
-                                    top_p             = data_dict['top_p'],
-                                    frequency_penalty = data_dict['frequency_penalty'],
-                                    presence_penalty  = data_dict['presence_penalty'],)
-                llm_response = await llm.async_get_response(messages)
+                # model_name_int の大きさで primary のプロバイダを切り替え、障害・遅延時は LLM_ROUTES_DICT の候補へ切り替える
+                # - クライアント (接続プール) はプロセス内で使い回し、生成パラメータは呼び出し時に渡す
+                llm = get_llm_router(model_name                = data_dict['model_name'],
+                                     primary_provider          = 'openai' if model_name_int < 100 else 'gcloud',
+                                     route_dict                = LLM_ROUTES_DICT.get(model_name_int),
+                                     retry_limit_n             = RETRY_LIMIT_N,
+                                     first_token_timeout_sec   = LLM_FIRST_TOKEN_TIMEOUT_SEC,
+                                     response_timeout_sec      = LLM_RESPONSE_TIMEOUT_SEC,
+                                     backoff_base_sec          = LLM_RETRY_BACKOFF_BASE_SEC,
+                                     backoff_max_sec           = LLM_RETRY_BACKOFF_MAX_SEC,
+                                     hedge_after_sec           = LLM_HEDGE_AFTER_SEC,
+                                     circuit_failure_threshold = LLM_CIRCUIT_FAILURE_THRESHOLD,
+                                     circuit_reset_sec         = LLM_CIRCUIT_RESET_SEC,)
+                generation_params = {
+                    'model_name':        data_dict['model_name'],
+                    'temperature':       data_dict['temperature'],
+                    'max_tokens':        data_dict['max_tokens'],
+                    'top_p':             data_dict['top_p'],
+                    'frequency_penalty': data_dict['frequency_penalty'],
+                    'presence_penalty':  data_dict['presence_penalty'],
+                }
+                # 保存済みのトークン数と同じ DEFAULT_ENCODING_NAME で数える
+                sent_tokens = settings_tokens + history_tokens + calc_token(sentence = data_dict['user_message'],)
+                # 回答のキャッシュ (opt-in)
+                response_cache_key = llm_response_cache.build_key(messages, generation_params)
+                cached_response    = await llm_response_cache.aget(response_cache_key) if response_cache_key else None
+                if is_tts_pipeline:
+                    # 回答をストリーミングで受け取り、文ごとに TTS に送って文と音声を順に送る
+                    if cached_response is not None:
+                        llm_stream = iter_text(cached_response, chunk_size=TTS_PIPELINE_MAX_CHARS)
+                    else:
+                        # 上流の呼び出しはスケジューラでスロットを確保してから行う
+                        # (LLM のストリームの終了で解放し、残りの文の TTS はスロットの外で行う)
+                        llm_stream = self._slot_stream(self._llm_slot(model_name_int, data_dict, sent_tokens, is_possible_compress),
+                                                       llm.async_get_stream_response(messages, **generation_params),
+                                                       sent_tokens,)
+                        if response_cache_key:
+                            llm_stream = llm_response_cache.record_stream(response_cache_key, llm_stream)
+                    # 送信前に ALLOWD_DOMAINS_LIST 以外の URL を削除する (キャッシュには処理前の回答を保存する)
+                    llm_stream   = sanitize_stream(llm_stream, ALLOWD_DOMAINS_LIST)
+                    llm_response = await self._stream_tts_pipeline(llm_stream,
+                                                                   data_dict['message_id'],
+                                                                   start_time,
+                                                                   is_send_bytes_data = is_possible_compress,)
+                else:
+                    if cached_response is not None:
+                        llm_response = cached_response
+                    else:
+                        # 上流の呼び出しはスケジューラでスロットを確保してから行う
+                        async with self._llm_slot(model_name_int, data_dict, sent_tokens, is_possible_compress) as llm_slot:
+                            llm_response = await llm.async_get_response(messages, **generation_params)
+                            llm_slot.commit(sent_tokens + calc_token(sentence = llm_response,))
+                        if response_cache_key:
+                            await llm_response_cache.aset(response_cache_key, llm_response)
+                    # 送信前に ALLOWD_DOMAINS_LIST 以外の URL を削除する
+                    llm_response = text_modify_fnc(llm_response, ALLOWD_DOMAINS_LIST)
                 message_data = {
                     'cmd':  'SendUserMessage',
                     'status': 200,
@@ -457,21 +657,21 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                     },
                 }
                 await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
+                observe('vrmchat.response_sec', time.perf_counter() - start_time,
+                        tags={'tts_pipeline': 'on' if is_tts_pipeline else 'off'})
 
                 # 結果の処理
                 data_dict['llm_response'] = llm_response
                 tokens_info_dict = {
-                    'sent_tokens': calc_token(sentence = data_dict['user_message']+ \
-                                                        data_dict['system_sentence'] if data_dict['system_sentence'] else ''+ \
-                                                        data_dict['assistant_sentence'] if data_dict['assistant_sentence'] else ''+ \
-                                                        data_dict['history_text'] if data_dict['history_text'] else '',
-                                            model_name = data_dict['model_name']),
+                    'sent_tokens':      sent_tokens,
                     'generated_tokens': calc_token(sentence = data_dict['llm_response'],),
                 }
+                if response_cache_key:
+                    tokens_info_dict['response_cache'] = 'hit' if cached_response is not None else 'miss'
                 data_dict['tokens_info_dict'] = tokens_info_dict
                 
                 # メッセージの保存
-                await sync_save_message_models(self.room_id, data_dict)
+                await save_message_models(self.room_id, data_dict)
 
                 # ルーム名チェック
                 is_replace, room_name = await replace_room_name_check(self.room_id, data_dict['user_message'])
@@ -485,6 +685,19 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                         },
                     }
                     await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
+        except LlmQueueTimeout as e:
+            print(e)
+            error_message = '混み合っているため回答を生成できませんでした。しばらくしてから再度送信してください。'
+            message_data  = {
+                'cmd':  'SendUserMessage',
+                'status': 200,
+                'ok':     True,
+                'data': {
+                    'messageId':   data_dict['message_id'],
+                    'llmResponse': error_message,
+                },
+            }
+            await self._self_send_message(message_data, is_send_bytes_data=is_possible_compress)
         except Exception as e:
             print(e)
             message_data = {
@@ -500,6 +713,165 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
     # _receive_user_message △
     ####################
 
+    ####################
+    # _stream_tts_pipeline
+    # - 回答 (llm_stream) を文ごとに TTS に送り、文と音声を順に自身にのみ送る (回答の完了を待たずにアバターが話し始める)
+    #   1. {'cmd': 'TtsStart', 'data': {'messageId', 'ttsId'}}
+    #   2. 文ごとに {'cmd': 'TtsSentence', 'data': {'messageId', 'ttsId', 'seq', 'text'}} と
+    #      音声のバイナリフレーム encode_audio_frame(ttsId, seq, False, 音声) (合成に失敗した文は空の音声)
+    #   3. 最後に空の音声のバイナリフレーム encode_audio_frame(ttsId, 文の数, True, b'')
+    #   (文と音声の順序を保つため、どちらも channel layer を経由せずに送る)
+    # - LLM の生成中も確定した文から TTS_PIPELINE_CONCURRENCY 並列で合成する
+    # - 最初の音声を送るまでの時間 (メッセージの受信から) を vrmchat.tts_first_audio_sec に記録する
+    ####################
+    async def _stream_tts_pipeline(self,
+                                   llm_stream,
+                                   message_id:str,
+                                   start_time:float,
+                                   is_send_bytes_data:bool = True,) -> str:
+        tts_id           = self.tts_counter
+        self.tts_counter = (self.tts_counter + 1) % 2**32
+        message_data = {
+            'cmd':   'TtsStart',
+            'status': 200,
+            'ok':     True,
+            'data': {
+                'messageId': message_id,
+                'ttsId':     tts_id,
+            },
+        }
+        await self.send(**self.codec.encode(message_data, is_send_bytes_data=is_send_bytes_data))
+
+        async def _synthesize(sentence:str) -> bytes:
+            async with self.tts_semaphore:
+                try:
+                    return await synthesize_speech(sentence)
+                except Exception as e:
+                    # 音声が無くても文は送る
+                    print(e)
+                    return b''
+
+        # 保存・送信する全文 (split_sentence_stream で除かれる文間の空白・改行も含める)
+        texts = []
+        async def _record():
+            try:
+                async for delta in llm_stream:
+                    texts.append(delta)
+                    yield delta
+            finally:
+                await llm_stream.aclose()
+
+        queue = asyncio.Queue()
+        async def _produce():
+            # 文が確定するたびに合成を始める
+            try:
+                async for sentence in split_sentence_stream(_record(), TTS_PIPELINE_MAX_CHARS):
+                    queue.put_nowait((sentence, asyncio.ensure_future(_synthesize(sentence))))
+            finally:
+                queue.put_nowait(None)
+
+        producer  = asyncio.ensure_future(_produce())
+        tasks     = []
+        sentences = []
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                sentence, task = item
+                tasks.append(task)
+                message_data = {
+                    'cmd':   'TtsSentence',
+                    'status': 200,
+                    'ok':     True,
+                    'data': {
+                        'messageId': message_id,
+                        'ttsId':     tts_id,
+                        'seq':       len(sentences),
+                        'text':      sentence,
+                    },
+                }
+                await self.send(**self.codec.encode(message_data, is_send_bytes_data=is_send_bytes_data))
+                audio_bytes = await task
+                await self.send(bytes_data=encode_audio_frame(tts_id, len(sentences), False, audio_bytes or b''))
+                if not sentences:
+                    observe('vrmchat.tts_first_audio_sec', time.perf_counter() - start_time)
+                sentences.append(sentence)
+            # LLM のエラーは呼び出し元で処理する
+            await producer
+            await self.send(bytes_data=encode_audio_frame(tts_id, len(sentences), True, b''))
+        finally:
+            # StopGeneration / 切断 / エラー時は LLM と残りの合成を止める
+            while not queue.empty():
+                item = queue.get_nowait()
+                if item is not None:
+                    tasks.append(item[1])
+            for task in [producer, *tasks]:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
+        return ''.join(texts)
+
+    async def _slot_stream(self,
+                           llm_slot,
+                           llm_stream,
+                           sent_tokens:int,):
+        """
+        llm_stream を読む間だけ llm_slot を確保する (最初の delta の前に確保し、最後まで読んだ時点で実績のトークン数を commit して解放する)
+        終了・キャンセル時は llm_stream を aclose する。
+        """
+        chunks = []
+        async with llm_slot:
+            try:
+                async for delta in llm_stream:
+                    chunks.append(delta)
+                    yield delta
+            finally:
+                aclose = getattr(llm_stream, 'aclose', None)
+                if aclose is not None:
+                    await aclose()
+            llm_slot.commit(sent_tokens + calc_token(sentence = ''.join(chunks),))
+
+    ####################
+    # _llm_slot / _send_queue_position
+    # - 上流 LLM のスロット (モデルごとの同時実行数 / TPM) をユーザごとに公平に確保する
+    # - 順番待ちの間は順番 (1 始まり) を QueuePosition でユーザにのみ通知する
+    ####################
+    def _llm_slot(self,
+                  model_name_int:int,
+                  data_dict:dict,
+                  sent_tokens:int,
+                  is_possible_compress:bool,):
+        limits = LLM_SCHEDULER_LIMITS_DICT.get(model_name_int, DEFAULT_LLM_SCHEDULER_LIMITS)
+
+        async def _on_position(position:int):
+            await self._send_queue_position(data_dict['message_id'], position, is_possible_compress)
+
+        return llm_scheduler.slot(model_name        = data_dict['model_name'],
+                                  user_key          = str(self.connect_user.pk),
+                                  cost              = sent_tokens + data_dict['max_tokens'],
+                                  concurrency_limit = limits['concurrency'],
+                                  tpm_limit         = limits['tpm'],
+                                  on_position       = _on_position,)
+
+    async def _send_queue_position(self,
+                                   message_id:str,
+                                   position:int,
+                                   is_send_bytes_data:bool = True,):
+        if self.is_disconnected:
+            return None
+        message_data = {
+            'cmd':   'QueuePosition',
+            'status': 200,
+            'ok':     True,
+            'data': {
+                'messageId': message_id,
+                'position':  position,
+            },
+        }
+        await self._self_send_message(message_data, is_send_bytes_data=is_send_bytes_data)
+        return None
+
     ####################
     # _create_prompt
     ####################
@@ -512,16 +884,13 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
         return formatted_prompt
 
     ####################
-    # _socket_access_get_channel_name
+    # _presence_get_channel_name
     # - access_id から channel_name を特定して _target_channel_name_send_message でメッセージを送信
     ####################
-    @database_sync_to_async
-    def _socket_access_get_channel_name(self, stage_id:str, access_id:str):
+    async def _presence_get_channel_name(self, access_id:str):
         try:
-            channel_name = SocketAccess.objects.get(stage_id__stage_id = stage_id,
-                                                    access_id          = access_id)\
-                                                .channel_name
-            return 200, channel_name
+            channel_name = await self.presence.get_channel_name(self.room_id, access_id)
+            return (200, channel_name) if channel_name else (404, None)
         except Exception as e:
             print(e)
             return 500, None
@@ -532,12 +901,8 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
     async def _self_send_message(self,
                                  message_data,
                                  is_send_bytes_data = True,):
-        await self.channel_layer.send(
-            self.channel_name,
-            {
-                'type':    'send_bytes_data_message' if is_send_bytes_data else 'send_text_data_message',
-                'message': message_data,
-            },
+        await self.delivery.self_send(
+            self.codec.build_event('send_encoded_message', message_data, is_send_bytes_data),
         )
         return None
 
@@ -547,12 +912,8 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
     async def _group_send_message(self,
                                   message_data,
                                   is_send_bytes_data = True,):
-        await self.channel_layer.group_send(
-            self.group_name,
-            {
-                'type':    'send_bytes_data_message' if is_send_bytes_data else 'send_text_data_message',
-                'message': message_data,
-            },
+        await self.delivery.group_send(
+            self.codec.build_event('send_encoded_message', message_data, is_send_bytes_data),
         )
         return None
 
@@ -564,22 +925,42 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
                                                 message_data,
                                                 is_send_bytes_data = True,):
         if channel_name:
-            await self.channel_layer.send(
+            await self.delivery.send(
                 channel_name,
-                {
-                    'type':    'send_bytes_data_message' if is_send_bytes_data else 'send_text_data_message',
-                    'message': message_data,
-                },
+                self.codec.build_event('send_encoded_message', message_data, is_send_bytes_data),
             )
         return None
 
     ####################
     # send_message
     ####################
+    async def send_encoded_message(self, event):
+        try:
+            await self.send(**self.codec.frame_for_event(event))
+            # メンバーの増減時は直接送信の宛先を更新する
+            if event.get('cmd') in ('SocketConnect', 'SocketDisconnect',):
+                asyncio.create_task(self._refresh_delivery_members(self.room_id))
+            # ストリームの終了時は stream_id を解放する
+            elif event.get('cmd') == 'isStreamingComplete':
+                self.codec.end_stream((event['message'].get('data') or {}).get('messageId'))
+        except Exception as e:
+            print(e)
+            pass
+        return None
+
+    async def send_stream_delta(self, event):
+        try:
+            for frame in self.codec.stream_frames(event):
+                await self.send(**frame)
+        except Exception as e:
+            print(e)
+            pass
+        return None
+
+    # 旧形式のイベント (デプロイ切り替え中の他ワーカーからの送信) 用
     async def send_text_data_message(self, event):
         try:
-            message = event['message']
-            await self.send(text_data=json.dumps(message))
+            await self.send(**self.codec.encode(event['message'], is_send_bytes_data=False))
         except Exception as e:
             print(e)
             pass
@@ -587,9 +968,7 @@ class VrmchatConsumer(AsyncWebsocketConsumer):
 
     async def send_bytes_data_message(self, event):
         try:
-            message = event['message']
-            await self.send(bytes_data=brotli.compress(json.dumps(message).encode('utf-8'),
-                                                       quality=4))
+            await self.send(**self.codec.encode(event['message'], is_send_bytes_data=True))
         except Exception as e:
             print(e)
             pass
@@ -55,6 +55,12 @@ class Message(models.Model):
                     blank        = True,
                     null         = True,
                     unique       = False,)
+    num_tokens = models.PositiveIntegerField(
+                    verbose_name = _('トークン数'),
+                    default      = None,
+                    blank        = True,
+                    null         = True,
+                    help_text    = _('ユーザメッセージ + LLM回答のトークン数 (ヒストリーのトークン数の計算用)'),)
     is_active = models.BooleanField(
                     verbose_name = _('メッセージが有効'),
                     default      = True,
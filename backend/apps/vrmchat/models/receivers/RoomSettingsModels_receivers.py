@@ -0,0 +1,14 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from ..Room_models import RoomSettings
+
+# キャッシュの更新 (utils は models の読み込み後に import する)
+@receiver(post_save, sender=RoomSettings)
+def refresh_room_settings_cache_on_save(sender, instance, **kwargs) -> None:
+    from ...utils import refresh_room_settings_cache
+    refresh_room_settings_cache(instance)
+
+@receiver(post_delete, sender=RoomSettings)
+def invalidate_room_settings_cache_on_delete(sender, instance, **kwargs) -> None:
+    from ...utils import invalidate_room_settings_cache
+    invalidate_room_settings_cache(instance.room_id.room_id)
\ No newline at end of file
@@ -1,8 +1,27 @@
 # Token
 # GPT-4 turbo: 128000, GPT-4 32K: 32768, GPT-4 8K: 8192, GPT-3.5: 4096
-MIN_TOKENS      = 50
-MAX_TOKENS      = 8192
-SEND_MAX_TOKENS = 8192
+MIN_TOKENS = 50
+MAX_TOKENS = 8192
+# モデルごとの送信できる最大トークン (key は MODEL_NAME_CHOICES の値)
+# - プロンプト (ヒストリー含む) + 回答の最大トークン数 (max_tokens) がこの値に収まるよう古いヒストリーから削る
+# - コンテキスト長が長いモデルもプロンプトの大きさ (レイテンシ) を抑えるため 32768 で打ち切る
+SEND_MAX_TOKENS_DICT = {
+    # gpt
+    1:   16385, # gpt-3.5-turbo (16385)
+    10:  8192,  # gpt-4 (8192)
+    11:  32768, # gpt-4-turbo (128000)
+    12:  32768, # gpt-4o-mini (128000)
+    20:  32768, # gpt-4o (128000)
+    # gemini
+    100: 32768, # gemini-1.5-flash-001 (1048576)
+    101: 32768, # gemini-1.5-pro-001 (2097152)
+    110: 32768, # gemini-1.5-flash-002 (1048576)
+    111: 32768, # gemini-1.5-pro-002 (2097152)
+    120: 32768, # gemini-exp-1206 (2097152)
+    130: 32767, # gemini-2.0-flash-thinking-exp-1219 (32767)
+    131: 32768, # gemini-2.0-flash-exp (1048576)
+}
+DEFAULT_SEND_MAX_TOKENS = 8192 # SEND_MAX_TOKENS_DICT に無いモデル
 
 # Process
 RETRY_LIMIT_N  = 2
@@ -15,4 +34,77 @@ DEFAULT_ROOM_NAME          = 'NewVRMChatRoom'
 MAX_LEN_ROOM_NAME          = 50
 
 # LLM回答の中に ALLOWD_DOMAINS_LIST 以外のURLドメインが含まれていた場合には削除してからDBに保存する
-ALLOWD_DOMAINS_LIST = ['go.jp', 'or.jp', 'google.com',]
\ No newline at end of file
+ALLOWD_DOMAINS_LIST = ['go.jp', 'or.jp', 'google.com',]
+
+# ルーム設定のキャッシュ
+ROOM_SETTINGS_L1_CACHE_SEC = 2   # プロセス内キャッシュの TTL(秒)
+ROOM_SETTINGS_CACHE_SEC    = 600 # 共有キャッシュ (Redis) の TTL(秒)
+
+# ヒストリーのキャッシュ (直近 MAX_HISSTORY_N 件の会話を保持)
+HISTORY_CACHE_SEC = 3600 # 共有キャッシュ (Redis) の TTL(秒)
+
+# メッセージの保存 (write-behind)
+MESSAGE_WRITE_BATCH_SIZE   = 50     # まとめて bulk_create する最大件数
+MESSAGE_WRITE_INTERVAL_SEC = 0.5    # 最初の 1 件から書き込みまでの最大待ち時間(秒)
+MESSAGE_SPOOL_DIR          = 'spool' # DB に書き込めない場合の退避先 (BASE_DIR からの相対パス)
+
+# LLM の回答のキャッシュ (opt-in)
+# - temperature が RESPONSE_CACHE_MAX_TEMPERATURE 以下 (決定的) の場合のみ、messages と生成パラメータが同じなら保存済みの回答を返す
+IS_RESPONSE_CACHE              = False
+RESPONSE_CACHE_MAX_TEMPERATURE = 0.0
+RESPONSE_CACHE_SEC             = 86400 # 共有キャッシュ (Redis) の TTL(秒)
+RESPONSE_CACHE_MAX_ENTRIES     = 10000 # 件数の上限 (最終アクセスが古いものから削除)
+
+# 上流 LLM の呼び出しのスケジューラ
+# - モデルごとの同時実行数と 1分あたりのトークン数 (TPM: 送信 + max_tokens の見積もりで確保し、完了後に実績との差を戻す) の上限
+# - 上限に達した場合はユーザごとに公平に順番待ちさせ、順番を QueuePosition で通知する
+# - 'redis': 全ワーカーで共有 (Lua で原子的に判定、Redis に接続できない場合はプロセス内で判定) / 'local': プロセス内のみ
+LLM_SCHEDULER_BACKEND = 'redis'
+# key は MODEL_NAME_CHOICES の値 (concurrency: 同時実行数, tpm: 1分あたりのトークン数, 0 は制限なし)
+LLM_SCHEDULER_LIMITS_DICT = {
+    # gpt
+    1:   {'concurrency': 16, 'tpm': 200000}, # gpt-3.5-turbo
+    10:  {'concurrency': 4,  'tpm': 40000},  # gpt-4
+    11:  {'concurrency': 8,  'tpm': 80000},  # gpt-4-turbo
+    12:  {'concurrency': 16, 'tpm': 200000}, # gpt-4o-mini
+    20:  {'concurrency': 8,  'tpm': 80000},  # gpt-4o
+    # gemini
+    100: {'concurrency': 16, 'tpm': 200000}, # gemini-1.5-flash-001
+    101: {'concurrency': 8,  'tpm': 80000},  # gemini-1.5-pro-001
+    110: {'concurrency': 16, 'tpm': 200000}, # gemini-1.5-flash-002
+    111: {'concurrency': 8,  'tpm': 80000},  # gemini-1.5-pro-002
+    120: {'concurrency': 4,  'tpm': 40000},  # gemini-exp-1206
+    130: {'concurrency': 4,  'tpm': 40000},  # gemini-2.0-flash-thinking-exp-1219
+    131: {'concurrency': 8,  'tpm': 80000},  # gemini-2.0-flash-exp
+}
+DEFAULT_LLM_SCHEDULER_LIMITS = {'concurrency': 4, 'tpm': 40000} # LLM_SCHEDULER_LIMITS_DICT に無いモデル
+LLM_QUEUE_TIMEOUT_SEC        = 60  # 順番待ちの上限(秒)
+LLM_SCHEDULER_POLL_SEC       = 0.1 # 空きが無い場合の再試行の間隔(秒) (他ワーカーの解放は通知されない)
+LLM_SLOT_LEASE_SEC           = 300 # 確保したスロットの期限(秒) (解放できずに停止したワーカーの分)
+
+# プロバイダのルーティング (フェイルオーバー)
+# key は MODEL_NAME_CHOICES の値 (無いモデルは gpt: openai / gemini: gcloud のみ)
+# - routes:    同じモデルの候補 (provider, model_name)。azure の model_name はデプロイ名
+#              CircuitBreaker が開いていない候補を、最初のトークンまでの時間 (p50) の短い順に使う
+# - fallbacks: 別のモデルの候補。routes が全て使えない場合とヘッジにだけ使う
+# - 認証情報が設定されていないプロバイダは候補から除く
+LLM_ROUTES_DICT = {
+    # gpt
+    1:   {'routes': [('openai', 'gpt-3.5-turbo'), ('azure', 'gpt-35-turbo')]},
+    10:  {'routes': [('openai', 'gpt-4'),         ('azure', 'gpt-4')]},
+    11:  {'routes': [('openai', 'gpt-4-turbo'),   ('azure', 'gpt-4-turbo')]},
+    12:  {'routes': [('openai', 'gpt-4o-mini'),   ('azure', 'gpt-4o-mini')]},
+    20:  {'routes': [('openai', 'gpt-4o'),        ('azure', 'gpt-4o')]},
+    # gemini
+    100: {'routes': [('gcloud', 'gemini-1.5-flash-001')], 'fallbacks': [('openai', 'gpt-4o-mini')]},
+    101: {'routes': [('gcloud', 'gemini-1.5-pro-001')],   'fallbacks': [('openai', 'gpt-4o')]},
+    110: {'routes': [('gcloud', 'gemini-1.5-flash-002')], 'fallbacks': [('openai', 'gpt-4o-mini')]},
+    111: {'routes': [('gcloud', 'gemini-1.5-pro-002')],   'fallbacks': [('openai', 'gpt-4o')]},
+}
+LLM_FIRST_TOKEN_TIMEOUT_SEC   = 20    # 最初のトークンまでの期限(秒) (ストリーミング)。超えたら次の候補で再試行 (最大 RETRY_LIMIT_N 回)
+LLM_RESPONSE_TIMEOUT_SEC      = 60    # 回答までの期限(秒) (非ストリーミング)
+LLM_RETRY_BACKOFF_BASE_SEC    = 0.2   # 再試行の待ち時間 (0 ~ base * 2^n の一様乱数、最大 LLM_RETRY_BACKOFF_MAX_SEC)
+LLM_RETRY_BACKOFF_MAX_SEC     = 2.0
+LLM_HEDGE_AFTER_SEC           = None  # 最初のトークンが届かないまま p95 (履歴が少ない場合はこの秒数) を過ぎたら次の候補にも送る (None: ヘッジしない)
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5     # プロバイダごとに続けて失敗したら候補から除く回数
+LLM_CIRCUIT_RESET_SEC         = 30    # 候補から除いてから再び試すまでの時間(秒)
\ No newline at end of file
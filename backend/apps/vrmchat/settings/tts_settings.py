@@ -0,0 +1,7 @@
+# 回答を文ごとに TTS に送るパイプライン
+# - SendUserMessage の data.isTts が true の場合、LLM をストリーミングで呼び、文が確定するたびに TTS に送って
+#   文 (TtsSentence) と音声 (バイナリフレーム) を順に送る (回答の完了を待たずにアバターが話し始める)
+# - False にすると data.isTts を無視する (これまで通り回答の完了後に SendUserMessage のみ)
+IS_TTS_PIPELINE          = True
+TTS_PIPELINE_MAX_CHARS   = 200 # 1 回で合成する最大文字数 (超える文は読点などで区切る)
+TTS_PIPELINE_CONCURRENCY = 3   # 1 接続で同時に合成する文の数
\ No newline at end of file
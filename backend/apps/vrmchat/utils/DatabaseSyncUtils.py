@@ -1,9 +1,19 @@
+import os
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from channels.db import database_sync_to_async
 from typing import Dict, List, Tuple, Optional
-from common.scripts.LlmUtils import text_modify_fnc
+from common.scripts.LlmUtils import text_modify_fnc, calc_token
+from apps.utils import VersionedReadThroughCache, RoomHistoryBuffer, WriteBehindQueue
 from ..models import Room, RoomSettings, Message
-from ..settings import DEFAULT_ROOM_NAME, MAX_LEN_ROOM_NAME
+from ..settings import (
+    DEFAULT_ROOM_NAME, MAX_LEN_ROOM_NAME, MAX_HISSTORY_N,
+    ALLOWD_DOMAINS_LIST,
+    ROOM_SETTINGS_L1_CACHE_SEC, ROOM_SETTINGS_CACHE_SEC,
+    HISTORY_CACHE_SEC,
+    MESSAGE_WRITE_BATCH_SIZE, MESSAGE_WRITE_INTERVAL_SEC, MESSAGE_SPOOL_DIR,
+)
 
 User = get_user_model()
 
@@ -27,57 +37,180 @@ def sync_get_room_obj(room_id: str):
         print(e)
         return None
 
+def room_settings_to_dict(room_settings_model_object:RoomSettings,
+                          ) -> Dict[str, str]:
+    """ キャッシュ用の dict (version は AutoIncVersionField) """
+    return {
+        'system_sentence':    room_settings_model_object.system_sentence,
+        'assistant_sentence': room_settings_model_object.assistant_sentence,
+        'history_len':        room_settings_model_object.history_len,
+        'model_name':         room_settings_model_object.model_name,
+        'max_tokens':         room_settings_model_object.max_tokens,
+        'temperature':        room_settings_model_object.temperature,
+        'top_p':              room_settings_model_object.top_p,
+        'presence_penalty':   room_settings_model_object.presence_penalty,
+        'frequency_penalty':  room_settings_model_object.frequency_penalty,
+        'version':            room_settings_model_object.version,
+        # トークン数の上限チェック用 (DEFAULT_ENCODING_NAME)
+        'system_sentence_tokens':    calc_token(sentence=room_settings_model_object.system_sentence),
+        'assistant_sentence_tokens': calc_token(sentence=room_settings_model_object.assistant_sentence),
+    }
+
 @database_sync_to_async
-def get_room_settings(room_id:str,
-                      ) -> Dict[str, str]:
+def _load_room_settings(room_id:str,
+                        ) -> Optional[Dict[str, str]]:
     try:
-        room_settings_dict         = {}
         room_settings_model_object = RoomSettings.objects.get(room_id__room_id=room_id)
-
-        room_settings_dict['system_sentence']    = room_settings_model_object.system_sentence
-        room_settings_dict['assistant_sentence'] = room_settings_model_object.assistant_sentence
-        room_settings_dict['history_len']        = room_settings_model_object.history_len
-        room_settings_dict['model_name']         = room_settings_model_object.model_name
-        room_settings_dict['max_tokens']         = room_settings_model_object.max_tokens
-        room_settings_dict['temperature']        = room_settings_model_object.temperature
-        room_settings_dict['top_p']              = room_settings_model_object.top_p
-        room_settings_dict['presence_penalty']   = room_settings_model_object.presence_penalty
-        room_settings_dict['frequency_penalty']  = room_settings_model_object.frequency_penalty
     except Exception as e:
         print(e)
         return None
+    return room_settings_to_dict(room_settings_model_object)
+
+# ルーム設定のキャッシュ (L1: プロセス内 / L2: 共有キャッシュ)
+# - 無効化は models.receivers (post_save / post_delete) と RoomSettingsViewSet.patch から行う
+room_settings_cache = VersionedReadThroughCache(
+                            namespace  = 'vrmchat:room_settings',
+                            loader     = _load_room_settings,
+                            l1_ttl_sec = ROOM_SETTINGS_L1_CACHE_SEC,
+                            l2_ttl_sec = ROOM_SETTINGS_CACHE_SEC,)
+
+async def get_room_settings(room_id:str,
+                            ) -> Optional[Dict[str, str]]:
+    room_settings_dict = await room_settings_cache.aget(room_id)
+    if room_settings_dict is None:
+        return None
+    room_settings_dict.pop('version', None)
+    # トークン数を持たない (更新前の) キャッシュの場合
+    for field_name in ('system_sentence', 'assistant_sentence',):
+        if f'{field_name}_tokens' not in room_settings_dict:
+            room_settings_dict[f'{field_name}_tokens'] = calc_token(sentence=room_settings_dict[field_name])
     return room_settings_dict
 
+def refresh_room_settings_cache(room_settings_model_object:RoomSettings) -> None:
+    """ 保存後の値でキャッシュを更新する (キャッシュ済みより古い version は無視) """
+    room_settings_cache.set_if_newer(room_settings_model_object.room_id.room_id,
+                                     room_settings_to_dict(room_settings_model_object))
+
+def invalidate_room_settings_cache(room_id:str) -> None:
+    room_settings_cache.delete(room_id)
+
+
+# ルームごとの直近の会話 (Redis のリングバッファ)
+# - 追加は save_message_models、無効化は MessageViewSet (PATCH / DELETE) から行う
+room_history_buffer = RoomHistoryBuffer(
+                            namespace = 'vrmchat',
+                            max_turns = MAX_HISSTORY_N,
+                            ttl_sec   = HISTORY_CACHE_SEC,)
+
+def message_to_turn(message_id:str,
+                    user_message:str,
+                    llm_response:str,
+                    num_tokens:Optional[int] = None,
+                    ) -> Dict[str, str]:
+    """ tokens は保存済み (Message.num_tokens) の値を使い、無い場合のみ数える """
+    if num_tokens is None:
+        num_tokens = calc_token(sentence=user_message) + calc_token(sentence=llm_response)
+    return {
+        'message_id':   message_id,
+        'user_message': user_message,
+        'llm_response': llm_response,
+        'tokens':       num_tokens,
+    }
 
 @database_sync_to_async
-def get_history(room_id:str,
-                history_len:int = 3,
-                ) -> Optional[Tuple[List[Dict[str, str]], str]]:
-    history_message_list = []
-    history_message_text = ''
+def _load_history_turns(room_id:str,
+                        history_len:int,
+                        ) -> List[Dict[str, str]]:
+    message_objs = Message.objects.filter(room_id__room_id = room_id,
+                                          is_active        = True,
+                                         ).order_by('-date_create')[:history_len] # 新しいものを取る (1/1, 1/2)
+    return [message_to_turn(message_obj.message_id, message_obj.user_message, message_obj.llm_response, message_obj.num_tokens)
+            for message_obj in reversed(message_objs)]                          # 古いものから入れる [1/2, 1/1]
+
+async def get_history_turns(room_id:str,
+                            history_len:int = 3,
+                            ) -> List[Dict[str, str]]:
+    """ 直近 history_len 件のターン (古い順) """
+    turns = []
     try:
         if history_len != 0:
-            message_objs = Message.objects.filter(room_id__room_id = room_id,
-                                                  is_active        = True,
-                                                 ).order_by('-date_create')[:history_len] # 新しいものを取る (1/1, 1/2)
-            if message_objs:
-                for message_obj in reversed(message_objs):                        # 古いものから入れる [1/2, 1/1]
-                    history_message_list.append({
-                        'role':    'user',
-                        'content': message_obj.user_message,
-                    })
-                    history_message_list.append({
-                        'role':    'assistant',
-                        'content': message_obj.llm_response,
-                    })
-                    history_message_text += message_obj.user_message+message_obj.llm_response
+            try:
+                turns = await room_history_buffer.aget(room_id, history_len)
+            except Exception as e:
+                print(e)
+                turns = None
+            # バッファが未構築の場合のみ DB から読み込む (バッファは最大件数で構築する)
+            if turns is None:
+                turns = await _load_history_turns(room_id, max(history_len, MAX_HISSTORY_N))
+                try:
+                    await room_history_buffer.afill(room_id, turns)
+                except Exception as e:
+                    print(e)
+                turns = turns[-history_len:]
     except Exception as e:
         print(e)
+        turns = []
+    return turns
 
-    return history_message_list, history_message_text
+def turns_to_history(turns:List[Dict[str, str]],
+                     ) -> Tuple[List[Dict[str, str]], int]:
+    """ Returns: (ヒストリーの messages, ヒストリーのトークン数の合計) """
+    history_message_list   = []
+    history_message_tokens = 0
+    for turn in turns:
+        history_message_list.append({
+            'role':    'user',
+            'content': turn['user_message'],
+        })
+        history_message_list.append({
+            'role':    'assistant',
+            'content': turn['llm_response'],
+        })
+        history_message_tokens += turn['tokens']
+    return history_message_list, history_message_tokens
 
-@database_sync_to_async
-def sync_save_message_models(room_id:str, data_dict:dict):
+async def get_history(room_id:str,
+                      history_len:int = 3,
+                      ) -> Optional[Tuple[List[Dict[str, str]], int]]:
+    """ Returns: (ヒストリーの messages, ヒストリーのトークン数の合計) """
+    return turns_to_history(await get_history_turns(room_id, history_len))
+
+def invalidate_history_cache(room_id:str) -> None:
+    try:
+        room_history_buffer.invalidate(room_id)
+    except Exception as e:
+        print(e)
+
+def _bulk_save_messages(items:List[Dict[str, str]]) -> None:
+    """ write-behind のバッチ書き込み (spool からの再投入で重複しても message_id の unique で無視する) """
+    room_obj_dict = {room_obj.room_id: room_obj
+                     for room_obj in Room.objects.filter(room_id__in={item['room_id'] for item in items})}
+    Message.objects.bulk_create([
+        Message(room_id          = room_obj_dict[item['room_id']],
+                message_id       = item['message_id'],
+                user_message     = item['user_message'],
+                llm_response     = item['llm_response'],
+                user_settings    = item['user_settings'],
+                tokens_info_dict = item['tokens_info_dict'],
+                history_list     = item['history_list'],
+                num_tokens       = item.get('num_tokens'),
+                date_create      = item['date_create'],)
+        for item in items
+        if item['room_id'] in room_obj_dict # 保存までにルームが削除された場合は捨てる
+    ], ignore_conflicts=True)
+
+# メッセージの保存 (write-behind)
+# - ターン終了時は積むだけで、MESSAGE_WRITE_BATCH_SIZE 件 / MESSAGE_WRITE_INTERVAL_SEC 秒ごとに bulk_create する
+# - DB に書き込めない場合は MESSAGE_SPOOL_DIR に退避し、書き込めるようになった時点で再投入する
+message_write_queue = WriteBehindQueue(
+                            name               = 'vrmchat.message_write',
+                            flush_fn           = _bulk_save_messages,
+                            max_batch          = MESSAGE_WRITE_BATCH_SIZE,
+                            flush_interval_sec = MESSAGE_WRITE_INTERVAL_SEC,
+                            spool_dir          = os.path.join(settings.BASE_DIR, MESSAGE_SPOOL_DIR),)
+
+async def save_message_models(room_id:str, data_dict:dict) -> None:
+    """ メッセージを保存キューに積み、ヒストリーのバッファには直ちに追加する (DB の書き込みは待たない) """
     try:
         user_settings = {
             k: v
@@ -87,18 +220,32 @@ def sync_save_message_models(room_id:str, data_dict:dict):
                 and k.lower() != 'llm_response'
                 and k.lower() != 'tokens_info_dict'
                 and k.lower() != 'history_list'
-                and k.lower() != 'history_text'
+                and k.lower() != 'history_tokens'
             )
         }
+        turn = message_to_turn(data_dict['message_id'],
+                               data_dict['user_message'],
+                               text_modify_fnc(data_dict['llm_response'], ALLOWD_DOMAINS_LIST),)
+        item = {
+            'room_id':          room_id,
+            'message_id':       data_dict['message_id'],
+            'user_message':     data_dict['user_message'],
+            'llm_response':     turn['llm_response'],
+            # TextField には str で保存される
+            'user_settings':    str(user_settings),
+            'tokens_info_dict': str(data_dict['tokens_info_dict']),
+            'history_list':     str(data_dict['history_list']),
+            'num_tokens':       turn['tokens'],
+            'date_create':      timezone.now().isoformat(),
+        }
+        await message_write_queue.put(item)
+    except Exception as e:
+        print(e)
+        return None
 
-        Message.objects.create(
-                room_id          = Room.objects.get(room_id=room_id),
-                message_id       = data_dict['message_id'],
-                user_message     = data_dict['user_message'],
-                llm_response     = text_modify_fnc(data_dict['llm_response']),
-                user_settings    = user_settings,
-                tokens_info_dict = data_dict['tokens_info_dict'],
-                history_list     = data_dict['history_list'],)
+    # ヒストリーのバッファに追加
+    try:
+        await room_history_buffer.aappend(room_id, turn)
     except Exception as e:
         print(e)
 
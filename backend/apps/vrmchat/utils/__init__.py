@@ -1,7 +1,10 @@
 from .DatabaseSyncUtils import (
     sync_get_room_obj,
     get_room_settings, get_history,
-    sync_save_message_models,
+    get_history_turns, turns_to_history,
+    invalidate_history_cache,
+    refresh_room_settings_cache, invalidate_room_settings_cache,
+    save_message_models,
     replace_room_name_check,
 )
 from .prompt import base_prompt
\ No newline at end of file
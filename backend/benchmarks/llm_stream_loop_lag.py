@@ -0,0 +1,125 @@
+"""
+LLM ストリーミング時のイベントループ遅延ベンチマーク
+
+    cd backend
+    python -m benchmarks.llm_stream_loop_lag --streams 1 10 50 --chunks 100
+
+上流 API へは接続せず、チャンクを一定間隔で返すダミーストリームを使う
+    - before: 同期 Stream をイベントループ上で for で読み、チャンク毎に asyncio.sleep(0.01) (旧実装)
+    - after : OpenAILlm.async_get_stream_response (AsyncOpenAI のストリームを async for で読む)
+ループ遅延は 5ms 周期で起きるプローブタスクの「予定時刻からの遅れ」で計測する
+"""
+import os
+import sys
+import argparse
+import asyncio
+import statistics
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django
+django.setup()
+
+from common.scripts.LlmUtils.llms import OpenAILlm
+
+PROBE_INTERVAL_SEC = 0.005
+
+
+def _chunk(text:str):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+class _SyncStream:
+    """ openai.Stream 相当: 1チャンク毎にソケット読み込みでブロックする """
+    def __init__(self, n_chunks:int, chunk_interval:float):
+        self.n_chunks       = n_chunks
+        self.chunk_interval = chunk_interval
+    def __iter__(self):
+        for i in range(self.n_chunks):
+            time.sleep(self.chunk_interval)
+            yield _chunk(str(i))
+
+class _AsyncStream:
+    """ openai.AsyncStream 相当 """
+    def __init__(self, n_chunks:int, chunk_interval:float):
+        self.n_chunks       = n_chunks
+        self.chunk_interval = chunk_interval
+    def __aiter__(self):
+        return self._gen()
+    async def _gen(self):
+        for i in range(self.n_chunks):
+            await asyncio.sleep(self.chunk_interval)
+            yield _chunk(str(i))
+    async def close(self):
+        return None
+
+class _FakeAsyncClient:
+    def __init__(self, n_chunks:int, chunk_interval:float):
+        async def create(**kwargs):
+            return _AsyncStream(n_chunks, chunk_interval)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+
+async def _legacy_stream(n_chunks:int, chunk_interval:float, asyncio_sleep:float = 0.01):
+    """ 変更前の OpenAILlm.async_get_stream_response と同じ読み出し方 """
+    response = await asyncio.to_thread(lambda: _SyncStream(n_chunks, chunk_interval))
+    for res in response:
+        yield res.choices[0].delta.content
+        await asyncio.sleep(asyncio_sleep)
+
+_LLM = None
+
+def _new_stream(n_chunks:int, chunk_interval:float):
+    # クライアント生成コストは計測対象外にするため使い回す
+    global _LLM
+    if _LLM is None:
+        _LLM = OpenAILlm(api_key='dummy')
+    _LLM.async_client = _FakeAsyncClient(n_chunks, chunk_interval)
+    return _LLM.async_get_stream_response([{'role': 'user', 'content': 'ping'}])
+
+
+async def _probe(lags:list, stop:asyncio.Event):
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL_SEC)
+        lags.append(max(time.perf_counter() - t - PROBE_INTERVAL_SEC, 0.0))
+
+async def _consume(stream):
+    async for _ in stream:
+        pass
+
+async def _run(make_stream, n_streams:int, n_chunks:int, chunk_interval:float):
+    lags  = []
+    stop  = asyncio.Event()
+    probe = asyncio.create_task(_probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[_consume(make_stream(n_chunks, chunk_interval)) for _ in range(n_streams)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    lags.sort()
+    return {
+        'elapsed_sec':  elapsed,
+        'lag_mean_ms':  statistics.fmean(lags) * 1000 if lags else 0.0,
+        'lag_p99_ms':   lags[int(len(lags) * 0.99) - 1] * 1000 if lags else 0.0,
+        'lag_max_ms':   lags[-1] * 1000 if lags else 0.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams',        type=int,   nargs='+', default=[1, 10, 50])
+    parser.add_argument('--chunks',         type=int,   default=100)
+    parser.add_argument('--chunk-interval', type=float, default=0.002, help='上流がチャンクを返す間隔(秒)')
+    args = parser.parse_args()
+
+    print(f'{"impl":<7}{"streams":>8}{"elapsed(s)":>12}{"lag mean(ms)":>14}{"lag p99(ms)":>13}{"lag max(ms)":>13}')
+    _new_stream(0, 0.0)
+    for n_streams in args.streams:
+        for label, make_stream in (('before', _legacy_stream), ('after', _new_stream)):
+            r = asyncio.run(_run(make_stream, n_streams, args.chunks, args.chunk_interval))
+            print(f'{label:<7}{n_streams:>8}{r["elapsed_sec"]:>12.2f}{r["lag_mean_ms"]:>14.2f}{r["lag_p99_ms"]:>13.2f}{r["lag_max_ms"]:>13.2f}')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""
+STT に送る音声の VAD / フレーム結合のベンチマーク
+
+    cd backend
+    python -m benchmarks.stt_vad_frames --speech-ratio 0.2 0.5 --chunk-ms 25 --sec 60
+
+上流 (Gcloud STT) へは接続せず、RecordRTC と同じ WAV ヘッダ付きのチャンク (chunk_ms ごと) に分けた
+合成音声 (高調波の音声区間 + 弱い雑音の無音区間) を SpeechFrameGate に通す
+    - before: 受信したチャンクをそのまま 1 リクエストとして送る (旧実装)
+    - gate:   SpeechFrameGate で無音を間引き、frame_ms ごとにまとめて送る
+"""
+import os
+import sys
+import argparse
+import io
+import time
+import wave
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django
+django.setup()
+
+import numpy as np
+from apps.third_party.gcloud.stt_tts.utils import SpeechFrameGate
+from apps.third_party.gcloud.stt_tts.settings import STT_SAMPLE_RATE_HERTZ, STT_FRAME_MS
+
+
+def _make_audio(sec:float, speech_ratio:float, seed:int = 0) -> np.ndarray:
+    """ 発話 (1.5 秒前後) と無音を speech_ratio の割合で繰り返す """
+    rng   = np.random.default_rng(seed)
+    parts = []
+    total = 0
+    while total < sec * STT_SAMPLE_RATE_HERTZ:
+        speech_n  = int(rng.uniform(1.0, 2.0) * STT_SAMPLE_RATE_HERTZ)
+        silence_n = int(speech_n * (1 - speech_ratio) / max(speech_ratio, 1e-3))
+        t         = np.arange(speech_n) / STT_SAMPLE_RATE_HERTZ
+        f0        = rng.uniform(100, 250)
+        parts.append((3000 * np.sin(2 * np.pi * f0 * t) + 1200 * np.sin(2 * np.pi * 3 * f0 * t)).astype('<i2'))
+        parts.append(rng.normal(0, 40, silence_n).astype('<i2'))
+        total += speech_n + silence_n
+    return np.concatenate(parts)[:int(sec * STT_SAMPLE_RATE_HERTZ)]
+
+def _wav_chunks(samples:np.ndarray, chunk_ms:int) -> list:
+    n      = STT_SAMPLE_RATE_HERTZ * chunk_ms // 1000
+    chunks = []
+    for i in range(0, len(samples), n):
+        buf = io.BytesIO()
+        with wave.open(buf, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(STT_SAMPLE_RATE_HERTZ)
+            f.writeframes(samples[i:i+n].tobytes())
+        chunks.append(buf.getvalue())
+    return chunks
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--speech-ratio', type=float, nargs='+', default=[0.2, 0.5], help='音声区間の割合')
+    parser.add_argument('--chunk-ms',     type=int,   default=25, help='クライアントのチャンクの長さ(ms)')
+    parser.add_argument('--sec',          type=float, default=60, help='音声の長さ(秒)')
+    args = parser.parse_args()
+
+    print(f'{"impl":<7}{"speech":>7}{"requests":>10}{"req/s":>8}{"sent(s)":>9}{"ratio":>7}{"cpu(us/chunk)":>15}')
+    for speech_ratio in args.speech_ratio:
+        chunks = _wav_chunks(_make_audio(args.sec, speech_ratio), args.chunk_ms)
+        print(f'{"before":<7}{speech_ratio:>7.2f}{len(chunks):>10}{len(chunks) / args.sec:>8.1f}'
+              f'{args.sec:>9.1f}{1.0:>7.2f}{0.0:>15.1f}')
+
+        gate   = SpeechFrameGate(sample_rate=STT_SAMPLE_RATE_HERTZ, frame_ms=STT_FRAME_MS)
+        start  = time.perf_counter()
+        frames = []
+        for chunk in chunks:
+            frames += gate.feed(chunk)
+        frames += gate.flush()
+        cpu_us = (time.perf_counter() - start) / len(chunks) * 1e6
+        print(f'{"gate":<7}{speech_ratio:>7.2f}{len(frames):>10}{len(frames) / args.sec:>8.1f}'
+              f'{gate.forwarded_sec:>9.1f}{gate.forwarded_sec / gate.received_sec:>7.2f}{cpu_us:>15.1f}')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
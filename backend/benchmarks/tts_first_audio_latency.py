@@ -0,0 +1,82 @@
+"""
+vrmchat の回答の最初の音声までの時間 (time-to-first-audio) のベンチマーク
+
+    cd backend
+    python -m benchmarks.tts_first_audio_latency --sentences 3 8 --chars-per-sec 60 --tts-base-ms 250
+
+上流 (LLM / Gcloud TTS) へは接続せず、一定間隔で 1 文字ずつ返すダミーストリームと、
+base + 文字数に比例する時間が掛かるダミーの合成を使う
+    - before:   回答の完了を待って全文を返し、クライアントが全文の TTS を依頼する (旧実装)
+    - pipeline: VrmchatConsumer._stream_tts_pipeline (文が確定するたびに TTS に送り、文と音声を順に送る)
+"""
+import os
+import sys
+import argparse
+import asyncio
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django
+django.setup()
+
+from apps.utils import SocketCodec, decode_audio_frame
+from apps.vrmchat.consumers import VrmchatConsumer
+from apps.vrmchat.settings import TTS_PIPELINE_CONCURRENCY
+consumer_module = sys.modules[VrmchatConsumer.__module__]
+
+SENTENCE = '今日はとても良い天気なので、近くの公園まで散歩に行きましょう。'
+
+
+async def _llm_stream(text:str, chars_per_sec:float):
+    for ch in text:
+        await asyncio.sleep(1 / chars_per_sec)
+        yield ch
+
+def _make_synthesize(tts_base_sec:float, tts_per_char_sec:float):
+    async def synthesize(text:str) -> bytes:
+        await asyncio.sleep(tts_base_sec + tts_per_char_sec * len(text))
+        return text.encode('utf-8')
+    return synthesize
+
+async def _before(text:str, chars_per_sec:float, synthesize) -> float:
+    start    = time.perf_counter()
+    response = ''.join([delta async for delta in _llm_stream(text, chars_per_sec)])
+    await synthesize(response)
+    return time.perf_counter() - start
+
+async def _pipeline(text:str, chars_per_sec:float, synthesize) -> float:
+    consumer_module.synthesize_speech = synthesize
+    consumer = VrmchatConsumer.__new__(VrmchatConsumer)
+    consumer.codec         = SocketCodec()
+    consumer.tts_semaphore = asyncio.Semaphore(TTS_PIPELINE_CONCURRENCY)
+    consumer.tts_counter   = 0
+    first_audio = []
+
+    async def send(text_data=None, bytes_data=None):
+        if bytes_data is not None and decode_audio_frame(bytes_data) and not first_audio:
+            first_audio.append(time.perf_counter())
+    consumer.send = send
+    start = time.perf_counter()
+    await consumer._stream_tts_pipeline(_llm_stream(text, chars_per_sec), 'bench', start, is_send_bytes_data=False)
+    return first_audio[0] - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sentences',        type=int,   nargs='+', default=[3, 8], help='回答の文の数')
+    parser.add_argument('--chars-per-sec',    type=float, default=60,  help='LLM の生成速度(文字/秒)')
+    parser.add_argument('--tts-base-ms',      type=float, default=250, help='TTS 1 回の固定の所要時間(ms)')
+    parser.add_argument('--tts-per-char-ms',  type=float, default=5,   help='TTS の 1 文字あたりの所要時間(ms)')
+    args = parser.parse_args()
+
+    synthesize = _make_synthesize(args.tts_base_ms / 1000, args.tts_per_char_ms / 1000)
+    print(f'{"impl":<9}{"sentences":>10}{"chars":>7}{"first audio(s)":>16}')
+    for n_sentences in args.sentences:
+        text = SENTENCE * n_sentences
+        for label, fnc in (('before', _before), ('pipeline', _pipeline)):
+            sec = asyncio.run(fnc(text, args.chars_per_sec, synthesize))
+            print(f'{label:<9}{n_sentences:>10}{len(text):>7}{sec:>16.2f}')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
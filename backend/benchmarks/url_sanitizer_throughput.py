@@ -0,0 +1,115 @@
+"""
+LLM 回答の URL 処理 (text_modify_fnc) のスループットベンチマーク
+
+    cd backend
+    python -m benchmarks.url_sanitizer_throughput --sizes 2 8 32 --repeat 50 --allowlist-size 3 1000
+
+URL (許可 / 不許可)・Markdown のリンク・「URL」を含む日本語の回答を sizes(KB) の長さで生成して計測する
+    - before: 呼び出し毎に 3 つの正規表現をコンパイルし、3 パスで処理する (旧実装)
+    - after : コンパイル済みの正規表現 1 つで 1 パスで処理する (text_modify_fnc)
+    - stream: StreamingUrlSanitizer に delta (--delta-chars 文字ずつ) を流す (送信前のストリーミング処理)
+許可するドメインの一覧は --allowlist-size 件になるまでダミーのドメインを追加する
+"""
+import os
+import sys
+import argparse
+import random
+import re
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+import django
+django.setup()
+
+from common.scripts.LlmUtils import text_modify_fnc, StreamingUrlSanitizer
+
+ALLOWED_DOMAINS_LIST = ['go.jp', 'or.jp', 'google.com',]
+
+SENTENCES = [
+    '厚生労働省の資料は https://www.mhlw.go.jp/stf/index.html を参照してください。\n',
+    '詳しくは[こちら](https://www.example.com/path?q=1)をご覧ください。\n',
+    '検索は「http://www.google.com/search?q=test」から行えます。\n',
+    '非公式のまとめ http://blog.example.net/entry/123 もあります。\n',
+    '[公式サイト](http://www.city.example.or.jp/) に最新情報があります。\n',
+    'URL を含まない説明文です。手順は次の通りです。\n',
+    '1. 設定画面を開きます。2. 項目を選択します。3. 保存します。\n',
+]
+
+
+def _is_allowed_url(url:str, allowed_domains_list:list) -> bool:
+    domain_parts = urlparse(url).netloc.split('.')
+    for allowed_domain in allowed_domains_list:
+        allowed_parts = allowed_domain.split('.')
+        if domain_parts[-len(allowed_parts):] == allowed_parts:
+            return True
+    return False
+
+def _legacy_text_modify_fnc(text:str, allowed_domains_list:list) -> str:
+    """ 変更前の text_modify_fnc と同じ処理 (呼び出し毎にコンパイルし 3 パス) """
+    url_pattern = re.compile(r'https?://[^\s]+')
+    def filter_url(m):
+        url = m.group(0).replace('http://', 'https://')
+        return url if _is_allowed_url(url, allowed_domains_list) else ''
+    text = url_pattern.sub(filter_url, text)
+    md_link_pattern = re.compile(r'\[([^\]]+)\]\((https?://[^\s\)]+)\)')
+    def replace_link(m):
+        link_text, url = m.groups()
+        url = url.replace('http://', 'https://')
+        return f'[{link_text}]({url})' if _is_allowed_url(url, allowed_domains_list) else link_text
+    text = md_link_pattern.sub(replace_link, text)
+    quoted_url_pattern = re.compile(r'「(https?://[^\s]+?)」')
+    def filter_quoted_url(m):
+        url = m.group(1).replace('http://', 'https://')
+        return f'「{url}」' if _is_allowed_url(url, allowed_domains_list) else ''
+    return quoted_url_pattern.sub(filter_quoted_url, text)
+
+def _make_text(size_kb:int, seed:int = 0) -> str:
+    rng    = random.Random(seed)
+    chunks = []
+    length = 0
+    while length < size_kb * 1024:
+        sentence = rng.choice(SENTENCES)
+        chunks.append(sentence)
+        length  += len(sentence.encode('utf-8'))
+    return ''.join(chunks)
+
+def _make_allowlist(size:int) -> list:
+    return ALLOWED_DOMAINS_LIST + [f'city{i}.example.lg.jp' for i in range(max(0, size - len(ALLOWED_DOMAINS_LIST)))]
+
+def _stream(text:str, allowed_domains_list:list, delta_chars:int) -> str:
+    sanitizer = StreamingUrlSanitizer(allowed_domains_list)
+    chunks    = [sanitizer.feed(text[i:i+delta_chars]) for i in range(0, len(text), delta_chars)]
+    chunks.append(sanitizer.flush())
+    return ''.join(chunks)
+
+def _measure(fnc, repeat:int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fnc()
+    return (time.perf_counter() - start) / repeat
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',       type=int, nargs='+', default=[2, 8, 32], help='回答の大きさ(KB)')
+    parser.add_argument('--repeat',      type=int, default=50)
+    parser.add_argument('--delta-chars', type=int, default=8, help='stream で 1 回に流す文字数')
+    parser.add_argument('--allowlist-size', type=int, nargs='+', default=[3, 1000], help='許可するドメインの件数')
+    args = parser.parse_args()
+
+    print(f'{"impl":<7}{"domains":>8}{"size(KB)":>9}{"time(ms)":>11}{"MB/s":>9}')
+    for allowlist_size in args.allowlist_size:
+        allowed_domains_list = _make_allowlist(allowlist_size)
+        for size_kb in args.sizes:
+            text    = _make_text(size_kb)
+            n_bytes = len(text.encode('utf-8'))
+            for label, fnc in (('before', lambda: _legacy_text_modify_fnc(text, allowed_domains_list)),
+                               ('after',  lambda: text_modify_fnc(text, allowed_domains_list)),
+                               ('stream', lambda: _stream(text, allowed_domains_list, args.delta_chars)),):
+                sec = _measure(fnc, args.repeat)
+                print(f'{label:<7}{allowlist_size:>8}{size_kb:>9}{sec * 1000:>11.3f}{n_bytes / sec / 1e6:>9.2f}')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
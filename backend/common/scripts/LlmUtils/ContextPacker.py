@@ -0,0 +1,44 @@
+import bisect
+import itertools
+from typing import Optional, Sequence
+from .TokenUtils import calc_token, calc_token_upper_bound
+
+
+def pack_history(turn_tokens:Sequence[int],
+                 budget:int,
+                 ) -> int:
+    """
+    budget に収まる直近のヒストリーのターン数を返す (古いものから削る)
+    - turn_tokens: ターンごとのトークン数 (古い順)
+    - prefix sums の二分探索で、合計が budget 以下になる最大の suffix を選ぶ
+    """
+    prefix_sums = list(itertools.accumulate(turn_tokens, initial=0))
+    total       = prefix_sums[-1]
+    if total <= budget:
+        return len(turn_tokens)
+    if budget <= 0:
+        return 0
+    # suffix [start:] の合計 total - prefix_sums[start] が budget 以下になる最小の start
+    start = bisect.bisect_left(prefix_sums, total - budget)
+    return len(turn_tokens) - start
+
+def pack_context(sentence:str,
+                 turn_tokens:Sequence[int],
+                 context_tokens:int,
+                 max_tokens:int     = 0,
+                 base_tokens:int    = 0,
+                 model_name:str     = None,
+                 ) -> Optional[int]:
+    """
+    コンテキスト長 (context_tokens) - 回答の最大トークン数 (max_tokens) - 固定部分 (base_tokens: system / assistant sentence)
+    に、ユーザメッセージ (sentence) と直近のヒストリーが収まるよう、使うヒストリーのターン数を返す
+    - ユーザメッセージだけで収まらない場合は None
+    - バイト数で明らかに収まる場合は sentence をトークン化しない
+    """
+    budget = context_tokens - max_tokens - base_tokens
+    if calc_token_upper_bound(sentence) + sum(turn_tokens) <= budget:
+        return len(turn_tokens)
+    budget -= calc_token(sentence, model_name)
+    if budget < 0:
+        return None
+    return pack_history(turn_tokens, budget)
\ No newline at end of file
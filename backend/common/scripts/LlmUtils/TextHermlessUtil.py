@@ -1,66 +1,198 @@
+import functools
 import re
-from urllib.parse import urlparse
+from typing import Dict, Match, Optional, Union
 
-def is_allowed_url(url:str, allowed_domains_list:list) -> bool:
+# URL の処理 (テキストを 1 パスで処理するため 1 つの正規表現にまとめる。同じ位置では先の選択肢が優先)
+# - md_text / md_url: Markdown のリンク [text](url)
+# - quoted_url:       引用符で囲まれた URL 「url」
+# - url:              それ以外の URL
+URL_PATTERN = re.compile(
+    r'\[(?P<md_text>[^\]]+)\]\((?P<md_url>https?://[^\s\)]+)\)'
+    r'|「(?P<quoted_url>https?://[^\s]+?)」'
+    r'|(?P<url>https?://[^\s]+)'
+)
+BARE_URL_PATTERN = re.compile(r'https?://[^\s]+')
+MD_LINK_PATTERN  = re.compile(r'\[([^\]]+)\]\((https?://[^\s\)]+)\)')
+
+# ストリーミングで次の delta まで保留する末尾 (未完成の Markdown のリンク / 「URL」 / URL の可能性がある部分)
+# - search で最も左の開始位置が見つかる (それより前は確定)
+PENDING_TAIL_PATTERN = re.compile(
+    r'(?:\[[^\]]*(?:\](?:\([^\s\)]*)?)?'                           # [text / [text] / [text](url
+    r'|「(?:h(?:t(?:t(?:p(?:s?(?::(?:/(?:/[^\s」]*)?)?)?)?)?)?)?)?'  # 「 / 「htt / 「https://...
+    r'|h(?:t(?:t(?:p(?:s?(?::(?:/(?:/\S*)?)?)?)?)?)?)?'             # h / htt / https://... (空白まで続く)
+    r')\Z'
+)
+# URL / Markdown のリンク / 「URL」 の先頭になり得る文字 (含まない delta は保留が無ければそのまま送れる)
+URL_START_CHARS_PATTERN = re.compile(r'[h\[「]')
+# Markdown のリンク / 「URL」 の候補を保留する最大文字数 (超えた場合はリンクではないとみなして送る)
+# URL 自体は空白が来るまで保留する
+MAX_PENDING_CHARS = 512
+
+# URL のホスト部分 (scheme:// の後から / ? # \ まで。\ はブラウザが / として扱うため区切りに含める)
+AUTHORITY_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9+.\-]*://([^/?#\\]*)')
+_TERMINAL         = object()
+
+def _normalize_hostname(host:str) -> Optional[str]:
+    # 小文字化・末尾の . を除去し、IDN は punycode (xn--) にする (「。」などの区切りも . になる)
+    if not host.isascii():
+        try:
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            return None
+    host = host.lower().rstrip('.')
+    return host or None
+
+def normalize_host(url:str) -> Optional[str]:
+    """
+    URL のホスト名を比較用に正規化して返す (userinfo / ポートを除く)。取得できない場合は None
+    """
+    m = AUTHORITY_PATTERN.match(url)
+    if m is None:
+        return None
+    host = m.group(1).rpartition('@')[2]  # userinfo (user:pass@) を除く
+    if host.startswith('['):
+        return None                       # IPv6 アドレスはドメインに一致しない
+    return _normalize_hostname(host.partition(':')[0])
+
+
+class DomainMatcher:
+    """
+    許可されたドメインの一覧から、URL のホストがいずれかのドメイン (またはそのサブドメイン) かを判定する
+    - ドメインをラベルの逆順 (jp -> go -> ...) の trie にしておき、ドメインの件数によらずホストのラベル数の手数で判定する
+    - get_domain_matcher で一覧ごとに 1 度だけ作って使い回す
+    """
+
+    def __init__(self, allowed_domains_list:list):
+        self._trie:Dict = {}
+        for allowed_domain in allowed_domains_list:
+            host = _normalize_hostname(allowed_domain.strip())
+            if host is None:
+                continue
+            node = self._trie
+            for label in reversed(host.split('.')):
+                node = node.setdefault(label, {})
+            node[_TERMINAL] = True
+
+    def match_host(self, host:str) -> bool:
+        node = self._trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if _TERMINAL in node:
+                return True
+        return False
+
+    def match_url(self, url:str) -> bool:
+        host = normalize_host(url)
+        return host is not None and self.match_host(host)
+
+@functools.lru_cache(maxsize=64)
+def _get_domain_matcher(allowed_domains:tuple) -> DomainMatcher:
+    return DomainMatcher(allowed_domains)
+
+def get_domain_matcher(allowed_domains_list:Union[list, DomainMatcher]) -> DomainMatcher:
+    """
+    許可されたドメインの一覧の DomainMatcher を返す (一覧ごとにキャッシュ。DomainMatcher はそのまま返す)
+    """
+    if isinstance(allowed_domains_list, DomainMatcher):
+        return allowed_domains_list
+    return _get_domain_matcher(tuple(allowed_domains_list))
+
+def is_allowed_url(url:str, allowed_domains_list:Union[list, DomainMatcher]) -> bool:
     """
     URLが許可されたドメインリストに含まれているかどうかを判定する
     """
-    parsed_url = urlparse(url)
-    domain     = parsed_url.netloc
-    # ドメインをピリオドで分割し、最後の2要素（または必要に応じてより多くの要素）を取得する
-    domain_parts = domain.split('.')
-    for allowed_domain in allowed_domains_list:
-        allowed_parts = allowed_domain.split('.')
-        # 許可されたドメインがURLのドメインで終わっていることを確認
-        if domain_parts[-len(allowed_parts):] == allowed_parts:
-            return True
-    return False
+    return get_domain_matcher(allowed_domains_list).match_url(url)
+
+def _filter_url(url:str, matcher:DomainMatcher) -> str:
+    url = url.replace('http://', 'https://')  # HTTPをHTTPSに変換
+    return url if matcher.match_url(url) else ''
 
-def remove_disallowed_urls(text:str, allowed_domains_list:list) -> str:
+def _replace_url(m:Match, matcher:DomainMatcher) -> str:
+    if m.group('md_url') is not None:
+        # リンクのテキスト内の URL も処理する
+        text = BARE_URL_PATTERN.sub(lambda m_text: _filter_url(m_text.group(0), matcher), m.group('md_text'))
+        url  = _filter_url(m.group('md_url'), matcher)
+        return f'[{text}]({url})' if url else text  # 許可されていないURLはリンクを解除
+    if m.group('quoted_url') is not None:
+        url = _filter_url(m.group('quoted_url'), matcher)
+        return f'「{url}」' if url else ''           # 許可されていないURLを完全に削除
+    return _filter_url(m.group('url'), matcher)
+
+def remove_disallowed_urls(text:str, allowed_domains_list:Union[list, DomainMatcher]) -> str:
     """
     テキストから許可されていないドメインのURLを削除する
     """
-    url_pattern = re.compile(r'https?://[^\s]+')
-    def filter_url(m):
-        url = m.group(0).replace('http://', 'https://')  # HTTPをHTTPSに変換
-        return url if is_allowed_url(url, allowed_domains_list) else ''
-    return url_pattern.sub(filter_url, text)
+    matcher = get_domain_matcher(allowed_domains_list)
+    return BARE_URL_PATTERN.sub(lambda m: _filter_url(m.group(0), matcher), text)
 
-def links_harmless(text:str, allowed_domains_list:list) -> str:
+def links_harmless(text:str, allowed_domains_list:Union[list, DomainMatcher]) -> str:
     """
     Markdown形式のリンクから許可されていないドメインのURLを削除する
     """
-    md_link_pattern = re.compile(r'\[([^\]]+)\]\((https?://[^\s\)]+)\)')
+    matcher = get_domain_matcher(allowed_domains_list)
     def replace_link(m):
         text, url = m.groups()
-        url = url.replace('http://', 'https://')  # HTTPをHTTPSに変換
-        if is_allowed_url(url, allowed_domains_list):
-            return f'[{text}]({url})'             # HTTPSに変換後、リンクを保持
-        else:
-            return text  # 許可されていないURLはリンクを解除
-    return md_link_pattern.sub(replace_link, text)
+        url = _filter_url(url, matcher)
+        return f'[{text}]({url})' if url else text
+    return MD_LINK_PATTERN.sub(replace_link, text)
 
-def text_url_hermless(text:str, allowed_domains_list:list) -> str:
+def text_url_hermless(text:str, allowed_domains_list:Union[list, DomainMatcher]) -> str:
     """
     テキスト内のURLを処理し、許可されたドメインのURLのみを保持する
+    - Markdown のリンク・「URL」・それ以外の URL を 1 パスで処理する
     """
-    # 直接URLとMarkdownリンクを処理
-    text = remove_disallowed_urls(text, allowed_domains_list)
-    text = links_harmless(text, allowed_domains_list)
-    # 引用符で囲まれたURLを処理する
-    quoted_url_pattern = re.compile(r'「(https?://[^\s]+?)」')
-    def filter_quoted_url(m):
-        url = m.group(1).replace('http://', 'https://')
-        if is_allowed_url(url, allowed_domains_list):
-            return f'「{url}」'  # 許可されたURLをそのまま保持
-        else:
-            return ''            # 許可されていないURLを完全に削除
-    
-    text = quoted_url_pattern.sub(filter_quoted_url, text)
-    return text
+    if not text:
+        return text
+    matcher = get_domain_matcher(allowed_domains_list)
+    return URL_PATTERN.sub(functools.partial(_replace_url, matcher=matcher), text)
 
 def text_modify_fnc(text:str,
-                    allowed_domains_list:list = ['go.jp', 'or.jp', 'google.com',],
+                    allowed_domains_list:Union[list, DomainMatcher] = ['go.jp', 'or.jp', 'google.com',],
                     ) -> str:
     text = text_url_hermless(text, allowed_domains_list)
-    return text
\ No newline at end of file
+    return text
+
+
+class StreamingUrlSanitizer:
+    """
+    LLM のストリーミング出力 (delta) に text_modify_fnc と同じ処理を逐次行う
+    - feed(delta) は確定した部分を処理して返し、未完成の URL / Markdown のリンクの可能性がある末尾だけを保留する
+    - 最後に flush() で保留していた部分を処理して返す
+    """
+
+    def __init__(self, allowed_domains_list:list):
+        self.matcher  = get_domain_matcher(allowed_domains_list)
+        self._pending = ''
+
+    def feed(self, delta:str) -> str:
+        if not delta:
+            return ''
+        if not self._pending and not URL_START_CHARS_PATTERN.search(delta):
+            return delta
+        text  = self._pending + delta
+        split = self._pending_start(text)
+        self._pending = text[split:]
+        return text_url_hermless(text[:split], self.matcher)
+
+    def flush(self) -> str:
+        text, self._pending = self._pending, ''
+        return text_url_hermless(text, self.matcher)
+
+    @staticmethod
+    def _pending_start(text:str) -> int:
+        # 末尾まで続く URL 以外の一致 (閉じたリンク・「URL」・空白で終わった URL) より前は確定
+        pos = 0
+        for m in URL_PATTERN.finditer(text):
+            if m.end() == len(text) and m.group('url') is not None:
+                break
+            pos = m.end()
+        while True:
+            m = PENDING_TAIL_PATTERN.search(text, pos)
+            if m is None:
+                return len(text)
+            # URL 以外 ([ / 「 で始まる候補) は MAX_PENDING_CHARS を超えたら諦める
+            if text[m.start()] == 'h' or len(text) - m.start() <= MAX_PENDING_CHARS:
+                return m.start()
+            pos = m.start() + 1
\ No newline at end of file
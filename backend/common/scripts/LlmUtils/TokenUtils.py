@@ -1,5 +1,29 @@
+import functools
 import tiktoken
-from typing import Dict
+from typing import Optional
+
+# モデル名が tiktoken に無い場合 (Gemini 等) と、ヒストリー・ルーム設定の保存用トークン数に使うエンコーディング
+DEFAULT_ENCODING_NAME = 'cl100k_base'
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name:Optional[str] = None) -> tiktoken.Encoding:
+    """
+    モデル名に対応する encoder を返す (encoder はプロセス内で使い回す)
+    tiktoken に無いモデル名の場合は DEFAULT_ENCODING_NAME で代用する
+    """
+    if model_name:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+
+@functools.lru_cache(maxsize=256)
+def _count_tokens(encoding_name:str, sentence:str) -> int:
+    # 同じターン内で同じ文字列を数え直さないよう直近の結果を保持する
+    # - 特殊トークンと同じ文字列 (<|endoftext|> 等) も通常の文字列として数える
+    return len(tiktoken.get_encoding(encoding_name).encode(sentence, disallowed_special=()))
 
 def calc_token(sentence:str   = '',
                model_name:str = None,
@@ -8,25 +32,35 @@ def calc_token(sentence:str   = '',
     現状 tiktoken (OpenAI) だけ対応
     """
     num_tokens = 0
+    if not sentence:
+        return num_tokens
     try:
-        if model_name:
-            encoding      = tiktoken.encoding_for_model(model_name)
-            encoding_name = encoding.name
-        else:
-            encoding_name = 'cl100k_base'
-        num_tokens = len(tiktoken.get_encoding(encoding_name).encode(sentence))
+        num_tokens = _count_tokens(get_encoding(model_name).name, sentence)
     except Exception as e:
         print(e)
 
     return num_tokens
 
-def is_tokens_less_than_settings(sentence:str   = '',
-                                 model_name:str = None,
-                                 max_tokens:int = 0,) -> bool:
+def calc_token_upper_bound(sentence:str = '') -> int:
+    """
+    トークン数の上限 (UTF-8 のバイト数)
+    - tiktoken (byte-level BPE) の 1 トークンは 1 バイト以上なので、トークン数はバイト数を超えない
+    """
+    return len(sentence.encode('utf-8')) if sentence else 0
+
+def is_tokens_less_than_settings(sentence:str    = '',
+                                 model_name:str  = None,
+                                 max_tokens:int  = 0,
+                                 base_tokens:int = 0,) -> bool:
+    """
+    base_tokens (保存済みのトークン数の合計) + sentence のトークン数が max_tokens 以下か
+    - バイト数で明らかに収まる場合は sentence をトークン化しない
+    """
     if max_tokens == 0:
         return True
+    if base_tokens + calc_token_upper_bound(sentence) <= max_tokens:
+        return True
+    if base_tokens + calc_token(sentence, model_name) > max_tokens:
+        return False
     else:
-        if calc_token(sentence, model_name) > max_tokens:
-            return False
-        else:
-            return True
\ No newline at end of file
+        return True
\ No newline at end of file
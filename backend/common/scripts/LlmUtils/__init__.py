@@ -1,8 +1,10 @@
-from .llms import AzureLlm, GcloudLlm, OpenAILlm
+from .llms import AzureLlm, GcloudLlm, OpenAILlm, get_client_pool_stats, get_router_stats
 from .create_messages import (
     create_messages, convert_messages_for_gemini,
 )
-from .TextHermlessUtil import text_modify_fnc
+from .TextHermlessUtil import text_modify_fnc, StreamingUrlSanitizer
 from .TokenUtils import (
-    calc_token, is_tokens_less_than_settings,
-)
\ No newline at end of file
+    DEFAULT_ENCODING_NAME, get_encoding,
+    calc_token, calc_token_upper_bound, is_tokens_less_than_settings,
+)
+from .ContextPacker import pack_history, pack_context
\ No newline at end of file
@@ -35,7 +35,7 @@ def create_messages(formatted_prompt:str,
                     'content': system_sentence,
                 })
             if assistant_sentence:
-                history_list.append({
+                messages.append({
                     'role':    'assistant',
                     'content': assistant_sentence,
                 })
@@ -60,19 +60,20 @@ def convert_messages_for_gemini(messages: List[Dict[str, str]]
         - system_instruction: [{'role': 'system', 'parts': [{'text': ...}]}]
         - contents:           [{'role': 'user'|'model', 'parts': [{'text': ...}]}]
     """
+    system_instruction = []
+    contents           = []
     try:
         if not messages:
             return [], []
         # 最後に登場する system を抜き取る (他の system_sentence 破棄)
+        # - 呼び出し元の messages を変更しないよう pop はしない
         system_index = None
         for idx in reversed(range(len(messages))):
             if messages[idx].get('role') == 'system':
                 system_index = idx
                 break
-        system_instruction = []
         if system_index is not None:
-            system_data = messages.pop(system_index)
-            system_text = system_data.get('content', '')
+            system_text = messages[system_index].get('content', '')
             system_instruction.append({
                 'role': 'system',
                 'parts': [{'text': system_text}]
@@ -81,7 +82,6 @@ def convert_messages_for_gemini(messages: List[Dict[str, str]]
             messages = [m for m in messages if m.get('role') != 'system']
 
         # contents 作成
-        contents = []
         for m in messages:
             role = m.get('role')
             text = m.get('content', '')
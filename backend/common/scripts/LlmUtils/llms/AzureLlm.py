@@ -1,9 +1,15 @@
 from rest_framework.exceptions import ValidationError
 import openai
-import asyncio
-from typing import Dict, Tuple, Union, AsyncGenerator
+from typing import Any, Dict, Tuple, Union, AsyncGenerator
+from .ClientPool import get_azure_openai_client
+from .GenerationParams import merge_generation_params, validate_generation_params
 
 class AzureLlm:
+    """
+    クライアント (接続プール) は ClientPool でプロセス内で使い回す
+    生成パラメータ (model_name, temperature, max_tokens, top_p, frequency_penalty, presence_penalty) は
+    __init__ の値を既定値として、各メソッドの呼び出し時に **generation_params で上書きできる
+    """
 
     def __init__(self,
                  model_name:str  = 'gpt-3.5-turbo',
@@ -24,44 +30,62 @@ class AzureLlm:
             raise ValidationError({'endpoint': 'Please set endpoint.'})
         if not api_version:
             raise ValueError('Please set api_version.')
-        # 想定外のパラメータが設定された場合の処理▽
-        if not (0.0 <= temperature <= 2.0) or not (0.0 <= top_p <= 1.0) or not (-2.0 <= presence_penalty <= 2.0) or not (-2.0 <= frequency_penalty <= 2.0):
-            raise ValueError('llm parameter values error')
-        # 想定外のパラメータが設定された場合の処理△
-
-        self.client = openai.AzureOpenAI(
-                                azure_endpoint = endpoint,
-                                api_key        = api_key,
-                                api_version    = api_version,
-                                http_client    = None,) # IF USE ProxyServer: httpx.Client(proxies=settings.HTTP_PROXY)
-
-        self.model_name        = model_name
-        self.temperature       = temperature
-        self.max_tokens        = max_tokens
-        self.top_p             = top_p
-        self.frequency_penalty = frequency_penalty
-        self.presence_penalty  = presence_penalty
+
+        self.api_key        = api_key
+        self.endpoint       = endpoint
+        self.api_version    = api_version
+        self.default_params = {
+            'model_name':        model_name,
+            'temperature':       temperature,
+            'max_tokens':        max_tokens,
+            'top_p':             top_p,
+            'frequency_penalty': frequency_penalty,
+            'presence_penalty':  presence_penalty,
+        }
+        validate_generation_params(self.default_params)
+
+        self.client        = get_azure_openai_client(self.api_key, self.endpoint, self.api_version, is_async=False)
+        self._async_client = None
+
+    @property
+    def async_client(self) -> openai.AsyncAzureOpenAI:
+        """ 実行中のイベントループのクライアント (呼び出し時に ClientPool から取得する) """
+        if self._async_client is not None:
+            return self._async_client
+        return get_azure_openai_client(self.api_key, self.endpoint, self.api_version, is_async=True)
+
+    @async_client.setter
+    def async_client(self, client:openai.AsyncAzureOpenAI) -> None:
+        # 差し替え用 (None で ClientPool に戻す)
+        self._async_client = client
+
+    def _create_kwargs(self, generation_params:Dict[str, Any]) -> Dict[str, Any]:
+        params = merge_generation_params(self.default_params, generation_params)
+        return {
+            'model':             params['model_name'],
+            'temperature':       params['temperature'],
+            'max_tokens':        params['max_tokens'],
+            'top_p':             params['top_p'],
+            'frequency_penalty': params['frequency_penalty'],
+            'presence_penalty':  params['presence_penalty'],
+        }
         
     def get_response(self,
                      messages:list = [],
                      *,
                      is_return_usage_dict:bool = False,
                      timeout:int               = 60,
+                     **generation_params,
                      ) -> Union[None, str, Tuple[str, Dict[str, int]]]:
 
         if not messages or messages == []:
             return None
 
         response = self.client.chat.completions.create(
-                        model             = self.model_name,
-                        messages          = messages,
-                        temperature       = self.temperature,
-                        max_tokens        = self.max_tokens,
-                        top_p             = self.top_p,
-                        frequency_penalty = self.frequency_penalty,
-                        presence_penalty  = self.presence_penalty,
-                        stream            = False,
-                        timeout           = timeout,)
+                        messages = messages,
+                        stream   = False,
+                        timeout  = timeout,
+                        **self._create_kwargs(generation_params),)
 
         return_responce = response.choices[0].message.content
 
@@ -80,24 +104,18 @@ class AzureLlm:
                                  *,
                                  is_return_usage_dict:bool = False,
                                  timeout:int               = 60,
+                                 **generation_params,
                                  ) -> Union[None, str, Tuple[str, Dict[str, int]]]:
 
         if not messages or messages == []:
             return None
 
-        def sync_call():
-            return self.client.chat.completions.create(
-                        model             = self.model_name,
-                        messages          = messages,
-                        temperature       = self.temperature,
-                        max_tokens        = self.max_tokens,
-                        top_p             = self.top_p,
-                        frequency_penalty = self.frequency_penalty,
-                        presence_penalty  = self.presence_penalty,
-                        stream            = False,
-                        timeout           = timeout,)
-
-        response        = await asyncio.to_thread(sync_call)
+        response = await self.async_client.chat.completions.create(
+                        messages = messages,
+                        stream   = False,
+                        timeout  = timeout,
+                        **self._create_kwargs(generation_params),)
+
         return_responce = response.choices[0].message.content
 
         if is_return_usage_dict:
@@ -113,33 +131,30 @@ class AzureLlm:
     async def async_get_stream_response(self,
                                  messages:list = [],
                                  *,
-                                 asyncio_sleep:float = 0.01,
-                                 timeout:int         = 60,
+                                 timeout:int   = 60,
+                                 **generation_params,
                                  ) -> AsyncGenerator[str, None]:
-
+        """
+        AsyncOpenAI のストリームをそのまま async for で読み出す (イベントループをブロックしない)
+        - 呼び出し側でキャンセル/aclose された場合も finally でストリーム (HTTP 接続) を閉じる
+        """
         if not messages or messages == []:
             return
 
-        def sync_call():
-            return self.client.chat.completions.create(
-                        model             = self.model_name,
-                        messages          = messages,
-                        temperature       = self.temperature,
-                        max_tokens        = self.max_tokens,
-                        top_p             = self.top_p,
-                        frequency_penalty = self.frequency_penalty,
-                        presence_penalty  = self.presence_penalty,
-                        stream            = True,
-                        timeout           = timeout,)
-
-        response = await asyncio.to_thread(sync_call)
-
-        for res in response:
-            try:
-                content = res.choices[0].delta.content
-                if content == None:
+        response = await self.async_client.chat.completions.create(
+                        messages = messages,
+                        stream   = True,
+                        timeout  = timeout,
+                        **self._create_kwargs(generation_params),)
+        try:
+            async for res in response:
+                try:
+                    content = res.choices[0].delta.content
+                    if content == None:
+                        content = ''
+                except:
                     content = ''
-            except:
-                content = ''
-            yield content
-            await asyncio.sleep(asyncio_sleep)
\ No newline at end of file
+                if content:
+                    yield content
+        finally:
+            await response.close()
\ No newline at end of file
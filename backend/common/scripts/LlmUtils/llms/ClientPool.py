@@ -0,0 +1,143 @@
+"""
+LLM プロバイダのクライアントをプロセス内で使い回す
+    - (プロバイダ, sync/async, 認証情報) ごとに 1 つだけ作り、keep-alive の接続プールを共有する
+      (メッセージごとに作り直すと毎回 TCP/TLS ハンドシェイクが発生する)
+    - OpenAI / Azure は h2 がインストールされていれば HTTP/2 を使う
+    - get_client_pool_stats で接続プールの状態を取得できる
+async のクライアントの接続はイベントループに紐づくため、実行中のイベントループごとに作る
+(async_to_sync や asyncio.run で別のループから使っても、前のループの接続を使わない)
+"""
+import asyncio
+import hashlib
+import importlib.util
+import threading
+import time
+import weakref
+import httpx
+import openai
+from google import genai
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+# 接続プール (クライアントごと)
+MAX_CONNECTIONS           = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY_SEC      = 60
+IS_HTTP2                  = importlib.util.find_spec('h2') is not None
+
+_POOLS:Dict[Tuple[str, ...], Dict[str, Any]] = {}
+_ASYNC_POOLS:'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, ...], Dict[str, Any]]]' = weakref.WeakKeyDictionary()
+_POOLS_LOCK = threading.Lock()
+
+
+def _credential_label(*credentials:str) -> str:
+    """ 統計用に認証情報を伏せたラベル """
+    return hashlib.sha256('\0'.join(map(str, credentials)).encode('utf-8')).hexdigest()[:8]
+
+def _get_pooled(provider:str,
+                mode:str,
+                credentials:Tuple[str, ...],
+                factory:Callable[[], Tuple[Any, Any]],
+                ) -> Any:
+    """
+    factory は (クライアント, 接続プールを持つ httpx クライアント) を返す
+    mode が 'async' の場合は実行中のイベントループごとに使い回す (ループ外では RuntimeError)
+    """
+    key  = (provider, mode, *credentials)
+    loop = asyncio.get_running_loop() if mode == 'async' else None
+    with _POOLS_LOCK:
+        pools = _POOLS if loop is None else _ASYNC_POOLS.setdefault(loop, {})
+        pool  = pools.get(key)
+        if pool is None:
+            client, http_client = factory()
+            pool = {
+                'provider':    provider,
+                'mode':        mode,
+                'label':       _credential_label(*credentials),
+                'client':      client,
+                'http_client': http_client,
+                'created_at':  time.time(),
+                'acquired':    0,
+            }
+            pools[key] = pool
+        pool['acquired'] += 1
+    return pool['client']
+
+def _httpx_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections           = MAX_CONNECTIONS,
+                        max_keepalive_connections = MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry          = KEEPALIVE_EXPIRY_SEC,)
+
+def _openai_http_client(is_async:bool) -> Union[httpx.Client, httpx.AsyncClient]:
+    # IF USE ProxyServer: proxy=settings.HTTP_PROXY
+    if is_async:
+        return openai.DefaultAsyncHttpxClient(http2=IS_HTTP2, limits=_httpx_limits())
+    return openai.DefaultHttpxClient(http2=IS_HTTP2, limits=_httpx_limits())
+
+def get_openai_client(api_key:str,
+                      is_async:bool = True,
+                      ) -> openai.OpenAI:
+    def factory():
+        http_client = _openai_http_client(is_async)
+        client_cls  = openai.AsyncOpenAI if is_async else openai.OpenAI
+        return client_cls(api_key=api_key, http_client=http_client), http_client
+    return _get_pooled('openai', 'async' if is_async else 'sync', (api_key,), factory)
+
+def get_azure_openai_client(api_key:str,
+                            endpoint:str,
+                            api_version:str,
+                            is_async:bool = True,
+                            ) -> openai.AzureOpenAI:
+    def factory():
+        http_client = _openai_http_client(is_async)
+        client_cls  = openai.AsyncAzureOpenAI if is_async else openai.AzureOpenAI
+        return client_cls(azure_endpoint = endpoint,
+                          api_key        = api_key,
+                          api_version    = api_version,
+                          http_client    = http_client,), http_client
+    return _get_pooled('azure', 'async' if is_async else 'sync', (api_key, endpoint, api_version), factory)
+
+def get_genai_client(project_name:str,
+                     location_name:str,
+                     is_async:bool = False,
+                     ) -> genai.Client:
+    """
+    genai.Client は sync / aio の httpx クライアントを内部に持つので、(project_name, location_name) ごとに使い回す
+    - is_async: aio を使う場合は実行中のイベントループごとのクライアントを返す
+    (google-genai 1.8 は httpx クライアントを差し替えられないため HTTP/2 にはしない)
+    """
+    def factory():
+        client = genai.Client(vertexai = True,
+                              project  = project_name,
+                              location = location_name,)
+        return client, getattr(getattr(client, '_api_client', None), '_async_httpx_client', None)
+    return _get_pooled('gcloud', 'async' if is_async else 'sync', (project_name, location_name), factory)
+
+def _connection_stats(http_client:Any) -> Dict[str, int]:
+    # httpx (httpcore) の接続プールは公開 API が無いので取得できない場合は空を返す
+    try:
+        connections = http_client._transport._pool.connections
+    except AttributeError:
+        return {}
+    return {
+        'connections':       len(connections),
+        'idle_connections':  sum(1 for conn in connections if conn.is_idle()),
+        'http2_connections': sum(1 for conn in connections if 'HTTP/2' in conn.info()),
+    }
+
+def get_client_pool_stats() -> List[Dict[str, Any]]:
+    """ 使い回しているクライアントごとの接続プールの状態 (認証情報はハッシュのラベルのみ) """
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values()) + [pool for loop_pools in list(_ASYNC_POOLS.values()) for pool in loop_pools.values()]
+    stats = []
+    for pool in pools:
+        stat = {
+            'provider': pool['provider'],
+            'mode':     pool['mode'],
+            'label':    pool['label'],
+            'age_sec':  time.time() - pool['created_at'],
+            'acquired': pool['acquired'], # 取得回数 (2 回目以降は接続プールの再利用)
+            'is_http2': IS_HTTP2 and pool['provider'] != 'gcloud',
+        }
+        stat.update(_connection_stats(pool['http_client']))
+        stats.append(stat)
+    return stats
\ No newline at end of file
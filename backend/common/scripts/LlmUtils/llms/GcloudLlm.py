@@ -3,10 +3,28 @@ from rest_framework.exceptions import ValidationError
 from google import genai
 from google.genai import types
 import asyncio
-from typing import Dict, Tuple, Union, AsyncGenerator
+from typing import Any, Dict, List, Tuple, Union, AsyncGenerator
 from ..create_messages import convert_messages_for_gemini
+from .ClientPool import get_genai_client
+from .GenerationParams import merge_generation_params, validate_generation_params
+
+# 生成パラメータ以外の GenerateContentConfig (呼び出しごとに生成パラメータを上書きして使う)
+BASE_GENERATE_CONTENT_CONFIG = types.GenerateContentConfig(
+    response_modalities = ['TEXT'],
+    safety_settings = [
+        types.SafetySetting(category='HARM_CATEGORY_HATE_SPEECH',       threshold='OFF'),
+        types.SafetySetting(category='HARM_CATEGORY_DANGEROUS_CONTENT', threshold='OFF'),
+        types.SafetySetting(category='HARM_CATEGORY_HARASSMENT',        threshold='OFF'),
+        types.SafetySetting(category='HARM_CATEGORY_SEXUALLY_EXPLICIT', threshold='OFF'),
+    ],
+)
 
 class GcloudLlm:
+    """
+    genai.Client (接続プール) は ClientPool でプロセス内で使い回す
+    生成パラメータ (model_name, temperature, max_tokens, top_p, frequency_penalty, presence_penalty) は
+    __init__ の値を既定値として、各メソッドの呼び出し時に **generation_params で上書きできる
+    """
 
     def __init__(self,
                  model_name:str    = 'gemini-1.5-flash',
@@ -24,49 +42,53 @@ class GcloudLlm:
             raise ValidationError({'project_name': 'Please set project_name.'})
         if not location_name:
             raise ValidationError({'location_name': 'Please set location_name.'})
-        # 想定外のパラメータが設定された場合の処理▽
-        if not (0.0 <= temperature <= 2.0) or not (0.0 <= top_p <= 1.0) or not (-2.0 <= presence_penalty <= 2.0) or not (-2.0 <= frequency_penalty <= 2.0):
-            raise ValueError('llm parameter values error')
-        # 想定外のパラメータが設定された場合の処理△
-
-        self.client = genai.Client(vertexai = True,
-                                   project  = project_name,
-                                   location = location_name,)
-        
-        self.model_name        = model_name
-        self.generate_content_config = types.GenerateContentConfig(
-            temperature         = temperature,
-            max_output_tokens   = max_tokens,
-            top_p               = top_p,
-            frequency_penalty   = frequency_penalty,
-            presence_penalty    = presence_penalty,
-            response_modalities = ['TEXT'],
-            safety_settings = [
-                types.SafetySetting(category='HARM_CATEGORY_HATE_SPEECH',       threshold='OFF'),
-                types.SafetySetting(category='HARM_CATEGORY_DANGEROUS_CONTENT', threshold='OFF'),
-                types.SafetySetting(category='HARM_CATEGORY_HARASSMENT',        threshold='OFF'),
-                types.SafetySetting(category='HARM_CATEGORY_SEXUALLY_EXPLICIT', threshold='OFF'),
-            ],
-        )
+
+        self.project_name  = project_name
+        self.location_name = location_name
+        self.client        = get_genai_client(project_name, location_name)
+        self._async_client = None
+
+        self.default_params = {
+            'model_name':        model_name,
+            'temperature':       temperature,
+            'max_tokens':        max_tokens,
+            'top_p':             top_p,
+            'frequency_penalty': frequency_penalty,
+            'presence_penalty':  presence_penalty,
+        }
+        validate_generation_params(self.default_params)
+
+    @property
+    def async_client(self) -> genai.Client:
+        """ 実行中のイベントループのクライアント (呼び出し時に ClientPool から取得する) """
+        if self._async_client is not None:
+            return self._async_client
+        return get_genai_client(self.project_name, self.location_name, is_async=True)
+
+    @async_client.setter
+    def async_client(self, client:genai.Client) -> None:
+        # 差し替え用 (None で ClientPool に戻す)
+        self._async_client = client
 
     def get_response(self,
                      messages:list = [],
                      *,
                      is_return_usage_dict:bool = False,
                      timeout:int               = 60,
+                     **generation_params,
                      ) -> Union[None, str, Tuple[str, Dict[str, int]]]:
 
         if not messages or messages == []:
             return None
 
         system_instruction, contents = convert_messages_for_gemini(messages)
+        params = merge_generation_params(self.default_params, generation_params)
 
         response = self.client.models.generate_content(
-                        model              = self.model_name,
-                        contents           = contents,
-                        # system_instruction = system_instruction if system_instruction else None,
-                        config             = self.generate_content_config,)
-        
+                        model    = params['model_name'],
+                        contents = contents,
+                        config   = self._get_generate_content_config(params, system_instruction),)
+
         return_responce = response.candidates[0].content.parts[0].text
 
         if is_return_usage_dict:
@@ -84,21 +106,21 @@ class GcloudLlm:
                                  *,
                                  is_return_usage_dict:bool = False,
                                  timeout:int               = 60,
+                                 **generation_params,
                                  ) -> Union[None, str, Tuple[str, Dict[str, int]]]:
 
         if not messages or messages == []:
             return None
         
         system_instruction, contents = convert_messages_for_gemini(messages)
-
-        def sync_call():
-            return self.client.models.generate_content(
-                        model              = self.model_name,
-                        contents           = contents,
-                        # system_instruction = system_instruction if system_instruction else None,
-                        config             = self.generate_content_config,)
-
-        response        = await asyncio.to_thread(sync_call)
+        params = merge_generation_params(self.default_params, generation_params)
+
+        response = await asyncio.wait_for(
+                        self.async_client.aio.models.generate_content(
+                            model    = params['model_name'],
+                            contents = contents,
+                            config   = self._get_generate_content_config(params, system_instruction),),
+                        timeout = timeout,)
         return_responce = response.candidates[0].content.parts[0].text
 
         if is_return_usage_dict:
@@ -114,30 +136,68 @@ class GcloudLlm:
     async def async_get_stream_response(self,
                                  messages:list = [],
                                  *,
-                                 asyncio_sleep:float = 0.01,
-                                 timeout:int         = 60,
+                                 first_token_timeout:float = 30,
+                                 inter_token_timeout:float = 15,
+                                 **generation_params,
                                  ) -> AsyncGenerator[str, None]:
-
+        """
+        aio クライアントのストリームを到着順にそのまま yield する
+        - first_token_timeout: 最初のチャンクが届くまでの最大待ち時間(秒)
+        - inter_token_timeout: チャンク間の最大待ち時間(秒)
+        いずれかを超えた場合は asyncio.TimeoutError を送出する
+        """
         if not messages or messages == []:
             return
 
         system_instruction, contents = convert_messages_for_gemini(messages)
-
-        def sync_call():
-            return self.client.models.generate_content_stream(
-                        model              = self.model_name,
-                        contents           = contents,
-                        # system_instruction = system_instruction if system_instruction else None,
-                        config             = self.generate_content_config,)
-
-        response = await asyncio.to_thread(sync_call)
-
-        for res in response:
-            try:
-                content = res.text
-                if content == None:
+        params = merge_generation_params(self.default_params, generation_params)
+
+        response = await asyncio.wait_for(
+                        self.async_client.aio.models.generate_content_stream(
+                            model    = params['model_name'],
+                            contents = contents,
+                            config   = self._get_generate_content_config(params, system_instruction),),
+                        timeout = first_token_timeout,)
+        response_iter = response.__aiter__()
+        timeout       = first_token_timeout
+        try:
+            while True:
+                try:
+                    res = await asyncio.wait_for(response_iter.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                timeout = inter_token_timeout
+                try:
+                    content = res.text
+                    if content == None:
+                        content = ''
+                except:
                     content = ''
-            except:
-                content = ''
-            yield content
-            await asyncio.sleep(asyncio_sleep)
\ No newline at end of file
+                if content:
+                    yield content
+        finally:
+            # キャンセル/タイムアウト時も上流の HTTP ストリームを閉じる
+            if hasattr(response_iter, 'aclose'):
+                await response_iter.aclose()
+
+    def _get_generate_content_config(self,
+                                     params:Dict[str, Any],
+                                     system_instruction:List[Dict[str, List[Dict[str, str]]]],
+                                     ) -> types.GenerateContentConfig:
+        """
+        生成パラメータと convert_messages_for_gemini の system_instruction を設定した GenerateContentConfig を返す
+        """
+        update = {
+            'temperature':       params['temperature'],
+            'max_output_tokens': params['max_tokens'],
+            'top_p':             params['top_p'],
+            'frequency_penalty': params['frequency_penalty'],
+            'presence_penalty':  params['presence_penalty'],
+        }
+        parts = [types.Part(text=part['text'])
+                 for instruction in (system_instruction or [])
+                 for part in instruction.get('parts', [])
+                 if part.get('text')]
+        if parts:
+            update['system_instruction'] = types.Content(parts=parts)
+        return BASE_GENERATE_CONTENT_CONFIG.model_copy(update=update)
\ No newline at end of file
@@ -0,0 +1,24 @@
+from typing import Any, Dict
+
+GENERATION_PARAM_NAMES = ('model_name', 'temperature', 'max_tokens', 'top_p', 'frequency_penalty', 'presence_penalty',)
+
+
+def merge_generation_params(default_params:Dict[str, Any],
+                            generation_params:Dict[str, Any],
+                            ) -> Dict[str, Any]:
+    """
+    呼び出し時の生成パラメータ (None は未指定) でインスタンスの既定値を上書きして返す
+    """
+    unknown_names = set(generation_params) - set(GENERATION_PARAM_NAMES)
+    if unknown_names:
+        raise TypeError(f'unexpected generation params: {sorted(unknown_names)}')
+    params = dict(default_params)
+    params.update({k: v for k, v in generation_params.items() if v is not None})
+    validate_generation_params(params)
+    return params
+
+def validate_generation_params(params:Dict[str, Any]) -> None:
+    # 想定外のパラメータが設定された場合の処理▽
+    if not (0.0 <= params['temperature'] <= 2.0) or not (0.0 <= params['top_p'] <= 1.0) or not (-2.0 <= params['presence_penalty'] <= 2.0) or not (-2.0 <= params['frequency_penalty'] <= 2.0):
+        raise ValueError('llm parameter values error')
+    # 想定外のパラメータが設定された場合の処理△
\ No newline at end of file
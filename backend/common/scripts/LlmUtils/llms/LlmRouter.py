@@ -0,0 +1,408 @@
+"""
+複数のプロバイダ (OpenAILlm / AzureLlm / GcloudLlm) を候補 (LlmRoute) として、障害・遅延時に切り替えて呼び出す
+    - 候補はプロバイダごとの CircuitBreaker が開いているものを除き、同じモデルの候補を最初のトークンまでの時間 (p50) の短い順に使う
+      (別のモデルの候補 (is_fallback_model) は同じモデルの候補の後ろ)
+    - 最初のトークン (非ストリーミングは回答) が first_token_timeout_sec までに届かない / 失敗した場合は
+      jitter 付きの指数バックオフの後に次の候補で再試行する (最大 retry_limit_n 回)
+    - hedge_after_sec を指定すると、最初のトークンが届かないまま p95 (履歴が少ない場合は hedge_after_sec) を過ぎた時点で
+      次の候補にも同時に送り、先に最初のトークンが届いた方を使う (もう一方は取り消す)
+    - 最初のトークンを返した後の失敗は切り替えずにそのまま送出する (ユーザに途中まで表示されているため)
+CircuitBreaker / LatencyHistogram はプロセス内で共有する
+"""
+import asyncio
+import bisect
+import random
+import time
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from common.scripts.PythonCodeUtils import incr_counter, observe, set_gauge
+
+# 最初のトークンまでの時間のヒストグラムのバケット(秒)
+LATENCY_BUCKETS_SEC = (0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0,)
+
+
+class NoAvailableRouteError(Exception):
+    """ 全ての候補の CircuitBreaker が開いている """
+
+
+def is_retryable_error(e:Exception) -> bool:
+    """
+    別の候補で再試行して良いエラーか
+    - 生成パラメータの誤り (ValueError / TypeError) と 4xx (408, 409, 429 を除く) は再試行しない
+    """
+    if isinstance(e, (ValueError, TypeError)):
+        return False
+    status_code = getattr(e, 'status_code', None) or getattr(e, 'code', None)
+    if isinstance(status_code, int) and 400 <= status_code < 500 and status_code not in (408, 409, 429):
+        return False
+    return True
+
+
+class CircuitBreaker:
+    """
+    failure_threshold 回続けて失敗したら開き (候補から除く)、reset_timeout_sec 経過後に半開 (再び試す) にする
+    半開で成功すれば閉じ、失敗すれば再び開く
+    """
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self,
+                 name:str,
+                 failure_threshold:int   = 5,
+                 reset_timeout_sec:float = 30,):
+        self.name              = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout_sec = reset_timeout_sec
+        self.failures          = 0
+        self.opened_at         = 0.0
+        self._state            = self.CLOSED
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout_sec:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def is_available(self) -> bool:
+        return self.state != self.OPEN
+
+    def record_success(self) -> None:
+        self.failures = 0
+        if self._state != self.CLOSED:
+            self._state = self.CLOSED
+            set_gauge('llm_router.circuit_open', 0, tags={'provider': self.name})
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                incr_counter('llm_router.circuit_opened', tags={'provider': self.name})
+            self._state    = self.OPEN
+            self.opened_at = time.monotonic()
+            set_gauge('llm_router.circuit_open', 1, tags={'provider': self.name})
+
+
+class LatencyHistogram:
+    """
+    LATENCY_BUCKETS_SEC のバケットごとの件数
+    - 合計が decay_count に達するたびに件数を半分にして、直近の傾向を優先する
+    - quantile はバケットの上限値を返す (件数が min_samples 未満の場合は None)
+    """
+
+    def __init__(self,
+                 min_samples:int = 20,
+                 decay_count:int = 1000,):
+        self.min_samples = min_samples
+        self.decay_count = decay_count
+        self.counts      = [0] * (len(LATENCY_BUCKETS_SEC) + 1)
+        self.total       = 0
+
+    def observe(self, seconds:float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_SEC, seconds)] += 1
+        self.total += 1
+        if self.total >= self.decay_count:
+            self.counts = [count // 2 for count in self.counts]
+            self.total  = sum(self.counts)
+
+    def quantile(self, q:float) -> Optional[float]:
+        if self.total < self.min_samples:
+            return None
+        threshold  = q * self.total
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return LATENCY_BUCKETS_SEC[min(i, len(LATENCY_BUCKETS_SEC)-1)]
+        return LATENCY_BUCKETS_SEC[-1]
+
+
+_BREAKERS:Dict[str, CircuitBreaker]                      = {} # provider: CircuitBreaker
+_HISTOGRAMS:Dict[Tuple[str, str, str], LatencyHistogram] = {} # (provider, model_name, 'stream' / 'response'): LatencyHistogram
+
+_BREAKER_MISMATCHES:Set[Tuple[str, int, float]] = set() # 警告済みの (provider, failure_threshold, reset_timeout_sec)
+
+def get_circuit_breaker(provider:str,
+                        failure_threshold:Optional[int]   = None,
+                        reset_timeout_sec:Optional[float] = None,
+                        ) -> CircuitBreaker:
+    """
+    プロバイダごとの CircuitBreaker をプロセス内で共有して返す (プロバイダの障害はアプリをまたいで共通のため)
+    - failure_threshold / reset_timeout_sec は最初の呼び出しの値で作る (None は 5 / 30)。
+      以降に異なる値で呼ばれた場合は既存の値のまま使い、組み合わせごとに 1 度だけ警告を出す
+    """
+    breaker = _BREAKERS.get(provider)
+    if breaker is None:
+        breaker = _BREAKERS[provider] = CircuitBreaker(provider,
+                                                       5  if failure_threshold is None else failure_threshold,
+                                                       30 if reset_timeout_sec is None else reset_timeout_sec,)
+        return breaker
+    is_mismatch = (failure_threshold is not None and max(failure_threshold, 1) != breaker.failure_threshold) \
+               or (reset_timeout_sec is not None and reset_timeout_sec != breaker.reset_timeout_sec)
+    mismatch    = (provider, failure_threshold, reset_timeout_sec)
+    if is_mismatch and mismatch not in _BREAKER_MISMATCHES:
+        _BREAKER_MISMATCHES.add(mismatch)
+        print(f'circuit breaker {provider}: failure_threshold={failure_threshold}, reset_timeout_sec={reset_timeout_sec} '
+              f'are ignored (already created with {breaker.failure_threshold}, {breaker.reset_timeout_sec})')
+    return breaker
+
+def get_latency_histogram(provider:str, model_name:str, kind:str) -> LatencyHistogram:
+    key       = (provider, model_name, kind)
+    histogram = _HISTOGRAMS.get(key)
+    if histogram is None:
+        histogram = _HISTOGRAMS[key] = LatencyHistogram()
+    return histogram
+
+def get_router_stats() -> Dict[str, Any]:
+    """ プロバイダごとの CircuitBreaker の状態と、候補ごとのレイテンシ (p50 / p95) """
+    return {
+        'breakers': [{'provider': breaker.name, 'state': breaker.state, 'failures': breaker.failures}
+                     for breaker in _BREAKERS.values()],
+        'latency':  [{'provider': provider, 'model_name': model_name, 'kind': kind, 'samples': histogram.total,
+                      'p50_sec': histogram.quantile(0.5), 'p95_sec': histogram.quantile(0.95)}
+                     for (provider, model_name, kind), histogram in _HISTOGRAMS.items()],
+    }
+
+
+class LlmRoute:
+    """
+    候補 (provider の llm インスタンスと、その provider で使う model_name)
+    - is_fallback_model: 要求されたモデルと別のモデル (同じモデルの候補が全て使えない場合とヘッジにだけ使う)
+    """
+
+    def __init__(self,
+                 provider:str,
+                 llm:Any,
+                 model_name:str,
+                 is_fallback_model:bool = False,):
+        self.provider          = provider
+        self.llm               = llm
+        self.model_name        = model_name
+        self.is_fallback_model = is_fallback_model
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return get_circuit_breaker(self.provider)
+
+    def histogram(self, kind:str) -> LatencyHistogram:
+        return get_latency_histogram(self.provider, self.model_name, kind)
+
+    def tags(self) -> Dict[str, str]:
+        return {'provider': self.provider, 'model': self.model_name}
+
+
+class LlmRouter:
+    """
+    OpenAILlm / AzureLlm / GcloudLlm と同じ async_get_response / async_get_stream_response を持つ
+    (generation_params の model_name は候補ごとの model_name で上書きする)
+
+    メトリクス (llm_router.*)
+        - attempt / failure / failover / hedged / timeout:  件数 (tags={'provider', 'model'})
+        - first_token_sec / response_sec:                   最初のトークン / 回答までの時間(秒)
+        - circuit_opened / circuit_open:                    CircuitBreaker が開いた件数 / 状態 (tags={'provider'})
+    """
+
+    def __init__(self,
+                 routes:List[LlmRoute],
+                 retry_limit_n:int               = 2,
+                 first_token_timeout_sec:float   = 20,
+                 response_timeout_sec:float      = 60,
+                 backoff_base_sec:float          = 0.2,
+                 backoff_max_sec:float           = 2.0,
+                 hedge_after_sec:Optional[float] = None,):
+        self.routes                  = routes
+        self.retry_limit_n           = max(retry_limit_n, 0)
+        self.first_token_timeout_sec = first_token_timeout_sec
+        self.response_timeout_sec    = response_timeout_sec
+        self.backoff_base_sec        = backoff_base_sec
+        self.backoff_max_sec         = backoff_max_sec
+        self.hedge_after_sec         = hedge_after_sec
+
+    ####################
+    # 候補の順序
+    ####################
+    def plan(self, kind:str) -> List[LlmRoute]:
+        """ CircuitBreaker が開いていない候補を (別モデルか, p50, 定義順) で並べる (履歴が無い候補の p50 は最後) """
+        def sort_key(item:Tuple[int, LlmRoute]):
+            i, route = item
+            p50      = route.histogram(kind).quantile(0.5)
+            return (route.is_fallback_model, p50 if p50 is not None else float('inf'), i)
+        return [route for _, route in sorted(enumerate(self.routes), key=sort_key) if route.breaker.is_available()]
+
+    def _backoff_sec(self, attempt:int) -> float:
+        # full jitter: 同時に失敗したリクエストの再試行が集中しないようにする
+        return random.uniform(0, min(self.backoff_max_sec, self.backoff_base_sec * (2 ** attempt)))
+
+    def _hedge_delay_sec(self, route:LlmRoute, kind:str) -> Optional[float]:
+        if self.hedge_after_sec is None:
+            return None
+        p95 = route.histogram(kind).quantile(0.95)
+        return p95 if p95 is not None else self.hedge_after_sec
+
+    ####################
+    # 呼び出し (再試行・ヘッジ)
+    ####################
+    async def _call(self,
+                    kind:str,
+                    timeout:float,
+                    start:Callable[[LlmRoute], Tuple[Any, Awaitable[Any]]],
+                    close:Callable[[Any], Awaitable[None]],
+                    ) -> Tuple[LlmRoute, Any, Any]:
+        """
+        start(route) は (handle, 最初の結果の awaitable) を返す
+        最初に結果が届いた候補の (route, handle, 結果) を返し、それ以外の handle は close で閉じる
+        """
+        last_error:Optional[Exception] = None
+        failed:List[LlmRoute]          = []
+        for attempt in range(self.retry_limit_n + 1):
+            routes = self.plan(kind)
+            if not routes:
+                raise NoAvailableRouteError('all llm routes are open') from last_error
+            # 直前に失敗した候補は後ろに回す
+            routes = [route for route in routes if route not in failed] + [route for route in routes if route in failed]
+            if attempt:
+                incr_counter('llm_router.failover', tags=routes[0].tags())
+                await asyncio.sleep(self._backoff_sec(attempt - 1))
+            try:
+                return await self._hedged_call(routes, kind, timeout, start, close, failed)
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                print(e)
+                last_error = e
+        raise last_error
+
+    async def _hedged_call(self,
+                           routes:List[LlmRoute],
+                           kind:str,
+                           timeout:float,
+                           start:Callable[[LlmRoute], Tuple[Any, Awaitable[Any]]],
+                           close:Callable[[Any], Awaitable[None]],
+                           failed:List[LlmRoute],
+                           ) -> Tuple[LlmRoute, Any, Any]:
+        loop        = asyncio.get_running_loop()
+        started_at  = loop.time()
+        deadline    = started_at + timeout
+        hedge_delay = self._hedge_delay_sec(routes[0], kind) if len(routes) > 1 else None
+        hedge_at    = started_at + hedge_delay if hedge_delay is not None else None
+        pending:Dict[asyncio.Future, Tuple[LlmRoute, Any, float]] = {}
+        errors:List[Exception] = []
+
+        def launch(route:LlmRoute) -> None:
+            incr_counter('llm_router.attempt', tags=route.tags())
+            handle, awaitable = start(route)
+            pending[asyncio.ensure_future(awaitable)] = (route, handle, loop.time())
+
+        def fail(route:LlmRoute) -> None:
+            incr_counter('llm_router.failure', tags=route.tags())
+            route.breaker.record_failure()
+            if route not in failed:
+                failed.append(route)
+
+        launch(routes[0])
+        try:
+            while pending:
+                wait_until = min(deadline, hedge_at) if hedge_at is not None else deadline
+                done, _    = await asyncio.wait(pending.keys(),
+                                                timeout     = max(wait_until - loop.time(), 0),
+                                                return_when = asyncio.FIRST_COMPLETED,)
+                for future in done:
+                    route, handle, launched_at = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except StopAsyncIteration:
+                        # 空のストリーム
+                        result = None
+                    except Exception as e:
+                        await close(handle)
+                        if not is_retryable_error(e):
+                            raise
+                        fail(route)
+                        errors.append(e)
+                        continue
+                    elapsed = loop.time() - launched_at
+                    route.histogram(kind).observe(elapsed)
+                    observe('llm_router.first_token_sec' if kind == 'stream' else 'llm_router.response_sec',
+                            elapsed, tags=route.tags())
+                    route.breaker.record_success()
+                    return route, handle, result
+                # ヘッジの時刻を過ぎても最初の結果が届いていない場合は次の候補にも送る
+                # (先に送った候補が失敗した場合は _call でバックオフしてから切り替える)
+                if hedge_at is not None and pending and loop.time() >= hedge_at:
+                    hedge_at = None
+                    incr_counter('llm_router.hedged', tags=routes[1].tags())
+                    launch(routes[1])
+                    continue
+                if pending and loop.time() >= deadline:
+                    for route, _, _ in pending.values():
+                        incr_counter('llm_router.timeout', tags=route.tags())
+                        fail(route)
+                    raise asyncio.TimeoutError(f'llm route timeout ({timeout} sec): '
+                                               + ', '.join(f'{route.provider}:{route.model_name}' for route, _, _ in pending.values()))
+            raise errors[-1] if errors else asyncio.TimeoutError('llm route timeout')
+        finally:
+            # 取り消した候補 (ヘッジで負けた / タイムアウト / キャンセル) の上流の接続を閉じる
+            for future, (route, handle, _) in pending.items():
+                future.cancel()
+                await asyncio.wait({future})
+                await close(handle)
+
+    async def async_get_response(self,
+                                 messages:list = [],
+                                 *,
+                                 is_return_usage_dict:bool = False,
+                                 **generation_params,
+                                 ) -> Any:
+        if not messages or messages == []:
+            return None
+
+        def start(route:LlmRoute):
+            return None, route.llm.async_get_response(messages,
+                                                      is_return_usage_dict = is_return_usage_dict,
+                                                      timeout              = self.response_timeout_sec,
+                                                      **dict(generation_params, model_name=route.model_name),)
+
+        _, _, response = await self._call('response', self.response_timeout_sec, start, _close_noop)
+        return response
+
+    async def async_get_stream_response(self,
+                                        messages:list = [],
+                                        **generation_params,
+                                        ) -> AsyncGenerator[str, None]:
+        """
+        最初のトークンが届いた候補のストリームを yield する
+        - 呼び出し側でキャンセル/aclose された場合も finally で上流のストリームを閉じる
+        """
+        if not messages or messages == []:
+            return
+
+        def start(route:LlmRoute):
+            stream = route.llm.async_get_stream_response(messages, **dict(generation_params, model_name=route.model_name))
+            return stream, stream.__anext__()
+
+        route, stream, first = await self._call('stream', self.first_token_timeout_sec, start, _close_stream)
+        try:
+            if first is None:
+                return
+            yield first
+            async for delta in stream:
+                yield delta
+        except Exception as e:
+            if is_retryable_error(e):
+                incr_counter('llm_router.failure', tags=route.tags())
+                route.breaker.record_failure()
+            raise
+        finally:
+            await _close_stream(stream)
+
+
+async def _close_noop(handle:Any) -> None:
+    return None
+
+async def _close_stream(stream:Any) -> None:
+    aclose = getattr(stream, 'aclose', None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        print(e)
\ No newline at end of file
@@ -1,3 +1,11 @@
 from .AzureLlm import AzureLlm
 from .GcloudLlm import GcloudLlm
-from .OpenAILlm import OpenAILlm
\ No newline at end of file
+from .OpenAILlm import OpenAILlm
+from .ClientPool import (
+    get_openai_client, get_azure_openai_client, get_genai_client,
+    get_client_pool_stats,
+)
+from .LlmRouter import (
+    LlmRoute, LlmRouter, CircuitBreaker, LatencyHistogram, NoAvailableRouteError,
+    get_circuit_breaker, get_router_stats, is_retryable_error,
+)
\ No newline at end of file
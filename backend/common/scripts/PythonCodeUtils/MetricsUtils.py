@@ -0,0 +1,74 @@
+"""
+プロセス内の簡易メトリクス
+    - incr_counter / set_gauge / observe で記録し、get_metrics でスナップショットを取得する
+    - add_metrics_hook で外部 (Prometheus, StatsD, ログ等) へ転送する関数を登録できる
+      hook(metric_type:str, name:str, value:float, tags:dict) の形で呼ばれる
+"""
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+MetricsHook = Callable[[str, str, float, Dict[str, str]], None]
+
+_LOCK                                   = threading.Lock()
+_COUNTERS:Dict[str, float]              = defaultdict(float)
+_GAUGES:Dict[str, float]                = {}
+_OBSERVATIONS:Dict[str, List[float]]    = defaultdict(list)
+_MAX_OBSERVATIONS                       = 1000 # 直近の観測値のみ保持
+_HOOKS:List[MetricsHook]                = []
+
+
+def _metric_key(name:str, tags:Optional[Dict[str, str]]) -> str:
+    if not tags:
+        return name
+    return name + '{' + ','.join(f'{k}={v}' for k, v in sorted(tags.items())) + '}'
+
+def _call_hooks(metric_type:str, name:str, value:float, tags:Optional[Dict[str, str]]) -> None:
+    for hook in list(_HOOKS):
+        try:
+            hook(metric_type, name, value, tags or {})
+        except Exception as e:
+            print(e)
+
+def add_metrics_hook(hook:MetricsHook) -> None:
+    with _LOCK:
+        if hook not in _HOOKS:
+            _HOOKS.append(hook)
+
+def remove_metrics_hook(hook:MetricsHook) -> None:
+    with _LOCK:
+        if hook in _HOOKS:
+            _HOOKS.remove(hook)
+
+def incr_counter(name:str, value:float = 1, tags:Optional[Dict[str, str]] = None) -> None:
+    with _LOCK:
+        _COUNTERS[_metric_key(name, tags)] += value
+    _call_hooks('counter', name, value, tags)
+
+def set_gauge(name:str, value:float, tags:Optional[Dict[str, str]] = None) -> None:
+    with _LOCK:
+        _GAUGES[_metric_key(name, tags)] = value
+    _call_hooks('gauge', name, value, tags)
+
+def observe(name:str, value:float, tags:Optional[Dict[str, str]] = None) -> None:
+    with _LOCK:
+        values = _OBSERVATIONS[_metric_key(name, tags)]
+        values.append(value)
+        if len(values) > _MAX_OBSERVATIONS:
+            del values[:len(values) - _MAX_OBSERVATIONS]
+    _call_hooks('observe', name, value, tags)
+
+def get_counter(name:str, tags:Optional[Dict[str, str]] = None) -> float:
+    with _LOCK:
+        return _COUNTERS.get(_metric_key(name, tags), 0)
+
+def get_observations(name:str, tags:Optional[Dict[str, str]] = None) -> List[float]:
+    with _LOCK:
+        return list(_OBSERVATIONS.get(_metric_key(name, tags), []))
+
+def get_metrics() -> Dict[str, Dict[str, float]]:
+    with _LOCK:
+        return {
+            'counters': dict(_COUNTERS),
+            'gauges':   dict(_GAUGES),
+        }
\ No newline at end of file
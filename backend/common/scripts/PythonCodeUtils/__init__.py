@@ -1 +1,6 @@
-from .CodeUtils import inverse_dict_lookup, calc_score_deviation_value, insert_br_multi_lines_optimized
\ No newline at end of file
+from .CodeUtils import inverse_dict_lookup, calc_score_deviation_value, insert_br_multi_lines_optimized
+from .MetricsUtils import (
+    add_metrics_hook, remove_metrics_hook,
+    incr_counter, set_gauge, observe,
+    get_counter, get_observations, get_metrics,
+)
\ No newline at end of file
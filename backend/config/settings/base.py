@@ -167,6 +167,11 @@ try:
     from .extra_settings.ChannelLayers import *
 except ImportError as e:
     print('ImportError occurred: ', e)
+# [LOAD extra_settings] Caches.py
+try:
+    from .extra_settings.Caches import *
+except ImportError as e:
+    print('ImportError occurred: ', e)
 
 # [LOAD security] PasswordHashers.py
 try:
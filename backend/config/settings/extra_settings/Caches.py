@@ -0,0 +1,20 @@
+from django.conf import settings
+
+# LOAD SECRET STEEINGS
+from config.settings.read_env import read_env
+env = read_env(settings.BASE_DIR)
+
+# https://docs.djangoproject.com/ja/4.2/topics/cache/
+# default: これまで通りプロセス内キャッシュ (AccessSecurityMiddleware 等)
+# shared:  ワーカー間で共有するキャッシュ (ルーム設定のキャッシュ等)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND':    'django.core.cache.backends.redis.RedisCache',
+        'LOCATION':   f"redis://{env.get_value('REDIS_HOST',str)}:{env.get_value('REDIS_PORT',int)}/1",
+        'KEY_PREFIX': 'shared',
+        'TIMEOUT':    600,
+    },
+}
\ No newline at end of file
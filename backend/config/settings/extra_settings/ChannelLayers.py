@@ -8,12 +8,16 @@ env = read_env(settings.BASE_DIR)
 # if os.getenv('GAE_APPLICATION', None) or os.getenv('GAE_INSTANCE', None):
 #     os.environ['ASGI_THREADS'] = '5'
 
+# Redis (channel layer 以外からも apps.utils.RedisUtils 経由で参照する)
+REDIS_HOST = env.get_value('REDIS_HOST',str)
+REDIS_PORT = env.get_value('REDIS_PORT',int)
+
 # https://github.com/django/channels_redis
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts':        [(env.get_value('REDIS_HOST',str), env.get_value('REDIS_PORT',int))],
+            'hosts':        [(REDIS_HOST, REDIS_PORT)],
             'expiry':       env.get_value('REDIS_EXPIRY',int),
             'group_expiry': env.get_value('REDIS_GROUP_EXPIRY',int),
             'capacity':     env.get_value('REDIS_CAPACITY',int),
@@ -0,0 +1,81 @@
+from django.test import SimpleTestCase
+import asyncio
+import json
+import sys
+from unittest import mock
+from apps.utils import SocketCodec
+from apps.llmchat.consumers import LlmChatConsumer
+
+consumer_module = sys.modules[LlmChatConsumer.__module__]
+
+
+class _RateLimiter:
+    async def allow(self, key):
+        return True
+
+
+def _make_consumer():
+    # python 3.9 の Queue は作成時のループに紐づくので実行中のループで呼ぶ
+    consumer = LlmChatConsumer.__new__(LlmChatConsumer)
+    consumer.codec                 = SocketCodec()
+    consumer.channel_name          = 'conn-1'
+    consumer.rate_limiter          = _RateLimiter()
+    consumer.receive_queue         = asyncio.Queue(maxsize=10)
+    consumer.generation_task       = None
+    consumer.generation_message_id = None
+    consumer.stream_task           = None
+    consumer.sent                  = []
+
+    async def self_send_message(message_data, is_send_bytes_data=True):
+        consumer.sent.append(message_data)
+    async def stream_send_message(stream, message_id, is_send_bytes_data=True, is_group_send=True):
+        consumer.sent.append({'cmd': 'stream', 'data': {'messageId': message_id}})
+    consumer._self_send_message   = self_send_message
+    consumer._stream_send_message = stream_send_message
+    return consumer
+
+
+class ReceiveQueueTest(SimpleTestCase):
+
+    def test_oversized_frame_keeps_worker(self):
+        """ サイズ超過 / 空のフレームは wsClose を返し、受信キューの処理は続ける """
+        async def run():
+            consumer = _make_consumer()
+            with mock.patch.object(consumer_module, 'SOCKET_REXEIVE_DATA_KB_LIMIT', 1):
+                worker = asyncio.create_task(consumer._receive_worker())
+                consumer.receive_queue.put_nowait(('a' * 4096, None))
+                consumer.receive_queue.put_nowait((None, b''))
+                consumer.receive_queue.put_nowait((json.dumps({'cmd': 'Reconnect'}), None))
+                await asyncio.sleep(0.05)
+                is_alive = not worker.done()
+                worker.cancel()
+            return consumer, is_alive
+        consumer, is_alive = asyncio.run(run())
+        self.assertTrue(is_alive)
+        self.assertEqual([message['cmd'] for message in consumer.sent], ['wsClose', 'wsClose', 'Reconnect'])
+
+    def test_one_generation_per_connection(self):
+        """ 生成中の SendUserMessage は生成中の旨を返し、StopGeneration で生成を取り消す """
+        started = []
+
+        async def receive_user_message(user_message, message_id, is_possible_compress):
+            started.append(user_message)
+            await asyncio.Event().wait()
+
+        async def run():
+            consumer                       = _make_consumer()
+            consumer._receive_user_message = receive_user_message
+            worker                         = asyncio.create_task(consumer._receive_worker())
+            for i, message in enumerate(['first', 'second']):
+                data = {'message': message, 'messageId': f'm{i}'}
+                consumer.receive_queue.put_nowait((json.dumps({'cmd': 'SendUserMessage', 'data': data}), None))
+            await asyncio.sleep(0.01)
+            consumer.receive_queue.put_nowait((json.dumps({'cmd': 'StopGeneration', 'data': {'messageId': 'm0'}}), None))
+            await asyncio.sleep(0.05)
+            worker.cancel()
+            return consumer
+        consumer = asyncio.run(run())
+        self.assertTrue(consumer.generation_task.cancelled())
+        self.assertEqual(started, ['first'])
+        complete = [message['data']['messageId'] for message in consumer.sent if message['cmd'] == 'isStreamingComplete']
+        self.assertEqual(complete, ['m1', 'm0'])
\ No newline at end of file
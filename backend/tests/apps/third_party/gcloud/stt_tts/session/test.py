@@ -0,0 +1,103 @@
+from django.test import SimpleTestCase
+import asyncio
+from types import SimpleNamespace
+from unittest import mock
+from apps.third_party.gcloud.stt_tts import consumers
+from apps.utils import LocalSessionLimiter, SocketCodec
+from common.scripts.PythonCodeUtils import get_counter, get_observations
+
+# 20ms の音声 (VAD を通る大きさの矩形波)
+VOICE_CHUNK = (b'\xd0\x07' * 10 + b'\x30\xf8' * 10) * 16
+
+
+def _make_consumer(limiter:LocalSessionLimiter, channel_name:str, user_pk:int = 1):
+    consumer = consumers.ThirdPartyGcloudSttTtsConsumer.__new__(consumers.ThirdPartyGcloudSttTtsConsumer)
+    consumer.codec              = SocketCodec()
+    consumer.channel_name       = channel_name
+    consumer.connect_user       = SimpleNamespace(pk=user_pk)
+    consumer.stt_sessions       = {}
+    consumer.session_counter    = 0
+    consumer.current_session_id = None
+    consumer.is_stt_rejected    = False
+    consumer.stt_limiter        = limiter
+    consumer.sent               = []
+
+    async def send(text_data=None, bytes_data=None):
+        consumer.sent.append(consumer.codec.decode_text(text_data))
+    async def run_streaming_recognize(session_id):
+        # Gcloud が止まっている (キューを読まない)
+        await asyncio.Event().wait()
+    consumer.send                     = send
+    consumer._run_streaming_recognize = run_streaming_recognize
+    return consumer
+
+
+class SttSessionTest(SimpleTestCase):
+
+    def test_user_limit_across_connections(self):
+        """ ユーザの同時セッション数は接続をまたいで数え、上限を超えた発話は sttend まで捨てる """
+        limiter = LocalSessionLimiter()
+        first   = _make_consumer(limiter, 'conn-1')
+        second  = _make_consumer(limiter, 'conn-2')
+
+        async def run():
+            with mock.patch.object(consumers, 'STT_MAX_SESSIONS_PER_USER', 1):
+                await first._handle_audio(VOICE_CHUNK)
+                await second._handle_audio(VOICE_CHUNK)
+                await second._handle_audio(VOICE_CHUNK)
+                self.assertEqual(len(first.stt_sessions), 1)
+                self.assertEqual(second.stt_sessions, {})
+                self.assertEqual([message['status'] for message in second.sent], [429])
+                await first._cleanup_session(first.current_session_id, reason='end')
+                await second._handle_audio(b'sttend')
+                await second._handle_audio(VOICE_CHUNK)
+                self.assertEqual(len(second.stt_sessions), 1)
+                await second._cleanup_session(second.current_session_id, reason='end')
+        asyncio.run(run())
+        self.assertIsNone(first.current_session_id)
+
+    def test_bounded_queue_and_idle_reaper(self):
+        """ キューが一杯なら古いフレームを捨て、音声が届かないセッションは閉じる """
+        consumer    = _make_consumer(LocalSessionLimiter(), 'conn-1')
+        idle_before = get_counter('stt_tts.stt_session_closed', tags={'reason': 'idle'})
+        n_ratio     = len(get_observations('stt_tts.stt_forwarded_ratio'))
+
+        async def run():
+            with mock.patch.multiple(consumers,
+                                     STT_SESSION_QUEUE_MAX_FRAMES    = 3,
+                                     STT_SESSION_IDLE_SEC            = 0.05,
+                                     STT_SESSION_REAPER_INTERVAL_SEC = 0.02,):
+                for _ in range(30):
+                    await consumer._handle_audio(VOICE_CHUNK)
+                session = consumer.stt_sessions[consumer.current_session_id]
+                self.assertEqual(session['queue'].qsize(), 3)
+                reaper = asyncio.create_task(consumer._reap_stt_sessions())
+                await asyncio.sleep(0.2)
+                reaper.cancel()
+        asyncio.run(run())
+        self.assertEqual(consumer.stt_sessions, {})
+        self.assertTrue(consumer.sent[-1]['is_end'])
+        self.assertEqual(get_counter('stt_tts.stt_session_closed', tags={'reason': 'idle'}), idle_before + 1)
+        self.assertEqual(len(get_observations('stt_tts.stt_forwarded_ratio')), n_ratio + 1)
+
+    def test_sttend_survives_overflow(self):
+        """ キューが一杯でも b'sttend' は捨てずに最後に入れる """
+        consumer = _make_consumer(LocalSessionLimiter(), 'conn-1')
+
+        async def run():
+            with mock.patch.multiple(consumers,
+                                     STT_SESSION_QUEUE_MAX_FRAMES = 3,
+                                     STT_SESSION_QUEUE_POLICY     = 'drop_oldest',):
+                for _ in range(30):
+                    await consumer._handle_audio(VOICE_CHUNK)
+                session_id = consumer.current_session_id
+                await consumer._handle_audio(b'sttend')
+                await consumer._handle_audio(b'sttend')
+                queue = consumer.stt_sessions[session_id]['queue']
+                items = [queue.get_nowait() for _ in range(queue.qsize())]
+                await consumer._cleanup_session(session_id, reason='end')
+            return items
+        items = asyncio.run(run())
+        self.assertEqual(len(items), 4)
+        self.assertEqual(items[-1], b'sttend')
+        self.assertNotIn(b'sttend', items[:-1])
\ No newline at end of file
@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+import io
+import numpy as np
+import wave
+from apps.third_party.gcloud.stt_tts.utils import SpeechFrameGate, strip_wav_header
+
+SAMPLE_RATE = 16000
+
+
+def _voice(sec:float) -> np.ndarray:
+    t = np.arange(int(SAMPLE_RATE * sec)) / SAMPLE_RATE
+    return (3000 * np.sin(2 * np.pi * 150 * t) + 1500 * np.sin(2 * np.pi * 450 * t)).astype('<i2')
+
+def _silence(sec:float, seed:int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(0, 30, int(SAMPLE_RATE * sec)).astype('<i2')
+
+def _wav(samples:np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(samples.tobytes())
+    return buf.getvalue()
+
+def _feed(gate:SpeechFrameGate, samples:np.ndarray, chunk_ms:int = 25) -> list:
+    n      = SAMPLE_RATE * chunk_ms // 1000
+    frames = []
+    for i in range(0, len(samples), n):
+        frames += gate.feed(_wav(samples[i:i+n]))
+    return frames + gate.flush()
+
+
+class SpeechFrameGateTest(SimpleTestCase):
+
+    def test_strip_wav_header(self):
+        """ WAV のヘッダを取り除き、ヘッダの無い PCM はそのまま返す """
+        samples = _voice(0.01)
+        self.assertEqual(strip_wav_header(_wav(samples)), samples.tobytes())
+        self.assertEqual(strip_wav_header(samples.tobytes()), samples.tobytes())
+
+    def test_trim_silence(self):
+        """ 長い無音は送らず、音声は前後を残して約 100ms ごとにまとめて送る """
+        samples = np.concatenate([_silence(3.0), _voice(1.0), _silence(3.0, seed=1), _voice(1.0), _silence(1.0, seed=2)])
+        gate    = SpeechFrameGate(sample_rate=SAMPLE_RATE, frame_ms=100, preroll_ms=200, hangover_ms=500)
+        frames  = _feed(gate, samples)
+        self.assertAlmostEqual(gate.received_sec, 9.0, places=2)
+        # 音声 1 秒 + 前 0.2 秒 + 後 0.5 秒 を 2 回
+        self.assertAlmostEqual(gate.forwarded_sec, 3.4, delta=0.1)
+        self.assertEqual(sum(len(frame) for frame in frames), gate.forwarded_samples * 2)
+        self.assertTrue(all(len(frame) <= 3200 for frame in frames))
+        self.assertLessEqual(len(frames), 40)
+        # 音声は全て送る
+        forwarded = np.frombuffer(b''.join(frames), dtype='<i2')
+        self.assertEqual(np.count_nonzero(np.abs(forwarded) > 1000), np.count_nonzero(np.abs(samples) > 1000))
+
+    def test_keepalive(self):
+        """ 無音が続いても keepalive_sec ごとに 1 区間は送る """
+        gate   = SpeechFrameGate(sample_rate=SAMPLE_RATE, keepalive_sec=1.0)
+        frames = _feed(gate, _silence(3.5))
+        self.assertEqual(len(frames), 3)
+        self.assertAlmostEqual(gate.forwarded_sec, 0.06, places=3)
+
+    def test_without_vad(self):
+        """ is_vad=False の場合はまとめるだけ """
+        samples = _silence(1.0)
+        gate    = SpeechFrameGate(sample_rate=SAMPLE_RATE, is_vad=False)
+        frames  = _feed(gate, samples)
+        self.assertEqual(b''.join(frames), samples.tobytes())
+        self.assertEqual(len(frames), 10)
\ No newline at end of file
@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase, override_settings
+import asyncio
+from apps.utils import VersionedReadThroughCache
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default',},
+    'shared':  {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared',},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class VersionedReadThroughCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.db    = {'room': {'model_name': 'gpt-4o', 'version': 1}}
+        self.loads = 0
+
+        async def loader(key):
+            self.loads += 1
+            value = self.db.get(key)
+            return dict(value) if value else None
+
+        self.cache = VersionedReadThroughCache(namespace='test:room_settings', loader=loader, l1_ttl_sec=60)
+        self.cache.delete('room')
+
+    def test_read_through(self):
+        """ 2 回目以降は loader を呼ばずに L1 から返す """
+        self.assertEqual(asyncio.run(self.cache.aget('room'))['model_name'], 'gpt-4o')
+        self.assertEqual(asyncio.run(self.cache.aget('room'))['model_name'], 'gpt-4o')
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+
+    def test_returns_copy(self):
+        """ 呼び出し側で変更してもキャッシュには影響しない """
+        asyncio.run(self.cache.aget('room'))['model_name'] = 'changed'
+        self.assertEqual(asyncio.run(self.cache.aget('room'))['model_name'], 'gpt-4o')
+
+    def test_set_if_newer_ignores_old_version(self):
+        """ キャッシュ済みより古い version では上書きしない """
+        self.cache.set_if_newer('room', {'model_name': 'new', 'version': 3})
+        self.cache.set_if_newer('room', {'model_name': 'old', 'version': 2})
+        self.assertEqual(asyncio.run(self.cache.aget('room'))['model_name'], 'new')
+        self.assertEqual(self.loads, 0)
\ No newline at end of file
@@ -0,0 +1,52 @@
+from django.test import SimpleTestCase
+import json
+import msgpack
+from apps.utils import CODEC_JSON, CODEC_MSGPACK, CODEC_ORJSON, SocketCodec, negotiate_codec
+
+
+class NegotiateCodecTest(SimpleTestCase):
+
+    def test_subprotocol(self):
+        """ 対応しているサブプロトコルが優先される """
+        scope = {'subprotocols': ['unknown', 'chat.msgpack'], 'query_string': b'codec=orjson'}
+        self.assertEqual(negotiate_codec(scope), (CODEC_MSGPACK, 'chat.msgpack'))
+
+    def test_query_string(self):
+        """ サブプロトコルが無ければクエリパラメータ """
+        self.assertEqual(negotiate_codec({'query_string': b'codec=orjson'}), (CODEC_ORJSON, None))
+
+    def test_fallback(self):
+        """ 指定が無い / 未対応の場合は json """
+        self.assertEqual(negotiate_codec({}), (CODEC_JSON, None))
+        self.assertEqual(negotiate_codec({'query_string': b'codec=xml'}), (CODEC_JSON, None))
+
+
+class SocketCodecTest(SimpleTestCase):
+
+    def _stream_event(self, sender:SocketCodec, text:str):
+        message_data = {'cmd': 'SendUserMessage', 'data': {'messageId': 'm1', 'llmResponse': text}}
+        return sender.build_stream_event('m1', text, message_data, is_send_bytes_data=False)
+
+    def test_compact_stream_frames(self):
+        """ msgpack は StreamStart ヘッダの後 [stream_id, text] で送る """
+        sender, receiver = SocketCodec(CODEC_JSON), SocketCodec(CODEC_MSGPACK)
+        first  = receiver.stream_frames(self._stream_event(sender, 'こん'))
+        second = receiver.stream_frames(self._stream_event(sender, 'にちは'))
+        header = msgpack.unpackb(first[0]['bytes_data'])
+        self.assertEqual(header['cmd'], 'StreamStart')
+        self.assertEqual(msgpack.unpackb(first[1]['bytes_data']), [header['sid'], 'こん'])
+        self.assertEqual(len(second), 1)
+        self.assertEqual(msgpack.unpackb(second[0]['bytes_data']), [header['sid'], 'にちは'])
+
+    def test_json_stream_frames(self):
+        """ json は従来通り SendUserMessage を送る """
+        sender = SocketCodec(CODEC_JSON)
+        frames = SocketCodec(CODEC_JSON).stream_frames(self._stream_event(sender, 'a'))
+        self.assertEqual(json.loads(frames[0]['text_data'])['cmd'], 'SendUserMessage')
+
+    def test_frame_for_event_encodes_once_per_codec(self):
+        """ 同じコーデックの受信者はイベント内のフレームを共有する """
+        event = SocketCodec(CODEC_JSON).build_event('send_encoded_message', {'cmd': 'x'}, is_send_bytes_data=False)
+        frame = SocketCodec(CODEC_ORJSON).frame_for_event(event)
+        self.assertIs(SocketCodec(CODEC_ORJSON).frame_for_event(event), frame)
+        self.assertEqual(set(event['frames']), {CODEC_JSON, CODEC_ORJSON})
\ No newline at end of file
@@ -0,0 +1,55 @@
+from django.test import SimpleTestCase
+import asyncio
+from channels.layers import InMemoryChannelLayer
+from apps.utils import DirectDelivery
+
+
+class _Consumer:
+
+    def __init__(self, channel_name, channel_layer):
+        self.channel_name  = channel_name
+        self.channel_layer = channel_layer
+        self.received      = []
+
+    async def send_text_data_message(self, event):
+        self.received.append(event['message'])
+
+
+class DirectDeliveryTest(SimpleTestCase):
+
+    def test_local_members_bypass_channel_layer(self):
+        """ 同一プロセス内のメンバーには channel layer を経由せずに送信される """
+        async def run():
+            layer = InMemoryChannelLayer()
+            a, b  = _Consumer('a', layer), _Consumer('b', layer)
+            delivery_a, delivery_b = DirectDelivery(a, 'room_x'), DirectDelivery(b, 'room_x')
+            delivery_a.register()
+            delivery_b.register()
+            delivery_a.update_members(['a', 'b', 'remote'])
+            for i in range(3):
+                await delivery_a.group_send({'type': 'send_text_data_message', 'message': i})
+            await delivery_a.self_send({'type': 'send_text_data_message', 'message': 'self'})
+            remote = [(await layer.receive('remote'))['message'] for _ in range(3)]
+            delivery_a.unregister()
+            delivery_b.unregister()
+            return a.received, b.received, remote
+
+        a_received, b_received, remote = asyncio.run(run())
+        self.assertEqual(a_received, [0, 1, 2, 'self'])
+        self.assertEqual(b_received, [0, 1, 2])
+        self.assertEqual(remote, [0, 1, 2])
+
+    def test_unknown_members_use_channel_layer(self):
+        """ メンバー確定前は channel layer 経由で送信される """
+        async def run():
+            layer = InMemoryChannelLayer()
+            a     = _Consumer('a', layer)
+            delivery = DirectDelivery(a, 'room_y')
+            delivery.register()
+            await delivery.self_send({'type': 'send_text_data_message', 'message': 'self'})
+            delivery.unregister()
+            return a.received, (await layer.receive('a'))['message']
+
+        a_received, via_layer = asyncio.run(run())
+        self.assertEqual(a_received, [])
+        self.assertEqual(via_layer, 'self')
\ No newline at end of file
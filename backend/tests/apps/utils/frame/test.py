@@ -0,0 +1,37 @@
+from django.test import SimpleTestCase
+import brotli
+import json
+from apps.utils import encode_frame, encode_audio_frame, decode_audio_frame
+
+
+class EncodeFrameTest(SimpleTestCase):
+
+    def test_small_payload_is_not_compressed(self):
+        """ compress_min_bytes 未満はテキストフレームで返す """
+        frame = encode_frame({'cmd': 'SendUserMessage', 'data': 'a'}, is_send_bytes_data=True, compress_min_bytes=1024)
+        self.assertEqual(json.loads(frame['text_data'])['data'], 'a')
+        self.assertNotIn('bytes_data', frame)
+
+    def test_large_payload_is_compressed(self):
+        """ compress_min_bytes 以上は brotli で圧縮したバイナリフレームで返す """
+        message_data = {'cmd': 'isStreamingComplete', 'data': 'テスト' * 200}
+        frame = encode_frame(message_data, is_send_bytes_data=True, compress_min_bytes=256)
+        self.assertEqual(json.loads(brotli.decompress(frame['bytes_data']).decode('utf-8')), message_data)
+
+    def test_text_mode(self):
+        """ is_send_bytes_data=False の場合は常にテキストフレーム """
+        frame = encode_frame({'data': 'テスト' * 200}, is_send_bytes_data=False, compress_min_bytes=0)
+        self.assertIn('text_data', frame)
+
+
+class AudioFrameTest(SimpleTestCase):
+
+    def test_round_trip(self):
+        """ ヘッダ (tts_id / seq / 最後のフレーム) と音声を取り出せる """
+        frame = encode_audio_frame(7, 2, True, b'OggS\x00audio')
+        self.assertEqual(decode_audio_frame(frame), (7, 2, True, b'OggS\x00audio'))
+        self.assertEqual(decode_audio_frame(encode_audio_frame(7, 0, False, b''))[2:], (False, b''))
+
+    def test_other_frame(self):
+        """ 音声以外のバイナリフレーム (brotli / msgpack) は None """
+        self.assertIsNone(decode_audio_frame(brotli.compress(json.dumps({'cmd': 'tts'}).encode('utf-8'))))
\ No newline at end of file
@@ -0,0 +1,77 @@
+from django.test import SimpleTestCase
+import asyncio
+from unittest import mock, skipUnless
+from apps.utils import RoomHistoryBuffer
+from apps.utils import HistoryUtils
+from apps.llmchat.utils import DatabaseSyncUtils
+
+try:
+    # Lua スクリプトを実行するため fakeredis[lua] (lupa) を使う
+    import fakeredis
+    import lupa
+except ImportError as e:
+    fakeredis = None
+
+
+def _turn(i:int):
+    return {'message_id': f'm{i}', 'user_message': f'u{i}', 'llm_response': f'a{i}', 'tokens': i}
+
+
+@skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RoomHistoryBufferTest(SimpleTestCase):
+
+    def setUp(self):
+        server  = fakeredis.FakeServer()
+        patcher = mock.patch.multiple(HistoryUtils,
+                                      get_async_redis_client = lambda: fakeredis.FakeAsyncRedis(server=server, decode_responses=True),
+                                      get_redis_client       = lambda: fakeredis.FakeRedis(server=server, decode_responses=True),)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buffer = RoomHistoryBuffer(namespace='test', max_turns=3, dirty_ttl_sec=1)
+
+    def test_append_before_fill(self):
+        """ 未構築のバッファには追加せず、dirty の間は構築しない (DB 読み込み中の追加を取りこぼさない) """
+        async def run():
+            self.assertIsNone(await self.buffer.aget('room', 2))
+            self.assertFalse(await self.buffer.aappend('room', _turn(1)))
+            self.assertFalse(await self.buffer.afill('room', [_turn(0)]))
+            self.assertIsNone(await self.buffer.aget('room', 2))
+            await asyncio.sleep(1.1)
+            self.assertTrue(await self.buffer.afill('room', [_turn(0), _turn(1)]))
+            return await self.buffer.aget('room', 2)
+        self.assertEqual([turn['message_id'] for turn in asyncio.run(run())], ['m0', 'm1'])
+
+    def test_trim_to_max_turns(self):
+        """ 最大ターン数まで古い順に保持し、それを超える件数は未構築扱い (None) """
+        async def run():
+            self.assertTrue(await self.buffer.afill('room', [_turn(i) for i in range(5)]))
+            self.assertEqual([turn['message_id'] for turn in await self.buffer.aget('room', 3)], ['m2', 'm3', 'm4'])
+            for i in range(5, 7):
+                self.assertTrue(await self.buffer.aappend('room', _turn(i)))
+            self.assertIsNone(await self.buffer.aget('room', 4))
+            return await self.buffer.aget('room', 3)
+        self.assertEqual([turn['message_id'] for turn in asyncio.run(run())], ['m4', 'm5', 'm6'])
+
+    def test_invalidate_forces_db_refill(self):
+        """ メッセージの変更・削除 (invalidate) 後は DB から読み直す """
+        db    = [_turn(i) for i in range(3)]
+        loads = []
+
+        async def load_history_turns(room_id, history_len):
+            loads.append(history_len)
+            return [dict(turn) for turn in db[-history_len:]]
+
+        async def run():
+            with mock.patch.multiple(DatabaseSyncUtils,
+                                     room_history_buffer = self.buffer,
+                                     MAX_HISSTORY_N      = 3,
+                                     _load_history_turns = load_history_turns,):
+                self.assertEqual(len(await DatabaseSyncUtils.get_history_turns('room', 2)), 2)
+                self.assertEqual(len(await DatabaseSyncUtils.get_history_turns('room', 2)), 2)
+                self.assertEqual(len(loads), 1)
+                db[-1]['llm_response'] = 'edited'
+                DatabaseSyncUtils.invalidate_history_cache('room')
+                turns = await DatabaseSyncUtils.get_history_turns('room', 2)
+                self.assertEqual(len(loads), 2)
+                return turns
+        self.assertEqual(asyncio.run(run())[-1]['llm_response'], 'edited')
\ No newline at end of file
@@ -0,0 +1,50 @@
+from django.test import SimpleTestCase
+import asyncio
+from unittest import mock, skipUnless
+from apps.utils import RoomPresence
+from apps.utils import PresenceUtils
+
+try:
+    # Lua スクリプトを実行するため fakeredis[lua] (lupa) を使う
+    import fakeredis
+    import lupa
+except ImportError as e:
+    fakeredis = None
+
+
+@skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RoomPresenceTest(SimpleTestCase):
+
+    def setUp(self):
+        server  = fakeredis.FakeServer()
+        patcher = mock.patch.object(PresenceUtils, 'get_async_redis_client',
+                                    lambda: fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.presence = RoomPresence(namespace='test', ttl_sec=1)
+
+    def test_join_and_heartbeat_prune_stale(self):
+        """ heartbeat が途絶えたメンバーは join で除去して返し、除去後の heartbeat は is_alive=False """
+        async def run():
+            self.assertEqual(await self.presence.join('room', 'a', 'A', 'chan-a', 1.0), [])
+            await asyncio.sleep(1.1)
+            stale = await self.presence.join('room', 'b', 'B', 'chan-b', 2.0)
+            self.assertEqual(stale, [{'access_id': 'a', 'user_name': 'A'}])
+            self.assertEqual(await self.presence.members('room'), [{'access_id': 'b', 'user_name': 'B'}])
+            self.assertEqual(await self.presence.channel_names('room'), ['chan-b'])
+            self.assertEqual(await self.presence.heartbeat('room', 'a'), (False, []))
+            self.assertEqual(await self.presence.heartbeat('room', 'b'), (True, []))
+            self.assertEqual(await self.presence.members('room'), [{'access_id': 'b', 'user_name': 'B'}])
+        asyncio.run(run())
+
+    def test_leave_is_idempotent(self):
+        """ leave は登録中のメンバーの時だけ True (SocketDisconnect を 1 度だけ送る) """
+        async def run():
+            await self.presence.join('room', 'a', 'A', 'chan-a', 1.0)
+            await self.presence.join('room', 'b', 'B', 'chan-b', 2.0)
+            self.assertTrue(await self.presence.leave('room', 'a'))
+            self.assertFalse(await self.presence.leave('room', 'a'))
+            self.assertIsNone(await self.presence.get_channel_name('room', 'a'))
+            self.assertEqual(await self.presence.get_channel_name('room', 'b'), 'chan-b')
+            self.assertEqual(await self.presence.heartbeat('room', 'a'), (False, []))
+        asyncio.run(run())
\ No newline at end of file
@@ -0,0 +1,43 @@
+from django.test import SimpleTestCase
+import asyncio
+from unittest import mock
+from apps.utils import LocalTokenBucketLimiter, RedisTokenBucketLimiter, get_socket_rate_limiter
+from apps.utils import RateLimitUtils
+
+
+def _raise_redis_error():
+    raise ConnectionError('redis is down')
+
+
+class TokenBucketLimiterTest(SimpleTestCase):
+
+    def test_burst_and_refill(self):
+        """ 容量までは連続で通し、超えた分は補充されるまで遮断する (キーごと) """
+        limiter = LocalTokenBucketLimiter(rate_per_sec=50, capacity=3)
+
+        async def run():
+            self.assertEqual([await limiter.allow('conn-1') for _ in range(4)], [True, True, True, False])
+            self.assertTrue(await limiter.allow('conn-2'))
+            await asyncio.sleep(0.05)
+            self.assertTrue(await limiter.allow('conn-1'))
+            await limiter.discard('conn-1')
+            self.assertEqual([await limiter.allow('conn-1') for _ in range(4)], [True, True, True, False])
+        asyncio.run(run())
+
+    def test_redis_fallback(self):
+        """ Redis に接続できない場合はプロセス内の token bucket で判定する """
+        limiter = RedisTokenBucketLimiter(rate_per_sec=1, capacity=2, key_prefix='ratelimit:test')
+
+        async def run():
+            with mock.patch.object(RateLimitUtils, 'get_async_redis_client', _raise_redis_error):
+                result = [await limiter.allow('conn-1') for _ in range(3)]
+                await limiter.discard('conn-1')
+                return result + [await limiter.allow('conn-1')]
+        self.assertEqual(asyncio.run(run()), [True, True, False, True])
+
+    def test_get_socket_rate_limiter(self):
+        """ namespace / backend / 流量ごとに共有する """
+        self.assertIs(get_socket_rate_limiter('test', 5, 'local'), get_socket_rate_limiter('test', 5.0, 'local'))
+        self.assertIsNot(get_socket_rate_limiter('test', 5, 'local'), get_socket_rate_limiter('test', 10, 'local'))
+        with self.assertRaises(ValueError):
+            get_socket_rate_limiter('test', 5, 'unknown')
\ No newline at end of file
@@ -0,0 +1,40 @@
+from django.test import SimpleTestCase
+import asyncio
+from unittest import mock
+from apps.utils import LlmResponseCache, iter_text
+
+MESSAGES = [{'role': 'system', 'content': 'sys'}, {'role': 'user', 'content': 'hello'}]
+PARAMS   = {'model_name': 'gpt-4o', 'temperature': 0.0, 'max_tokens': 128, 'top_p': 1.0}
+
+
+class LlmResponseCacheTest(SimpleTestCase):
+
+    def test_key_is_canonical(self):
+        """ 生成パラメータの順序に依存せず、messages / パラメータが変われば別のキーになる """
+        cache = LlmResponseCache('test', is_enabled=True)
+        key   = cache.build_key(MESSAGES, PARAMS)
+        self.assertEqual(key, cache.build_key(MESSAGES, dict(reversed(list(PARAMS.items())))))
+        self.assertNotEqual(key, cache.build_key(MESSAGES, dict(PARAMS, max_tokens=256)))
+        self.assertNotEqual(key, cache.build_key(MESSAGES[1:], PARAMS))
+
+    def test_opt_in(self):
+        """ 無効、または temperature が max_temperature を超える場合はキャッシュしない """
+        self.assertIsNone(LlmResponseCache('test').build_key(MESSAGES, PARAMS))
+        cache = LlmResponseCache('test', is_enabled=True, max_temperature=0.0)
+        self.assertIsNone(cache.build_key(MESSAGES, dict(PARAMS, temperature=0.7)))
+
+    def test_record_stream_saves_only_completed(self):
+        """ 最後まで読み切ったストリームだけを保存する """
+        cache = LlmResponseCache('test', is_enabled=True)
+
+        async def run():
+            with mock.patch.object(cache, 'aset') as aset:
+                deltas = [delta async for delta in cache.record_stream('k', iter_text('abcdef', chunk_size=2))]
+                self.assertEqual(deltas, ['ab', 'cd', 'ef'])
+                aset.assert_awaited_once_with('k', 'abcdef')
+
+                stream = cache.record_stream('k2', iter_text('abcdef', chunk_size=2))
+                await stream.__anext__()
+                await stream.aclose()
+                aset.assert_awaited_once()
+        asyncio.run(run())
\ No newline at end of file
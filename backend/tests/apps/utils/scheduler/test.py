@@ -0,0 +1,66 @@
+from django.test import SimpleTestCase
+import asyncio
+from apps.utils import LocalLlmBudget, LlmScheduler, LlmQueueTimeout, get_llm_scheduler
+
+
+class LlmSchedulerTest(SimpleTestCase):
+
+    def test_concurrency_limit(self):
+        """ 同時実行数の上限を超えた分は解放されるまで待ち、待つ間は順番を通知する """
+        scheduler = LlmScheduler(LocalLlmBudget(), poll_interval_sec=0.01)
+        positions = []
+
+        async def on_position(position):
+            positions.append(position)
+
+        async def run():
+            async with scheduler.slot('gpt-4o', 'user-a', 10, concurrency_limit=1):
+                waiter = asyncio.create_task(scheduler.slot('gpt-4o', 'user-b', 10, concurrency_limit=1,
+                                                            on_position=on_position).__aenter__())
+                await asyncio.sleep(0.05)
+                self.assertFalse(waiter.done())
+                self.assertEqual(scheduler.queue_len('gpt-4o'), 1)
+            slot = await asyncio.wait_for(waiter, 1)
+            await slot.__aexit__(None, None, None)
+        asyncio.run(run())
+        self.assertEqual(positions, [1])
+
+    def test_fair_queue_per_user(self):
+        """ 1 ユーザが先に大量に並べても、他のユーザの要求が間に入る """
+        scheduler = LlmScheduler(LocalLlmBudget(), poll_interval_sec=0.01)
+        order     = []
+
+        async def request(user_key):
+            async with scheduler.slot('gpt-4o', user_key, 10, concurrency_limit=1):
+                order.append(user_key)
+                await asyncio.sleep(0.01)
+
+        async def run():
+            async with scheduler.slot('gpt-4o', 'user-a', 10, concurrency_limit=1):
+                tasks  = [asyncio.create_task(request('user-a')) for _ in range(3)]
+                await asyncio.sleep(0)
+                tasks += [asyncio.create_task(request('user-b'))]
+                await asyncio.sleep(0.02)
+            await asyncio.gather(*tasks)
+        asyncio.run(run())
+        self.assertLess(order.index('user-b'), 2)
+
+    def test_tpm_limit_and_timeout(self):
+        """ TPM を使い切った場合は queue_timeout_sec で LlmQueueTimeout """
+        scheduler = LlmScheduler(LocalLlmBudget(), poll_interval_sec=0.01, queue_timeout_sec=0.05)
+
+        async def run():
+            async with scheduler.slot('gpt-4o', 'user-a', 1000, tpm_limit=1000):
+                pass
+            with self.assertRaises(LlmQueueTimeout):
+                async with scheduler.slot('gpt-4o', 'user-b', 1000, tpm_limit=1000):
+                    pass
+        asyncio.run(run())
+    def test_get_llm_scheduler_per_settings(self):
+        """ 設定ごとに別のスケジューラを返し、budget は backend ごとに共有する """
+        llmchat = get_llm_scheduler('local', poll_interval_sec=0.1, lease_ttl_sec=300, queue_timeout_sec=60)
+        vrmchat = get_llm_scheduler('local', poll_interval_sec=0.1, lease_ttl_sec=300, queue_timeout_sec=10)
+        self.assertIs(get_llm_scheduler('local', poll_interval_sec=0.1, lease_ttl_sec=300, queue_timeout_sec=60), llmchat)
+        self.assertIsNot(llmchat, vrmchat)
+        self.assertEqual(vrmchat.queue_timeout_sec, 10)
+        self.assertIs(llmchat.budget, vrmchat.budget)
\ No newline at end of file
@@ -0,0 +1,36 @@
+from django.test import SimpleTestCase
+import asyncio
+from apps.utils import LocalSessionLimiter, get_session_limiter
+
+
+class LocalSessionLimiterTest(SimpleTestCase):
+
+    def test_limit_per_key(self):
+        """ キーごとに上限まで確保でき、解放すると空く (同じ lease_id の再確保は数えない) """
+        limiter = LocalSessionLimiter()
+
+        async def run():
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-1:0', 2, 60))
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-2:0', 2, 60))
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-1:0', 2, 60))
+            self.assertFalse(await limiter.try_acquire('user-a', 'conn-1:1', 2, 60))
+            self.assertTrue(await limiter.try_acquire('user-b', 'conn-3:0', 2, 60))
+            await limiter.release('user-a', 'conn-2:0')
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-1:1', 2, 60))
+        asyncio.run(run())
+
+    def test_expired_lease(self):
+        """ 解放されなかったリースは期限で消える """
+        limiter = LocalSessionLimiter()
+
+        async def run():
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-1:0', 1, 0.01))
+            await asyncio.sleep(0.02)
+            self.assertTrue(await limiter.try_acquire('user-a', 'conn-1:1', 1, 60))
+        asyncio.run(run())
+
+    def test_get_session_limiter(self):
+        """ namespace / backend ごとに共有する """
+        self.assertIs(get_session_limiter('test', 'local'), get_session_limiter('test', 'local'))
+        with self.assertRaises(ValueError):
+            get_session_limiter('test', 'unknown')
\ No newline at end of file
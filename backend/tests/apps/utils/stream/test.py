@@ -0,0 +1,54 @@
+from django.test import SimpleTestCase
+import asyncio
+from apps.utils import StreamCoalescer, coalesce_stream, iter_text, split_sentences, split_sentence_stream
+
+
+class StreamCoalescerTest(SimpleTestCase):
+
+    def test_flush_on_max_bytes(self):
+        """ バッファが flush_max_bytes に達したらフラッシュされる """
+        coalescer = StreamCoalescer(flush_interval_ms=10_000, flush_max_bytes=4, is_flush_on_sentence=False)
+        self.assertIsNone(coalescer.add('ab'))
+        self.assertEqual(coalescer.add('cd'), 'abcd')
+        self.assertTrue(coalescer.is_empty)
+
+    def test_flush_on_sentence(self):
+        """ 文末で終わる delta でフラッシュされる """
+        coalescer = StreamCoalescer(flush_interval_ms=10_000, flush_max_bytes=1024, is_flush_on_sentence=True)
+        self.assertIsNone(coalescer.add('こんにち'))
+        self.assertEqual(coalescer.add('は。'), 'こんにちは。')
+
+    def test_coalesce_stream_keeps_full_text(self):
+        """ coalesce_stream の出力を連結すると元の全文になる """
+        text      = 'テスト用の文章です。二文目です！三文目'
+        coalescer = StreamCoalescer(flush_interval_ms=10_000, flush_max_bytes=1024, is_flush_on_sentence=True)
+
+        async def run():
+            return [chunk async for chunk in coalesce_stream(iter_text(text), coalescer)]
+
+        chunks = asyncio.run(run())
+        self.assertEqual(chunks, ['テスト用の文章です。', '二文目です！', '三文目'])
+        self.assertEqual(''.join(chunks), text)
+        self.assertEqual(coalescer.text,  text)
+
+
+class SplitSentencesTest(SimpleTestCase):
+
+    def test_split(self):
+        """ 文末で区切り、空白だけの部分は直前の文に含める """
+        text = '  こんにちは。今日はいい天気ですね！\n\n散歩に行きましょう'
+        self.assertEqual(split_sentences(text), ['  こんにちは。', '今日はいい天気ですね！\n\n', '散歩に行きましょう'])
+        self.assertEqual(split_sentences(' \n '), [])
+
+    def test_long_sentence(self):
+        """ max_chars を超える文は読点で (無ければ max_chars で) 区切る """
+        text = 'あ' * 8 + '、' + 'い' * 15 + '。'
+        self.assertEqual(split_sentences(text, max_chars=10), ['あ' * 8 + '、', 'い' * 10, 'い' * 5 + '。'])
+
+    def test_sentence_stream(self):
+        """ 文末の後に次の文字が来た時点で文を確定する (delta の区切り方によらない) """
+        text = 'こんにちは！？今日は\n\nいい天気。ですね  '
+        for chunk_size in (1, 3, len(text)):
+            async def run():
+                return [sentence async for sentence in split_sentence_stream(iter_text(text, chunk_size))]
+            self.assertEqual(asyncio.run(run()), ['こんにちは！？', '今日は\n\n', 'いい天気。', 'ですね  '])
\ No newline at end of file
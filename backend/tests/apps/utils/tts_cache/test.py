@@ -0,0 +1,59 @@
+from django.test import SimpleTestCase
+import asyncio
+import tempfile
+from apps.utils import TtsAudioCache
+
+VOICE        = {'language_code': 'ja-JP', 'name': 'ja-JP-Neural2-B', 'ssml_gender': 0}
+AUDIO_CONFIG = {'audio_encoding': 3, 'speaking_rate': 1.0, 'pitch': 0.0, 'volume_gain_db': 0.0}
+
+
+class TtsAudioCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.calls   = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _synthesizer(self, text:str):
+        async def synthesize():
+            self.calls.append(text)
+            await asyncio.sleep(0.01)
+            return f'audio:{text}'.encode('utf-8') * 10
+        return synthesize
+
+    def test_key(self):
+        """ テキスト・音声・AudioConfig のいずれかが違えば別のキーになる """
+        cache = TtsAudioCache('test', self.tmp_dir.name)
+        key   = cache.build_key('こんにちは', VOICE, AUDIO_CONFIG)
+        self.assertEqual(key, cache.build_key('こんにちは', dict(reversed(VOICE.items())), AUDIO_CONFIG))
+        self.assertNotEqual(key, cache.build_key('こんばんは', VOICE, AUDIO_CONFIG))
+        self.assertNotEqual(key, cache.build_key('こんにちは', VOICE, {**AUDIO_CONFIG, 'speaking_rate': 1.2}))
+        self.assertIsNone(TtsAudioCache('test', self.tmp_dir.name, is_enabled=False).build_key('こんにちは', VOICE, AUDIO_CONFIG))
+
+    def test_repeated_phrase(self):
+        """ 同じフレーズは (同時でも) 1 回だけ合成し、以降はディスクから返す (別のプロセスでも) """
+        cache = TtsAudioCache('test', self.tmp_dir.name)
+        key   = cache.build_key('こんにちは', VOICE, AUDIO_CONFIG)
+
+        async def run():
+            results = await asyncio.gather(*[cache.get_or_synthesize(key, self._synthesizer('こんにちは')) for _ in range(3)])
+            results.append(await cache.get_or_synthesize(key, self._synthesizer('こんにちは')))
+            other_process = TtsAudioCache('test', self.tmp_dir.name)
+            results.append(await other_process.get_or_synthesize(key, self._synthesizer('こんにちは')))
+            return results
+        results = asyncio.run(run())
+        self.assertEqual(self.calls, ['こんにちは'])
+        self.assertEqual(set(results), {'audio:こんにちは'.encode('utf-8') * 10})
+
+    def test_lru(self):
+        """ 合計が max_bytes を超えたら最終アクセスが古いものから削除する """
+        size  = len('audio:a'.encode('utf-8') * 10)
+        cache = TtsAudioCache('test', self.tmp_dir.name, max_bytes=size * 2)
+
+        async def run():
+            for text in ('a', 'b', 'a', 'c', 'a', 'b'):
+                await cache.get_or_synthesize(cache.build_key(text, VOICE, AUDIO_CONFIG), self._synthesizer(text))
+        asyncio.run(run())
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
\ No newline at end of file
@@ -0,0 +1,88 @@
+from django.test import SimpleTestCase
+import asyncio
+import glob
+import os
+import tempfile
+from apps.utils import WriteBehindQueue
+
+
+class WriteBehindQueueTest(SimpleTestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.batches   = []
+        self.is_down   = False
+
+    def _flush_fn(self, items):
+        if self.is_down:
+            raise ConnectionError('db is down')
+        if any(item['i'] < 0 for item in items):
+            raise ValueError('invalid item')
+        self.batches.append([item['i'] for item in items])
+
+    def _queue(self, **kwargs):
+        return WriteBehindQueue(name='test.write', flush_fn=self._flush_fn, spool_dir=self.spool_dir, **kwargs)
+
+    def test_flush_by_batch_size(self):
+        """ max_batch 件たまった時点でまとめて書き込む """
+        async def run():
+            queue = self._queue(max_batch=3, flush_interval_sec=10)
+            for i in range(3):
+                await queue.put({'i': i})
+            for _ in range(100):
+                if self.batches:
+                    break
+                await asyncio.sleep(0.01)
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[0, 1, 2]])
+
+    def test_flush_by_interval(self):
+        """ max_batch に満たなくても flush_interval_sec 経過で書き込む """
+        async def run():
+            queue = self._queue(max_batch=50, flush_interval_sec=0.05)
+            await queue.put({'i': 0})
+            await queue.put({'i': 1})
+            await asyncio.sleep(0.3)
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[0, 1]])
+
+    def test_spool_and_replay(self):
+        """ 書き込めない場合は spool に退避し、次の書き込み成功後に再投入する """
+        queue = self._queue(max_batch=2, replay_interval_sec=0)
+        self.is_down = True
+        queue._items.extend([{'i': 0}, {'i': 1}])
+        queue.flush_now()
+        self.assertEqual(len(glob.glob(os.path.join(self.spool_dir, '*.jsonl'))), 1)
+
+        self.is_down = False
+        self.assertEqual(queue.replay_spool(), 2)
+        self.assertEqual(self.batches, [[0, 1]])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_flush_now(self):
+        """ flush_now (終了時) は残りを全て同期で書き込む """
+        queue = self._queue(max_batch=2)
+        queue._items.extend([{'i': i} for i in range(5)])
+        queue.flush_now()
+        self.assertEqual(self.batches, [[0, 1], [2, 3], [4]])
+        self.assertEqual(len(queue), 0)
+
+    def test_replay_quarantines_invalid_items(self):
+        """ 再投入で書き込めない item は 1 件ずつ確認して .dead に移し、他の item / ファイルの再投入を続ける """
+        queue = self._queue(max_batch=3, replay_interval_sec=0)
+        self.is_down = True
+        queue._items.extend([{'i': 0}, {'i': -1}, {'i': 2}])
+        queue.flush_now()
+        queue._spool_path = lambda: os.path.join(self.spool_dir, 'test.write-other.jsonl')
+        queue._items.extend([{'i': 3}])
+        queue.flush_now()
+
+        self.is_down = False
+        self.assertEqual(queue.replay_spool(), 3)
+        self.assertEqual(sorted(i for batch in self.batches for i in batch), [0, 2, 3])
+        dead_paths = glob.glob(os.path.join(self.spool_dir, '*.dead'))
+        self.assertEqual(len(dead_paths), 1)
+        with open(dead_paths[0], encoding='utf-8') as f:
+            self.assertEqual(f.read(), '{"i": -1}\n')
+        self.assertEqual(glob.glob(os.path.join(self.spool_dir, '*.jsonl')), [])
+        self.assertEqual(queue.replay_spool(), 0)
\ No newline at end of file
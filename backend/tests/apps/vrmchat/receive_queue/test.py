@@ -0,0 +1,76 @@
+from django.test import SimpleTestCase
+import asyncio
+import json
+import sys
+from unittest import mock
+from apps.utils import SocketCodec
+from apps.vrmchat.consumers import VrmchatConsumer
+
+consumer_module = sys.modules[VrmchatConsumer.__module__]
+
+
+class _RateLimiter:
+    async def allow(self, key):
+        return True
+
+
+def _make_consumer():
+    # python 3.9 の Queue は作成時のループに紐づくので実行中のループで呼ぶ
+    consumer = VrmchatConsumer.__new__(VrmchatConsumer)
+    consumer.codec                 = SocketCodec()
+    consumer.channel_name          = 'conn-1'
+    consumer.rate_limiter          = _RateLimiter()
+    consumer.receive_queue         = asyncio.Queue(maxsize=10)
+    consumer.generation_task       = None
+    consumer.generation_message_id = None
+    consumer.sent                  = []
+
+    async def self_send_message(message_data, is_send_bytes_data=True):
+        consumer.sent.append(message_data)
+    consumer._self_send_message = self_send_message
+    return consumer
+
+
+class ReceiveQueueTest(SimpleTestCase):
+
+    def test_oversized_frame_keeps_worker(self):
+        """ サイズ超過 / 空のフレームは wsClose を返し、受信キューの処理は続ける """
+        async def run():
+            consumer = _make_consumer()
+            with mock.patch.object(consumer_module, 'SOCKET_REXEIVE_DATA_KB_LIMIT', 1):
+                worker = asyncio.create_task(consumer._receive_worker())
+                consumer.receive_queue.put_nowait(('a' * 4096, None))
+                consumer.receive_queue.put_nowait((None, b''))
+                consumer.receive_queue.put_nowait((json.dumps({'cmd': 'Reconnect'}), None))
+                await asyncio.sleep(0.05)
+                is_alive = not worker.done()
+                worker.cancel()
+            return consumer, is_alive
+        consumer, is_alive = asyncio.run(run())
+        self.assertTrue(is_alive)
+        self.assertEqual([message['cmd'] for message in consumer.sent], ['wsClose', 'wsClose', 'Reconnect'])
+
+    def test_one_generation_per_connection(self):
+        """ 生成中の SendUserMessage は空の回答で返し、StopGeneration で生成を取り消す """
+        started = []
+
+        async def receive_user_message(user_message, message_id, is_possible_compress, is_tts_pipeline=False):
+            started.append(user_message)
+            await asyncio.Event().wait()
+
+        async def run():
+            consumer                       = _make_consumer()
+            consumer._receive_user_message = receive_user_message
+            worker                         = asyncio.create_task(consumer._receive_worker())
+            for message in ['first', 'second']:
+                consumer.receive_queue.put_nowait((json.dumps({'cmd': 'SendUserMessage', 'data': {'message': message}}), None))
+            await asyncio.sleep(0.01)
+            consumer.receive_queue.put_nowait((json.dumps({'cmd': 'StopGeneration', 'data': {}}), None))
+            await asyncio.sleep(0.05)
+            worker.cancel()
+            return consumer
+        consumer = asyncio.run(run())
+        self.assertTrue(consumer.generation_task.cancelled())
+        self.assertEqual(started, ['first'])
+        busy = [message for message in consumer.sent if message['cmd'] == 'SendUserMessage']
+        self.assertEqual([message['data']['llmResponse'] for message in busy], ['', ''])
\ No newline at end of file
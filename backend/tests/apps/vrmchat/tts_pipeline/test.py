@@ -0,0 +1,53 @@
+from django.test import SimpleTestCase
+import asyncio
+import sys
+from unittest import mock
+from apps.utils import SocketCodec, LocalLlmBudget, LlmScheduler, decode_audio_frame
+from apps.vrmchat.consumers import VrmchatConsumer
+
+consumer_module = sys.modules[VrmchatConsumer.__module__]
+
+
+async def _llm_stream(deltas):
+    for delta in deltas:
+        await asyncio.sleep(0.001)
+        yield delta
+
+
+class TtsPipelineTest(SimpleTestCase):
+
+    def setUp(self):
+        self.consumer = VrmchatConsumer.__new__(VrmchatConsumer)
+        self.consumer.codec       = SocketCodec()
+        self.consumer.tts_counter = 0
+        self.sent                 = []
+
+        async def send(text_data=None, bytes_data=None):
+            if bytes_data is not None:
+                self.sent.append(decode_audio_frame(bytes_data))
+        self.consumer.send = send
+
+    def test_slot_released_before_tts(self):
+        """ LLM のスロットはストリームの終了で解放し、残りの文の TTS はスロットの外で行う。全文は文間の改行も含めて返す """
+        scheduler  = LlmScheduler(LocalLlmBudget(), poll_interval_sec=0.01)
+        is_holding = []
+
+        async def synthesize(text):
+            await asyncio.sleep(0.05)
+            is_holding.append(bool(scheduler.budget._leases.get('m')))
+            return text.encode('utf-8')
+
+        async def run():
+            # python 3.9 の Semaphore は作成時のループに紐づくので実行中のループで作る
+            self.consumer.tts_semaphore = asyncio.Semaphore(3)
+            slot   = scheduler.slot('m', 'user-a', 10, concurrency_limit=1)
+            stream = self.consumer._slot_stream(slot, _llm_stream(['こんにちは。', '\n\n', '良い天気です。\n', 'またね。']), 5)
+            with mock.patch.object(consumer_module, 'synthesize_speech', synthesize):
+                response = await self.consumer._stream_tts_pipeline(stream, 'm1', 0.0, is_send_bytes_data=False)
+            return response, slot
+        response, slot = asyncio.run(run())
+        self.assertEqual(response, 'こんにちは。\n\n良い天気です。\nまたね。')
+        self.assertIsNotNone(slot.actual_tokens)
+        # 最後の文の合成が終わる時点ではスロットは解放済み
+        self.assertFalse(is_holding[-1])
+        self.assertEqual([frame[1] for frame in self.sent], [0, 1, 2, 3])
\ No newline at end of file
@@ -0,0 +1,67 @@
+from django.test import SimpleTestCase
+import asyncio
+from types import SimpleNamespace
+from common.scripts.LlmUtils import OpenAILlm, get_client_pool_stats
+
+
+class _FakeCompletions:
+
+    def __init__(self):
+        self.kwargs_list = []
+
+    async def create(self, **kwargs):
+        self.kwargs_list.append(kwargs)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='ok'))])
+
+
+class ClientPoolTest(SimpleTestCase):
+
+    def test_clients_are_reused(self):
+        """ 同じ認証情報のクライアント (接続プール) は使い回す """
+        llm_a = OpenAILlm(api_key='test-key-a')
+        llm_b = OpenAILlm(api_key='test-key-a')
+        llm_c = OpenAILlm(api_key='test-key-b')
+        self.assertIs(llm_a.client, llm_b.client)
+        self.assertIsNot(llm_a.client, llm_c.client)
+
+        async def run():
+            self.assertIs(llm_a.async_client, llm_b.async_client)
+            self.assertIsNot(llm_a.async_client, llm_c.async_client)
+        asyncio.run(run())
+
+    def test_async_clients_per_event_loop(self):
+        """ async のクライアントはイベントループごとに作る (別のループの接続を使わない) """
+        llm = OpenAILlm(api_key='test-key-a')
+
+        async def get_async_client():
+            self.assertIs(llm.async_client, llm.async_client)
+            return llm.async_client
+        self.assertIsNot(asyncio.run(get_async_client()), asyncio.run(get_async_client()))
+        with self.assertRaises(RuntimeError):
+            llm.async_client
+
+    def test_stats_hide_credentials(self):
+        """ 統計には認証情報を含めない """
+        OpenAILlm(api_key='test-key-secret')
+        stats = get_client_pool_stats()
+        self.assertTrue(any(stat['provider'] == 'openai' and stat['acquired'] >= 1 for stat in stats))
+        self.assertNotIn('test-key-secret', repr(stats))
+
+    def test_generation_params_at_request_time(self):
+        """ 生成パラメータは呼び出し時に渡した値で上書きする """
+        llm = OpenAILlm(api_key='test-key-a', temperature=1.0)
+        completions      = _FakeCompletions()
+        llm.async_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        messages = [{'role': 'user', 'content': 'ping'}]
+        asyncio.run(llm.async_get_response(messages, model_name='gpt-4o', temperature=0.2))
+        asyncio.run(llm.async_get_response(messages))
+        self.assertEqual((completions.kwargs_list[0]['model'], completions.kwargs_list[0]['temperature']), ('gpt-4o', 0.2))
+        self.assertEqual(completions.kwargs_list[1]['temperature'], 1.0)
+
+    def test_invalid_generation_params(self):
+        """ 範囲外・未知の生成パラメータはエラー """
+        llm = OpenAILlm(api_key='test-key-a')
+        with self.assertRaises(ValueError):
+            asyncio.run(llm.async_get_response([{'role': 'user', 'content': 'ping'}], temperature=3.0))
+        with self.assertRaises(TypeError):
+            asyncio.run(llm.async_get_response([{'role': 'user', 'content': 'ping'}], seed=1))
\ No newline at end of file
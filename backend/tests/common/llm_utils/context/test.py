@@ -0,0 +1,41 @@
+from django.test import SimpleTestCase
+from common.scripts.LlmUtils import pack_history, pack_context
+
+
+class PackHistoryTest(SimpleTestCase):
+
+    def test_all_turns_fit(self):
+        """ 全て収まる場合は全ターンを使う """
+        self.assertEqual(pack_history([10, 20, 30], 60), 3)
+
+    def test_oldest_turns_are_dropped(self):
+        """ 古いターンから削り、収まる最大の直近ターン数を返す """
+        self.assertEqual(pack_history([10, 20, 30], 59), 2)
+        self.assertEqual(pack_history([10, 20, 30], 50), 2)
+        self.assertEqual(pack_history([10, 20, 30], 49), 1)
+        self.assertEqual(pack_history([10, 20, 30], 29), 0)
+        self.assertEqual(pack_history([10, 20, 30], -1), 0)
+
+    def test_matches_linear_scan(self):
+        """ 線形探索の結果と一致する """
+        turn_tokens = [7, 1, 12, 3, 0, 25, 4, 9]
+        for budget in range(0, sum(turn_tokens)+2):
+            n, total = 0, 0
+            for tokens in reversed(turn_tokens):
+                if total + tokens > budget:
+                    break
+                total += tokens
+                n     += 1
+            self.assertEqual(pack_history(turn_tokens, budget), n)
+
+
+class PackContextTest(SimpleTestCase):
+
+    def test_history_is_trimmed_instead_of_rejected(self):
+        """ ユーザメッセージが収まればヒストリーを削って返す """
+        n = pack_context('hi', [100, 100, 100], context_tokens=1000, max_tokens=700, base_tokens=50)
+        self.assertEqual(n, 2)
+
+    def test_sentence_does_not_fit(self):
+        """ ユーザメッセージだけで収まらない場合は None """
+        self.assertIsNone(pack_context('a' * 4000, [10], context_tokens=100, max_tokens=0))
\ No newline at end of file
@@ -0,0 +1,88 @@
+from django.test import SimpleTestCase
+import asyncio
+from common.scripts.LlmUtils.llms import LlmRoute, LlmRouter, NoAvailableRouteError, get_circuit_breaker
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+class _FakeLlm:
+
+    def __init__(self, deltas=('a', 'b'), delay_sec=0.0, error=None):
+        self.deltas    = deltas
+        self.delay_sec = delay_sec
+        self.error     = error
+        self.calls     = 0
+        self.closed    = 0
+
+    async def async_get_stream_response(self, messages, **generation_params):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay_sec)
+            if self.error:
+                raise self.error
+            for delta in self.deltas:
+                yield delta
+        finally:
+            self.closed += 1
+
+    async def async_get_response(self, messages, **generation_params):
+        self.calls += 1
+        await asyncio.sleep(self.delay_sec)
+        if self.error:
+            raise self.error
+        return generation_params['model_name']
+
+
+async def _collect(stream):
+    return ''.join([delta async for delta in stream])
+
+
+class LlmRouterTest(SimpleTestCase):
+
+    def test_failover_on_error(self):
+        """ primary が失敗した場合は次の候補で再試行する """
+        primary   = _FakeLlm(error=ConnectionError('down'))
+        secondary = _FakeLlm(deltas=('ok',))
+        router    = LlmRouter([LlmRoute('test-failover-a', primary, 'm'), LlmRoute('test-failover-b', secondary, 'm')],
+                              retry_limit_n=1, backoff_base_sec=0,)
+        self.assertEqual(asyncio.run(_collect(router.async_get_stream_response(MESSAGES, model_name='m'))), 'ok')
+        self.assertEqual((primary.calls, secondary.calls), (1, 1))
+
+    def test_first_token_deadline(self):
+        """ 最初のトークンが期限までに届かない候補は取り消して次の候補を使う """
+        slow   = _FakeLlm(delay_sec=1.0)
+        fast   = _FakeLlm(deltas=('fast',))
+        router = LlmRouter([LlmRoute('test-deadline-a', slow, 'm'), LlmRoute('test-deadline-b', fast, 'm')],
+                           retry_limit_n=1, first_token_timeout_sec=0.05, backoff_base_sec=0,)
+        self.assertEqual(asyncio.run(_collect(router.async_get_stream_response(MESSAGES, model_name='m'))), 'fast')
+        self.assertEqual(slow.closed, 1)
+
+    def test_hedge(self):
+        """ ヘッジでは先に最初のトークンが届いた候補を使う (非ストリーミングも同じ) """
+        slow   = _FakeLlm(delay_sec=0.5)
+        fast   = _FakeLlm()
+        router = LlmRouter([LlmRoute('test-hedge-a', slow, 'slow'), LlmRoute('test-hedge-b', fast, 'fast', is_fallback_model=True)],
+                           hedge_after_sec=0.01,)
+        self.assertEqual(asyncio.run(router.async_get_response(MESSAGES, model_name='slow')), 'fast')
+
+    def test_circuit_breaker(self):
+        """ 続けて失敗したプロバイダは候補から除き、全て除かれた場合は NoAvailableRouteError """
+        get_circuit_breaker('test-breaker', failure_threshold=2, reset_timeout_sec=60)
+        llm    = _FakeLlm(error=ConnectionError('down'))
+        router = LlmRouter([LlmRoute('test-breaker', llm, 'm')], retry_limit_n=5, backoff_base_sec=0,)
+        with self.assertRaises(NoAvailableRouteError):
+            asyncio.run(router.async_get_response(MESSAGES, model_name='m'))
+        self.assertEqual(llm.calls, 2)
+
+    def test_no_retry_on_invalid_params(self):
+        """ 生成パラメータの誤りは再試行しない """
+        llm    = _FakeLlm(error=ValueError('llm parameter values error'))
+        router = LlmRouter([LlmRoute('test-invalid', llm, 'm')], retry_limit_n=2, backoff_base_sec=0,)
+        with self.assertRaises(ValueError):
+            asyncio.run(router.async_get_response(MESSAGES, model_name='m'))
+        self.assertEqual(llm.calls, 1)
+    def test_circuit_breaker_shared(self):
+        """ CircuitBreaker はプロバイダごとに共有し、異なる値は最初の値のまま使う """
+        breaker = get_circuit_breaker('test-shared', failure_threshold=2, reset_timeout_sec=60)
+        self.assertIs(get_circuit_breaker('test-shared', failure_threshold=5, reset_timeout_sec=30), breaker)
+        self.assertEqual((breaker.failure_threshold, breaker.reset_timeout_sec), (2, 60))
\ No newline at end of file
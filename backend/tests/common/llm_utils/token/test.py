@@ -0,0 +1,32 @@
+from django.test import SimpleTestCase
+from unittest import mock
+from common.scripts.LlmUtils import (
+    get_encoding, calc_token, calc_token_upper_bound, is_tokens_less_than_settings,
+)
+from common.scripts.LlmUtils import TokenUtils
+
+
+class TokenUtilsTest(SimpleTestCase):
+
+    def test_encoding_is_cached(self):
+        """ encoder はモデル名ごとに使い回し、未知のモデル名は既定のエンコーディングで代用する """
+        self.assertIs(get_encoding('gpt-4o'), get_encoding('gpt-4o'))
+        self.assertEqual(get_encoding('gemini-2.0-flash').name, TokenUtils.DEFAULT_ENCODING_NAME)
+
+    def test_upper_bound(self):
+        """ トークン数は UTF-8 のバイト数を超えない """
+        for sentence in ('hello world', 'こんにちは、世界。', '<|endoftext|>'):
+            self.assertLessEqual(calc_token(sentence), calc_token_upper_bound(sentence))
+
+    def test_skip_tokenize_when_obviously_under(self):
+        """ バイト数で収まる場合はトークン化しない """
+        with mock.patch.object(TokenUtils, 'calc_token') as calc_token_mock:
+            self.assertTrue(is_tokens_less_than_settings('short', max_tokens=100, base_tokens=10))
+            calc_token_mock.assert_not_called()
+
+    def test_base_tokens_are_added(self):
+        """ 保存済みのトークン数 (base_tokens) を含めて判定する """
+        sentence = 'テスト' * 50
+        tokens   = calc_token(sentence)
+        self.assertTrue(is_tokens_less_than_settings(sentence, max_tokens=tokens+5, base_tokens=5))
+        self.assertFalse(is_tokens_less_than_settings(sentence, max_tokens=tokens+5, base_tokens=6))
\ No newline at end of file
@@ -98,6 +98,8 @@ export function WebSocketCoreProvider({ WebsocketUrl, WebsocketId, children,}: W
   const socketRef   = useRef<WebSocket | null>(null);
   const brotliRef   = useRef<BrotliWasm | null>(null);
   const accessIdRef = useRef<string>('');
+  // 受信したメッセージを到着順に処理する (Blob の復号は非同期のため、後に届いたテキストが先に処理されないようにする)
+  const receiveChainRef = useRef<Promise<void>>(Promise.resolve());
   // ping
   const pingIntervalRef  = useRef<NodeJS.Timeout | null>(null);
   const pingIntervalTime = 5000;
@@ -120,9 +122,11 @@ export function WebSocketCoreProvider({ WebsocketUrl, WebsocketId, children,}: W
     });
     // message
     ws.addEventListener('message', (event: MessageEvent) => {
-      handleReceiveMessage(event).catch(() => {
-        showToast('error', 'socket error', {position: 'bottom-right', duration: 3000,});
-      });
+      receiveChainRef.current = receiveChainRef.current
+        .then(() => handleReceiveMessage(event))
+        .catch(() => {
+          showToast('error', 'socket error', {position: 'bottom-right', duration: 3000,});
+        });
     });
     // close
     ws.addEventListener('close', () => {